@@ -10,6 +10,7 @@ add_arg = functools.partial(add_arguments, argparser=parser)
 add_arg('configs',          str,   'configs/conformer.yml',     "配置文件")
 add_arg("use_gpu",          bool,  True,                        "是否使用GPU评估模型")
 add_arg('resume_model',     str,   'models/conformer_streaming_fbank/best_model/',  "模型的路径")
+add_arg('num_decode_processes', int, 4,                         "集束搜索解码的进程数量，每个进程加载一份语言模型，为0时在主进程中解码")
 args = parser.parse_args()
 print_arguments(args=args)
 
@@ -20,6 +21,7 @@ trainer = MASRTrainer(configs=args.configs, use_gpu=args.use_gpu)
 # 开始评估
 start = time.time()
 loss, error_result = trainer.evaluate(resume_model=args.resume_model,
-                                      display_result=True)
+                                      display_result=True,
+                                      num_decode_processes=args.num_decode_processes)
 end = time.time()
 print('评估消耗时间：{}s，错误率：{:.5f}'.format(int(end - start), error_result))
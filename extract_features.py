@@ -8,6 +8,8 @@ parser = argparse.ArgumentParser(description=__doc__)
 add_arg = functools.partial(add_arguments, argparser=parser)
 add_arg('configs',          str,    'configs/conformer.yml',       '配置文件')
 add_arg('save_dir',         str,     'dataset/features',        '保存特征的路径')
+add_arg('shard_duration',   int,     3600,                      '每个特征分片包含的音频总长度，单位为秒')
+add_arg('feature_dtype',    str,     'float32',                 '保存特征的数据类型', choices=['float32', 'float16'])
 args = parser.parse_args()
 print_arguments(args=args)
 
@@ -15,4 +17,4 @@ print_arguments(args=args)
 trainer = MASRTrainer(configs=args.configs)
 
 # 提取特征保存文件
-trainer.extract_features(save_dir=args.save_dir)
+trainer.extract_features(save_dir=args.save_dir, shard_duration=args.shard_duration, feature_dtype=args.feature_dtype)
@@ -0,0 +1,205 @@
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import time
+
+import soundfile
+from tqdm import tqdm
+
+from masr.data_utils.audio import AudioSegment
+from masr.utils.logger import setup_logger
+from masr.utils.utils import add_arguments, print_arguments
+
+logger = setup_logger(__name__)
+
+parser = argparse.ArgumentParser(description=__doc__)
+add_arg = functools.partial(add_arguments, argparser=parser)
+add_arg('configs',          str,    'configs/conformer.yml',     "配置文件")
+add_arg('input_path',       str,    'dataset/manifest.test',     "需要识别的数据列表路径，或者是音频文件夹路径")
+add_arg('output_path',      str,    'output/transcription.jsonl', "识别结果的保存路径，已经存在时会跳过已经识别的音频继续识别")
+add_arg('num_workers',      int,    2,                           "识别的进程数量，每个进程加载一个识别器")
+add_arg('worker_threads',   int,    2,                           "每个识别进程使用的线程数量")
+add_arg('batch_size',       int,    32,                          "每个识别进程一次识别的音频数量")
+add_arg('max_frames',       int,    60000,                       "每个批次补齐之后的最大特征帧数")
+add_arg('use_gpu',          bool,   True,                        "是否使用GPU预测")
+add_arg('use_pun',          bool,   False,                       "是否给识别结果加标点符号")
+add_arg('is_itn',           bool,   False,                       "是否对文本进行反标准化")
+add_arg('model_path',       str,    'models/conformer_streaming_fbank/inference.pt', "导出的预测模型文件路径")
+add_arg('pun_model_dir',    str,    'models/pun_models/',        "加标点符号的模型文件夹路径")
+args = parser.parse_args()
+
+AUDIO_EXTENSIONS = ['.wav', '.mp3', '.flac', '.m4a', '.ogg', '.opus', '.aac']
+
+
+# 获取音频的长度，单位秒
+def get_duration(audio_path):
+    try:
+        return soundfile.info(audio_path).duration
+    except Exception:
+        return AudioSegment.from_file(audio_path).duration
+
+
+# 读取需要识别的音频列表，数据列表和read_manifest()的格式相同
+def load_input_list(input_path):
+    if os.path.isdir(input_path):
+        audio_paths = []
+        for root, _, files in os.walk(input_path):
+            for file in files:
+                if os.path.splitext(file)[-1].lower() in AUDIO_EXTENSIONS:
+                    audio_paths.append(os.path.join(root, file))
+        return [{'audio_filepath': p, 'duration': get_duration(p)} for p in sorted(audio_paths)]
+    data_list = []
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() == '': continue
+            data = json.loads(line)
+            if 'duration' not in data:
+                if 'start_time' in data:
+                    data['duration'] = data['end_time'] - data['start_time']
+                else:
+                    data['duration'] = get_duration(data['audio_filepath'])
+            data_list.append(data)
+    return data_list
+
+
+# 识别结果的唯一标识，同一个音频文件的不同片段需要分开记录
+def segment_key(data):
+    return data['audio_filepath'], data.get('start_time'), data.get('end_time')
+
+
+# 读取需要识别的音频数据，有start_time和end_time的数据只读取这一片段，并统一采样率
+def load_audio_data(data, sample_rate):
+    if 'start_time' not in data:
+        return data['audio_filepath']
+    audio_segment = AudioSegment.slice_from_file(data['audio_filepath'],
+                                                 start=data['start_time'], end=data['end_time'])
+    if audio_segment.sample_rate != sample_rate:
+        audio_segment.resample(sample_rate)
+    return audio_segment.samples
+
+
+# 读取已经识别完成的音频，并截断最后一行没有写完整的结果
+def load_finished(output_path):
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, 'rb+') as f:
+        valid_size = 0
+        for line in f:
+            if not line.endswith(b'\n'): break
+            try:
+                finished.add(segment_key(json.loads(line.decode('utf-8'))))
+            except Exception:
+                break
+            valid_size += len(line)
+        f.truncate(valid_size)
+    return finished
+
+
+# 识别进程，每个进程独立加载一个识别器，从任务队列中取出批次进行识别
+def worker(worker_id, task_queue, result_queue):
+    import torch
+    torch.set_num_threads(args.worker_threads)
+    from masr.predict import MASRPredictor
+    predictor = MASRPredictor(configs=args.configs,
+                              model_path=args.model_path,
+                              use_gpu=args.use_gpu,
+                              use_pun=args.use_pun,
+                              pun_model_dir=args.pun_model_dir)
+    sample_rate = predictor.configs.preprocess_conf.sample_rate
+    result_queue.put(('ready', worker_id, None))
+    while True:
+        batch = task_queue.get()
+        if batch is None: break
+        start = time.time()
+        try:
+            results = predictor.predict_batch(audio_datas=[load_audio_data(d, sample_rate) for d in batch],
+                                              use_pun=args.use_pun, is_itn=args.is_itn, sample_rate=sample_rate,
+                                              max_frames=args.max_frames, num_workers=args.worker_threads)
+        except Exception as e:
+            # 批次中有无法识别的音频时逐条识别，识别失败的音频不写入结果，下次运行会重新识别
+            logger.warning(f'批量识别失败，改为逐条识别：{e}')
+            results = []
+            for d in batch:
+                try:
+                    results.append(predictor.predict(audio_data=load_audio_data(d, sample_rate),
+                                                     use_pun=args.use_pun, is_itn=args.is_itn,
+                                                     sample_rate=sample_rate))
+                except Exception as e:
+                    logger.error(f'识别音频{segment_key(d)}失败：{e}')
+                    results.append(None)
+        result_queue.put(('result', worker_id, (batch, results, time.time() - start)))
+    result_queue.put(('done', worker_id, None))
+
+
+def main():
+    print_arguments(args=args)
+    data_list = load_input_list(args.input_path)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+    finished = load_finished(args.output_path)
+    data_list = [d for d in data_list if segment_key(d) not in finished]
+    logger.info(f'一共{len(data_list) + len(finished)}条音频，已经识别{len(finished)}条，剩余{len(data_list)}条')
+    if len(data_list) == 0: return
+    # 按长度从长到短排序，长度相近的音频在同一个批次中，补齐的部分最少
+    data_list.sort(key=lambda d: d['duration'], reverse=True)
+    batches = [data_list[i:i + args.batch_size] for i in range(0, len(data_list), args.batch_size)]
+
+    ctx = multiprocessing.get_context('spawn')
+    task_queue, result_queue = ctx.Queue(), ctx.Queue()
+    for batch in batches:
+        task_queue.put(batch)
+    num_workers = max(1, min(args.num_workers, len(batches)))
+    for _ in range(num_workers):
+        task_queue.put(None)
+    processes = [ctx.Process(target=worker, args=(i, task_queue, result_queue), daemon=True)
+                 for i in range(num_workers)]
+    for p in processes:
+        p.start()
+
+    num_ready, num_done, num_failed = 0, 0, 0
+    total_duration, compute_time, start = 0.0, 0.0, None
+    with open(args.output_path, 'a', encoding='utf-8') as f, tqdm(total=len(data_list)) as bar:
+        while num_done < num_workers:
+            try:
+                event, worker_id, data = result_queue.get(timeout=10)
+            except Exception:
+                if not any(p.is_alive() for p in processes):
+                    raise Exception('识别进程异常退出')
+                continue
+            if event == 'ready':
+                num_ready += 1
+                # 全部识别器加载完成之后才开始计时，不统计模型加载和预热的时间
+                if num_ready == num_workers: start = time.time()
+            elif event == 'done':
+                num_done += 1
+            else:
+                batch, results, used_time = data
+                compute_time += used_time
+                for d, result in zip(batch, results):
+                    if result is None:
+                        num_failed += 1
+                        continue
+                    line = {'audio_filepath': d['audio_filepath'], 'duration': d['duration'],
+                            'text': result['text'], 'score': result['score']}
+                    if 'start_time' in d:
+                        line['start_time'], line['end_time'] = d['start_time'], d['end_time']
+                    f.write(json.dumps(line, ensure_ascii=False) + '\n')
+                    total_duration += d['duration']
+                # 每个批次写入之后刷新到磁盘，中断之后可以从这里继续识别
+                f.flush()
+                os.fsync(f.fileno())
+                bar.update(len(batch))
+    for p in processes:
+        p.join()
+    elapsed = time.time() - (start or time.time())
+    logger.info(f'识别完成，音频总长度：{total_duration:.2f}s，消耗时间：{elapsed:.2f}s，识别失败：{num_failed}条')
+    if total_duration > 0 and elapsed > 0:
+        logger.info(f'整体实时率(RTF)：{elapsed / total_duration:.4f}，'
+                    f'单进程实时率(RTF)：{compute_time / total_duration:.4f}，'
+                    f'吞吐量：{total_duration / elapsed:.2f}秒音频/秒，{(len(data_list) - num_failed) / elapsed:.2f}条/秒')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import argparse
 import functools
+import os
 import time
 import wave
 
@@ -9,12 +10,16 @@ from masr.utils.utils import add_arguments, print_arguments
 parser = argparse.ArgumentParser(description=__doc__)
 add_arg = functools.partial(add_arguments, argparser=parser)
 add_arg('configs',          str,    'configs/conformer.yml',     "配置文件")
-add_arg('wav_path',         str,    'dataset/test.wav',          "预测音频的路径")
+add_arg('wav_path',         str,    'dataset/test.wav',          "预测音频的路径，如果是文件夹则批量识别文件夹中的全部音频")
 add_arg('is_long_audio',    bool,   False,                       "是否为长语音")
 add_arg('real_time_demo',   bool,   False,                       "是否使用实时语音识别演示")
 add_arg('use_gpu',          bool,   True,                        "是否使用GPU预测")
 add_arg('use_pun',          bool,   False,                       "是否给识别结果加标点符号")
 add_arg('is_itn',           bool,   False,                       "是否对文本进行反标准化")
+add_arg('max_frames',       int,    60000,                       "批量识别时每个批次补齐之后的最大特征帧数")
+add_arg('num_decode_processes', int, 0,                          "批量识别时集束搜索解码的进程数量，为0时在主进程中解码")
+add_arg('decoding_chunk_size', int,  16,                         "流式识别的数据块大小，越大延迟越高")
+add_arg('num_decoding_left_chunks', int, -1,                     "流式识别使用左边数据块的数量，小于0为使用全部历史数据")
 add_arg('model_path',       str,    'models/conformer_streaming_fbank/inference.pt', "导出的预测模型文件路径")
 add_arg('pun_model_dir',    str,    'models/pun_models/',        "加标点符号的模型文件夹路径")
 args = parser.parse_args()
@@ -25,7 +30,9 @@ predictor = MASRPredictor(configs=args.configs,
                           model_path=args.model_path,
                           use_gpu=args.use_gpu,
                           use_pun=args.use_pun,
-                          pun_model_dir=args.pun_model_dir)
+                          pun_model_dir=args.pun_model_dir,
+                          decoding_chunk_size=args.decoding_chunk_size,
+                          num_decoding_left_chunks=args.num_decoding_left_chunks)
 
 
 # 短语音识别
@@ -44,6 +51,24 @@ def predict_long_audio():
     print(f"长语音识别结果，消耗时间：{int(round((time.time() - start) * 1000))}, 得分: {score}, 识别结果: {text}")
 
 
+# 批量识别文件夹中的音频
+def predict_audio_dir():
+    audio_paths = sorted([os.path.join(args.wav_path, f) for f in os.listdir(args.wav_path)
+                          if os.path.splitext(f)[-1].lower() in ['.wav', '.mp3', '.flac', '.m4a', '.ogg']])
+    decoder_pool = None
+    if args.num_decode_processes > 0 and predictor.configs.decoder == 'ctc_beam_search':
+        from masr.infer_utils.decoder_pool import DecoderPool
+        decoder_pool = DecoderPool(vocab_list=predictor._text_featurizer.vocab_list,
+                                   decoder_conf=predictor.configs.ctc_beam_search_decoder_conf,
+                                   num_processes=args.num_decode_processes)
+    start = time.time()
+    results = predictor.predict_batch(audio_datas=audio_paths, use_pun=args.use_pun, is_itn=args.is_itn,
+                                      max_frames=args.max_frames, decoder_pool=decoder_pool)
+    for audio_path, result in zip(audio_paths, results):
+        print(f"{audio_path}, 识别结果: {result['text']}, 得分: {int(result['score'])}")
+    print(f"批量识别{len(audio_paths)}条音频，消耗时间：{int(round((time.time() - start) * 1000))}ms")
+
+
 # 实时识别模拟
 def real_time_predict_demo():
     # 识别间隔时间
@@ -72,6 +97,8 @@ def real_time_predict_demo():
 if __name__ == "__main__":
     if args.real_time_demo:
         real_time_predict_demo()
+    elif os.path.isdir(args.wav_path):
+        predict_audio_dir()
     else:
         if args.is_long_audio:
             predict_long_audio()
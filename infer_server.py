@@ -1,21 +1,28 @@
 import argparse
+import asyncio
+import contextlib
 import functools
 import os
 import random
 import sys
 import time
+import uuid
 import wave
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import yaml
 import re
 
 import aiofiles
+import torch
 import uvicorn
 from fastapi import FastAPI, WebSocket, UploadFile, File, Request
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 from starlette.websockets import WebSocketState
 
+from masr.infer_utils.decoder_pool import DecoderPool
+from masr.infer_utils.worker_pool import PredictorWorkerPool
 from masr.predict import MASRPredictor
 from masr.utils.logger import setup_logger
 from masr.utils.utils import add_arguments, print_arguments
@@ -33,8 +40,30 @@ add_arg('use_pun',          bool,   False,  "是否给识别结果加标点符
 add_arg('is_itn',           bool,   False,  "是否对文本进行反标准化")
 add_arg('model_path',       str,    'models/inference.pt',       "导出的预测模型文件路径")
 add_arg('pun_model_dir',    str,    'models/pun_models/',        "加标点符号的模型文件夹路径")
+add_arg('max_sessions',     int,    100,    "同时进行流式识别的最大连接数量")
+add_arg('batch_window_ms',  int,    20,     "流式识别收集多个连接音频数据的时间窗口，单位毫秒，为0时不合并批次")
+add_arg('max_batch_size',   int,    32,     "流式识别一个批次最多合并的连接数量")
+add_arg('recognition_window_ms',  int,  50,    "短语音识别收集多个请求的时间窗口，单位毫秒，为0时不合并批次")
+add_arg('recognition_batch_size', int,  16,    "短语音识别一个批次最多合并的请求数量")
+add_arg('recognition_max_frames', int,  30000, "短语音识别一个批次补齐之后最多的特征帧数")
+add_arg('num_infer_threads',      int,  2,     "执行模型推理的线程数量")
+add_arg('num_decode_processes',   int,  0,     "集束搜索解码使用的进程数量，为0时在推理线程中解码")
+add_arg('max_queue_size',         int,  64,    "等待识别的最大请求数量，超过时直接拒绝新的请求")
+add_arg('infer_timeout',          float, 30,   "单个请求识别的超时时间，单位秒")
+add_arg('num_workers',            int,  0,     "识别工作进程的数量，工作进程共享主进程加载的模型，为0时在当前进程中识别")
+add_arg('worker_threads',         int,  1,     "每个识别工作进程PyTorch使用的线程数量")
+add_arg('pin_cpus',               bool, False, "是否把每个识别工作进程绑定到固定的CPU核心上")
+add_arg('decoding_chunk_size',      int, 16,   "流式识别默认的数据块大小，越大延迟越高，吞吐量越大")
+add_arg('num_decoding_left_chunks', int, -1,   "流式识别使用左边数据块的数量，小于0为使用全部历史数据，长时间的流式识别建议设置")
+add_arg('adaptive_chunk_sizes',     str, '',   "根据负载自动选择的流式识别数据块大小，从小到大用逗号分隔，如：8,16,32，为空时不自动调整")
 args = parser.parse_args()
 print_arguments(args=args)
+# 工作进程是在主进程加载完模型之后fork出来的，fork之前已经初始化的CUDA不能在子进程中使用
+if args.use_gpu and args.num_workers > 0:
+    raise Exception('多进程模式只支持CPU识别，使用GPU时num_workers必须为0')
+# OpenMP的线程池在fork之后不能使用，主进程在加载和预热模型之前只使用一个线程，工作进程再设置自己的线程数量
+if args.num_workers > 0:
+    torch.set_num_threads(1)
 
 with open(args.configs, 'r', encoding='utf-8') as f:
     args.configs = yaml.load(f.read(), Loader=yaml.FullLoader)
@@ -72,7 +101,312 @@ predictor = MASRPredictor(configs=args.configs,
                           model_path=args.model_path,
                           use_gpu=args.use_gpu,
                           use_pun=args.use_pun,
-                          pun_model_dir=args.pun_model_dir)
+                          pun_model_dir=args.pun_model_dir,
+                          decoding_chunk_size=args.decoding_chunk_size,
+                          num_decoding_left_chunks=args.num_decoding_left_chunks)
+
+
+# 后台执行的任务，保存引用避免任务在完成前被回收
+background_tasks = set()
+
+
+def run_background(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class InferenceExecutor:
+    def __init__(self, predictor, num_threads=2, num_decode_processes=0, max_queue_size=64, timeout=30):
+        """
+        推理执行器，模型推理在线程池中执行，集束搜索解码可以放到进程池中执行，避免阻塞事件循环
+        :param predictor: 语音识别预测器
+        :param num_threads: 执行推理的线程数量，TorchScript的算子执行时会释放GIL
+        :param num_decode_processes: 集束搜索解码的进程数量，为0时在推理线程中解码
+        :param max_queue_size: 同时等待识别的最大请求数量，超过时直接拒绝
+        :param timeout: 单个请求的超时时间，单位秒
+        """
+        self.predictor = predictor
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.num_requests = 0
+        self.thread_pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='infer')
+        self.decoder_pool = None
+        if num_decode_processes > 0 and predictor.configs.decoder == 'ctc_beam_search':
+            self.decoder_pool = DecoderPool(vocab_list=predictor._text_featurizer.vocab_list,
+                                            decoder_conf=predictor.configs.ctc_beam_search_decoder_conf,
+                                            num_processes=num_decode_processes)
+
+    # 提交识别任务，等待的请求数量超过限制时抛出ServerBusyError，任务执行完成之后才释放请求名额
+    def submit(self, coro):
+        if self.num_requests >= self.max_queue_size:
+            coro.close()
+            raise ServerBusyError(f'等待识别的请求数量已达上限：{self.max_queue_size}')
+        self.num_requests += 1
+        task = run_background(coro)
+        task.add_done_callback(self._release_request)
+        return task
+
+    def _release_request(self, task):
+        self.num_requests -= 1
+        # 超时之后没有人等待的任务，读取异常避免事件循环输出异常没有被获取的警告
+        if not task.cancelled(): task.exception()
+
+    # 等待识别任务完成，超时抛出asyncio.TimeoutError，超时不会取消任务，任务修改的会话状态要等它执行完才能再使用
+    async def wait(self, task):
+        return await asyncio.wait_for(asyncio.shield(task), timeout=self.timeout)
+
+    # 在线程池中执行阻塞的函数
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.thread_pool, functools.partial(func, *args, **kwargs))
+
+    # 识别多条音频的特征，模型推理在线程池中执行，解码在进程池或者线程池中执行
+    async def predict_features(self, features, use_pun=False, is_itn=False):
+        if self.decoder_pool is None:
+            return await self.run(self.predictor.predict_features, features, use_pun=use_pun, is_itn=is_itn)
+        output_datas = await self.run(self.predictor.predictor.predict_batch, features)
+        decoded = await asyncio.gather(*[asyncio.wrap_future(self.decoder_pool.submit(output_data))
+                                         for output_data in output_datas])
+        results = []
+        for score, text in decoded:
+            if use_pun or is_itn:
+                text = await self.run(self.predictor.postprocess, text, use_pun=use_pun, is_itn=is_itn)
+            results.append({'text': text, 'score': score})
+        return results
+
+
+class StreamSessionManager:
+    def __init__(self, predictor, max_sessions=100, worker_pool=None):
+        """
+        流式识别会话管理器，每个WebSocket连接使用一个独立的会话，所有会话共用同一个预测器
+        :param predictor: 语音识别预测器
+        :param max_sessions: 同时存在的最大会话数量
+        :param worker_pool: 多进程模式的识别工作池，不为None时会话保存在工作进程中
+        """
+        self.predictor = predictor
+        self.max_sessions = max_sessions
+        self.worker_pool = worker_pool
+        self.sessions = {}
+
+    # 创建会话，超过最大数量时返回None，多进程模式下会话保存在工作进程中，返回的会话为None
+    def create(self):
+        if len(self.sessions) >= self.max_sessions:
+            return None, None
+        if self.worker_pool is not None:
+            session_id, session = self.worker_pool.create_session(), None
+        else:
+            session_id, session = uuid.uuid4().hex, self.predictor.create_stream_session()
+        self.sessions[session_id] = session
+        return session_id, session
+
+    # 关闭会话，释放会话占用的缓存
+    def close(self, session_id):
+        if session_id not in self.sessions: return
+        session = self.sessions.pop(session_id)
+        if self.worker_pool is not None:
+            self.worker_pool.close_session(session_id)
+        else:
+            self.predictor.reset_stream(session=session)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class AdaptiveChunkScheduler:
+    def __init__(self, predictor, chunk_sizes, session_manager, executor):
+        """
+        根据服务的负载选择流式识别的数据块大小，负载低时使用小的数据块降低延迟，负载高时使用大的数据块提高吞吐量
+        :param predictor: 语音识别预测器，用于检查数据块大小是否可用
+        :param chunk_sizes: 可选的数据块大小，从小到大排列
+        :param session_manager: 流式识别会话管理器，会话数量占最大会话数量的比例作为负载
+        :param executor: 推理执行器，等待识别的请求数量占最大数量的比例作为负载
+        """
+        for chunk_size in chunk_sizes:
+            predictor._check_chunk_size(chunk_size)
+        self.chunk_sizes = sorted(chunk_sizes)
+        self.session_manager = session_manager
+        self.executor = executor
+
+    # 当前负载，范围是0到1
+    @property
+    def load(self):
+        session_load = len(self.session_manager) / max(self.session_manager.max_sessions, 1)
+        queue_load = self.executor.num_requests / max(self.executor.max_queue_size, 1)
+        return min(max(session_load, queue_load), 1.0)
+
+    # 把负载平均分成len(chunk_sizes)段，每一段对应一个数据块大小
+    def select(self):
+        index = min(int(self.load * len(self.chunk_sizes)), len(self.chunk_sizes) - 1)
+        return self.chunk_sizes[index]
+
+
+class StreamBatcher:
+    def __init__(self, predictor, executor, window_ms=20, max_batch_size=32):
+        """
+        流式识别批处理器，收集一个时间窗口内多个连接发来的音频数据，合并成一个批次执行识别
+        :param predictor: 语音识别预测器
+        :param executor: 执行识别的推理执行器
+        :param window_ms: 收集数据的时间窗口，单位毫秒
+        :param max_batch_size: 一个批次最多合并的连接数量，达到该数量时立即执行识别
+        """
+        self.predictor = predictor
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.timer = None
+
+    # 提交一个会话的音频数据，等待所在批次识别完成后返回该会话的识别结果
+    async def submit(self, audio_data, is_end, session):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((audio_data, is_end, session, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    # 把当前收集到的全部数据交给推理执行器
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if len(pending) == 0: return
+        run_background(self._run_batch(pending))
+
+    async def _run_batch(self, pending):
+        try:
+            results = await self.executor.run(self.predictor.predict_stream_batch,
+                                              audio_datas=[p[0] for p in pending],
+                                              is_ends=[p[1] for p in pending],
+                                              sessions=[p[2] for p in pending],
+                                              use_pun=args.use_pun, is_itn=args.is_itn)
+        except Exception as e:
+            for p in pending:
+                if not p[3].done(): p[3].set_exception(e)
+            return
+        for p, result in zip(pending, results):
+            if not p[3].done(): p[3].set_result(result)
+
+
+class RecognitionBatcher:
+    def __init__(self, executor, window_ms=50, max_batch_size=16, max_frames=30000):
+        """
+        短语音识别批处理器，收集一个时间窗口内到达的请求，按特征长度分组补齐后合并成批次执行识别
+        :param executor: 执行识别的推理执行器
+        :param window_ms: 收集请求的时间窗口，单位毫秒
+        :param max_batch_size: 一个批次最多合并的请求数量
+        :param max_frames: 一个批次补齐之后最多的特征帧数，即批次大小乘以批次中最长的特征长度
+        """
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_frames = max_frames
+        self.pending = []
+        self.pending_frames = 0
+        self.timer = None
+
+    # 提交一条音频的特征，等待所在批次识别完成后返回该音频的识别结果
+    async def submit(self, feature):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((feature, future))
+        self.pending_frames += feature.shape[0]
+        if len(self.pending) >= self.max_batch_size or self.pending_frames >= self.max_frames:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    # 把收集到的请求按特征长度排序后切分成多个批次，并执行识别
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending, self.pending_frames = self.pending, [], 0
+        pending.sort(key=lambda p: p[0].shape[0])
+        batch = []
+        for p in pending:
+            # 加入当前请求之后补齐的帧数超过限制，先执行已经收集的批次
+            if len(batch) > 0 and (len(batch) >= self.max_batch_size or
+                                   (len(batch) + 1) * p[0].shape[0] > self.max_frames):
+                run_background(self._run_batch(batch))
+                batch = []
+            batch.append(p)
+        if len(batch) > 0:
+            run_background(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        try:
+            results = await self.executor.predict_features(features=[p[0] for p in batch],
+                                                           use_pun=args.use_pun, is_itn=args.is_itn)
+        except Exception as e:
+            for p in batch:
+                if not p[1].done(): p[1].set_exception(e)
+            return
+        for p, result in zip(batch, results):
+            if not p[1].done(): p[1].set_result(result)
+
+
+# 多进程模式，在加载完模型之后fork出工作进程，工作进程共享主进程的模型、语言模型和VAD
+worker_pool = None
+if args.num_workers > 0:
+    predictor.init_vad()
+    worker_pool = PredictorWorkerPool(predictor=predictor,
+                                      num_workers=args.num_workers,
+                                      num_threads=args.worker_threads,
+                                      pin_cpus=args.pin_cpus)
+inference_executor = InferenceExecutor(predictor=predictor,
+                                       num_threads=args.num_infer_threads,
+                                       num_decode_processes=args.num_decode_processes,
+                                       max_queue_size=args.max_queue_size,
+                                       timeout=args.infer_timeout)
+session_manager = StreamSessionManager(predictor=predictor, max_sessions=args.max_sessions, worker_pool=worker_pool)
+stream_batcher = StreamBatcher(predictor=predictor, executor=inference_executor,
+                               window_ms=args.batch_window_ms, max_batch_size=args.max_batch_size)
+chunk_scheduler = None
+if args.adaptive_chunk_sizes:
+    chunk_scheduler = AdaptiveChunkScheduler(predictor=predictor,
+                                             chunk_sizes=[int(c) for c in args.adaptive_chunk_sizes.split(',')],
+                                             session_manager=session_manager, executor=inference_executor)
+recognition_batcher = RecognitionBatcher(executor=inference_executor, window_ms=args.recognition_window_ms,
+                                         max_batch_size=args.recognition_batch_size,
+                                         max_frames=args.recognition_max_frames)
+
+
+# 识别一个音频文件，多进程模式下交给负载最小的工作进程，否则提取特征后和其他请求合并成批次识别
+async def recognize(file_path):
+    if worker_pool is not None:
+        return await worker_pool.predict(file_path, use_pun=args.use_pun, is_itn=args.is_itn)
+    if args.recognition_window_ms > 0:
+        feature = await inference_executor.run(predictor.featurize, audio_data=file_path)
+        return await recognition_batcher.submit(feature)
+    # TODO: 读取音频看时长
+    func = predictor.predict if True else predictor.predict_long
+    return await inference_executor.run(func, audio_data=file_path, use_pun=args.use_pun, is_itn=args.is_itn)
+
+
+# 识别一段流式音频，多进程模式下在会话所在的工作进程中识别
+async def recognize_stream(session_id, session, data, is_end):
+    # 根据当前负载调整这个会话接下来的数据块大小
+    chunk_size = chunk_scheduler.select() if chunk_scheduler is not None else None
+    if worker_pool is not None:
+        return await worker_pool.predict_stream(session_id, data, is_end=is_end, use_pun=args.use_pun,
+                                                is_itn=args.is_itn, decoding_chunk_size=chunk_size)
+    if chunk_size is not None:
+        predictor.set_stream_chunk_size(chunk_size, session=session)
+    if args.batch_window_ms > 0:
+        return await stream_batcher.submit(audio_data=data, is_end=is_end, session=session)
+    return await inference_executor.run(predictor.predict_stream, audio_data=data, use_pun=args.use_pun,
+                                        is_itn=args.is_itn, is_end=is_end, session=session)
 
 
 # 语音识别接口
@@ -89,14 +423,18 @@ async def recognition(audio: UploadFile = File(..., description="音频文件"))
     try:
         start = time.time()
         # 执行识别
-        # TODO: 读取音频看时长
-        func = predictor.predict if True else predictor.predict_long
-        result = func(audio_data=file_path, use_pun=args.use_pun, is_itn=args.is_itn)
+        result = await inference_executor.wait(inference_executor.submit(recognize(file_path)))
         score, text = result['score'], format_result(result['text'])
         end = time.time()
         print("结　果：%s\n可靠度：%f\n耗　时：%d ms" % (text, score, round((end - start) * 1000)))
         result = {"code": 0, "msg": "success", "result": text, "score": round(score, 2)}
         return result
+    except ServerBusyError as e:
+        print(f'[{datetime.now()}] 语音识别失败，错误信息：{e}', file=sys.stderr)
+        return {"error": 3, "msg": "服务繁忙，请稍后再试！"}
+    except asyncio.TimeoutError:
+        print(f'[{datetime.now()}] 语音识别超时，超时时间：{args.infer_timeout}秒', file=sys.stderr)
+        return {"error": 4, "msg": "语音识别超时！"}
     except Exception as e:
         print(f'[{datetime.now()}] 语音识别失败，错误信息：{e}', file=sys.stderr)
         return {"error": 1, "msg": "音频读取失败！"}
@@ -111,9 +449,13 @@ async def index(request: Request):
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     logger.info(f'有WebSocket连接建立')
-    if not predictor.running:
+    session_id, session = session_manager.create()
+    if session_id is not None:
+        logger.info(f'创建流式识别会话：{session_id}，当前会话数量：{len(session_manager)}')
         frames = []
         score, text = 0, ""
+        # 这个会话正在执行的识别任务，同一个会话同时只能有一个识别任务
+        task = None
         while True:
             try:
                 data = await websocket.receive_bytes()
@@ -124,9 +466,21 @@ async def websocket_endpoint(websocket: WebSocket):
                 if b'end' == data[-3:]:
                     is_end = True
                     data = data[:-3]
-                # 开始预测
-                result = predictor.predict_stream(audio_data=data, use_pun=args.use_pun, is_itn=args.is_itn,
-                                                  is_end=is_end)
+                # 开始预测，服务繁忙或者超时的时候结束这次识别，跳过数据块继续识别会得到错误的结果
+                try:
+                    task = inference_executor.submit(recognize_stream(session_id, session, data, is_end))
+                    result = await inference_executor.wait(task)
+                except (ServerBusyError, asyncio.TimeoutError) as e:
+                    if isinstance(e, ServerBusyError):
+                        logger.warning(f'识别请求被拒绝：{e}')
+                        send_data = {"code": 3, "msg": "server busy!"}
+                    else:
+                        logger.error(f'流式识别超时，超时时间：{args.infer_timeout}秒')
+                        send_data = {"code": 4, "msg": "recognition timeout!"}
+                    with contextlib.suppress(Exception):
+                        await websocket.send_json(send_data)
+                        await websocket.close()
+                    break
                 if result is not None:
                     score, text = result['score'], format_result(result['text'])
                 send_data = {"code": 0, "result": text, "score": round(score, 2)}
@@ -143,9 +497,10 @@ async def websocket_endpoint(websocket: WebSocket):
                     await websocket.send_json({"code": 2, "msg": "recognition fail!"})
                 except:
                     break
-        # 重置流式识别
-        predictor.reset_stream()
-        predictor.running = False
+        # 等待还在执行的识别任务完成之后再关闭流式识别会话
+        if task is not None and not task.done():
+            await asyncio.wait([task])
+        session_manager.close(session_id)
         # 保存录音
         save_dir = os.path.join(args.save_path, datetime.now().strftime('%Y-%m'))
         os.makedirs(save_dir, exist_ok=True)
@@ -158,7 +513,7 @@ async def websocket_endpoint(websocket: WebSocket):
         wf.writeframes(audio_bytes)
         wf.close()
     else:
-        logger.error(f'语音识别失败，预测器不足')
+        logger.error(f'语音识别失败，流式识别会话数量已达上限：{args.max_sessions}')
         await websocket.send_json({"code": 1, "msg": "recognition fail, no resource!"})
         await websocket.close()
 
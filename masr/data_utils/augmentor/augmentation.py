@@ -93,6 +93,11 @@ class AugmentationPipeline(object):
         self._augmentors, self._rates = self._parse_pipeline_from(augmentation_config, aug_type='audio')
         self._spec_augmentors, self._spec_rates = self._parse_pipeline_from(augmentation_config, aug_type='feature')
 
+    @property
+    def is_empty(self):
+        """没有任何音频增强和特征增强时为True"""
+        return len(self._augmentors) == 0 and len(self._spec_augmentors) == 0
+
     def transform_audio(self, audio_segment):
         """Run the pre-processing pipeline for data augmentation.
 
@@ -1,7 +1,13 @@
+import hashlib
 import json
 import mmap
-
+import os
 import struct
+from array import array
+
+import numpy as np
+
+from masr.data_utils.featurizer.text_featurizer import TextFeaturizer
 
 
 class DatasetWriter(object):
@@ -36,6 +42,7 @@ class DatasetWriter(object):
 class DatasetReader(object):
     def __init__(self, data_path, min_duration=0, max_duration=20):
         self.keys = []
+        self.durations = []
         self.offset_dict = {}
         self.fp = open(data_path + '.data', 'rb')
         self.m = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
@@ -50,6 +57,7 @@ class DatasetReader(object):
             if max_duration != -1 and data["duration"] > max_duration:
                 continue
             self.keys.append(key)
+            self.durations.append(data["duration"])
             self.offset_dict[key] = (int(val_pos), int(val_len))
 
     # 获取一行列表数据
@@ -62,6 +70,227 @@ class DatasetReader(object):
         data = str(data, encoding="utf-8")
         return json.loads(data)
 
+    # 旧版的数据列表没有保存标签索引
+    def get_tokens(self, key):
+        return None
+
+    # 获取keys
+    def get_keys(self):
+        return self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class TextDatasetReader(object):
+    def __init__(self, data_path, min_duration=0, max_duration=20, text_featurizer=None, cache_dir=None):
+        """
+        读取文本格式的数据列表，接口和DatasetReader相同。整个数据列表保存为一个UTF-8字节数组，
+        每条数据只保存起始位置、结束位置和音频长度，读取时才解析为字典。数据列表中没有大量的Python对象，
+        DataLoader的子进程读取数据时不会修改这些对象的引用计数，不会把整个数据列表逐渐复制到每个子进程中
+        :param data_path: 文本数据列表的路径
+        :param text_featurizer: 文本特征器，不为None时在加载数据列表时一次转换全部标签索引
+        :param cache_dir: 标签索引的缓存路径，按数据列表和词汇表的MD5保存，为None时不使用缓存
+        """
+        with open(data_path, 'rb') as f:
+            content = f.read()
+        self.data = np.frombuffer(content, dtype=np.uint8)
+        self.tokens, self.token_offsets = None, None
+        cache_path = None
+        if text_featurizer is not None and cache_dir is not None:
+            key = hashlib.md5(json.dumps([hashlib.md5(content).hexdigest(), text_featurizer.vocab_md5,
+                                          min_duration, max_duration]).encode('utf-8')).hexdigest()
+            cache_path = os.path.join(cache_dir, f'{key}.npz')
+            if os.path.exists(cache_path):
+                cache = np.load(cache_path)
+                self.starts, self.ends, self.durations = cache['starts'], cache['ends'], cache['durations']
+                self.tokens, self.token_offsets = cache['tokens'], cache['token_offsets']
+                self.keys = np.arange(len(self.starts))
+                return
+        starts, ends, durations, texts = array('q'), array('q'), array('f'), []
+        pos = 0
+        for line in content.split(b'\n'):
+            start, pos = pos, pos + len(line) + 1
+            if len(line.strip()) == 0:
+                continue
+            line_data = json.loads(line)
+            duration = line_data["duration"]
+            # 跳过超出长度限制的音频
+            if duration < min_duration:
+                continue
+            if max_duration != -1 and duration > max_duration:
+                continue
+            starts.append(start)
+            ends.append(start + len(line))
+            durations.append(duration)
+            if text_featurizer is not None:
+                texts.append(line_data["text"])
+        self.starts = np.frombuffer(starts, dtype=np.int64)
+        self.ends = np.frombuffer(ends, dtype=np.int64)
+        self.durations = np.frombuffer(durations, dtype=np.float32)
+        self.keys = np.arange(len(self.starts))
+        if text_featurizer is not None:
+            self.tokens, self.token_offsets = text_featurizer.featurize_many(texts)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 先写入临时文件再重命名，写入中断时不会留下不完整的缓存
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, starts=self.starts, ends=self.ends, durations=self.durations,
+                         tokens=self.tokens, token_offsets=self.token_offsets)
+            os.replace(tmp_path, cache_path)
+
+    # 获取一行列表数据
+    def get_data(self, key):
+        return json.loads(bytes(self.data[self.starts[key]:self.ends[key]]))
+
+    # 获取加载时转换好的标签索引，没有传入文本特征器时返回None
+    def get_tokens(self, key):
+        if self.tokens is None:
+            return None
+        return self.tokens[self.token_offsets[key]:self.token_offsets[key + 1]]
+
+    # 获取keys
+    def get_keys(self):
+        return self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+# 第二版二进制数据列表每条数据的数值列，没有的值start_time和end_time为nan，start_frame和end_frame为-1
+COLUMNS_DTYPE = np.dtype([('duration', '<f8'),
+                          ('start_time', '<f8'),
+                          ('end_time', '<f8'),
+                          ('start_frame', '<i8'),
+                          ('end_frame', '<i8'),
+                          ('path_id', '<i4')])
+
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _save_string_table(save_dir, name, strings):
+    # 字符串表保存为连续的UTF-8字节和每个字符串的起始位置
+    data = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=offsets[1:])
+    np.save(os.path.join(save_dir, f'{name}_bytes.npy'), np.frombuffer(b''.join(data), dtype=np.uint8))
+    np.save(os.path.join(save_dir, f'{name}_offsets.npy'), offsets)
+
+
+class ColumnarDatasetWriter(object):
+    def __init__(self, prefix, vocab_filepath=None):
+        """
+        第二版二进制数据列表，数值保存为定长的列，音频路径保存为字符串表，标签保存为已经转换好的int32索引，
+        读取时全部以内存映射的方式打开，不需要为每条数据创建Python对象
+        :param prefix: 数据列表的路径，生成的文件保存在prefix.v2文件夹
+        :param vocab_filepath: 词汇表的路径，不为None时保存转换好的标签索引
+        """
+        self.save_dir = prefix + '.v2'
+        self.vocab_filepath = vocab_filepath
+        self.text_featurizer = TextFeaturizer(vocab_filepath) if vocab_filepath is not None else None
+        self.columns = []
+        self.path_ids = {}
+        self.texts = []
+        self.manifest_md5 = hashlib.md5()
+
+    def add_data(self, data):
+        """
+        添加一条数据
+        :param data: 文本数据列表中的一行，JSON字符串
+        """
+        self.manifest_md5.update(data.encode('utf-8'))
+        line = json.loads(data)
+        path_id = self.path_ids.setdefault(line['audio_filepath'], len(self.path_ids))
+        self.columns.append((line['duration'], line.get('start_time', np.nan), line.get('end_time', np.nan),
+                             line.get('start_frame', -1), line.get('end_frame', -1), path_id))
+        self.texts.append(line['text'])
+
+    def close(self):
+        os.makedirs(self.save_dir, exist_ok=True)
+        np.save(os.path.join(self.save_dir, 'columns.npy'), np.array(self.columns, dtype=COLUMNS_DTYPE))
+        _save_string_table(self.save_dir, 'paths', list(self.path_ids.keys()))
+        _save_string_table(self.save_dir, 'texts', [json.dumps(text, ensure_ascii=False) for text in self.texts])
+        # 一次转换全部标签，没有词汇表时每条数据的标签索引都为空
+        if self.text_featurizer is not None:
+            tokens, token_offsets = self.text_featurizer.featurize_many(self.texts)
+        else:
+            tokens, token_offsets = np.zeros(0, dtype=np.int32), np.zeros(len(self.texts) + 1, dtype=np.int64)
+        np.save(os.path.join(self.save_dir, 'tokens.npy'), tokens)
+        np.save(os.path.join(self.save_dir, 'token_offsets.npy'), token_offsets)
+        # 最后写入meta.json，有这个文件才是完整的数据列表
+        meta = {'version': 2,
+                'num_data': len(self.columns),
+                'manifest_md5': self.manifest_md5.hexdigest(),
+                'vocab_md5': _file_md5(self.vocab_filepath) if self.vocab_filepath is not None else None}
+        with open(os.path.join(self.save_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+
+class ColumnarDatasetReader(object):
+    def __init__(self, data_path, min_duration=0, max_duration=20, vocab_filepath=None):
+        """
+        读取第二版二进制数据列表，接口和DatasetReader相同
+        :param data_path: 数据列表的路径，读取prefix.v2文件夹
+        :param vocab_filepath: 训练使用的词汇表路径，和生成数据列表时的词汇表相同时直接使用保存的标签索引
+        """
+        self.save_dir = data_path + '.v2'
+        with open(os.path.join(self.save_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.columns = self._load('columns')
+        self.path_bytes, self.path_offsets = self._load('paths_bytes'), self._load('paths_offsets')
+        self.text_bytes, self.text_offsets = self._load('texts_bytes'), self._load('texts_offsets')
+        self.tokens, self.token_offsets = self._load('tokens'), self._load('token_offsets')
+        # 词汇表有变化时保存的标签索引不能使用，需要重新转换文本
+        self.has_tokens = self.meta['vocab_md5'] is not None and vocab_filepath is not None \
+                          and _file_md5(vocab_filepath) == self.meta['vocab_md5']
+        # 跳过超出长度限制的音频，只使用NumPy数组，不为每条数据创建Python对象
+        durations = self.columns['duration']
+        keep = durations >= min_duration
+        if max_duration != -1:
+            keep &= durations <= max_duration
+        self.keys = np.flatnonzero(keep)
+        self.durations = np.asarray(durations[self.keys])
+
+    def _load(self, name):
+        path = os.path.join(self.save_dir, f'{name}.npy')
+        # 空数组不能创建内存映射
+        if os.path.getsize(path) <= 128:
+            return np.load(path)
+        return np.load(path, mmap_mode='r')
+
+    @staticmethod
+    def exists(data_path):
+        return os.path.exists(os.path.join(data_path + '.v2', 'meta.json'))
+
+    @staticmethod
+    def _get_string(data, offsets, idx):
+        return bytes(data[offsets[idx]:offsets[idx + 1]]).decode('utf-8')
+
+    # 获取一行列表数据
+    def get_data(self, key):
+        row = self.columns[key]
+        data = {'audio_filepath': self._get_string(self.path_bytes, self.path_offsets, row['path_id']),
+                'duration': float(row['duration']),
+                'text': json.loads(self._get_string(self.text_bytes, self.text_offsets, key))}
+        if not np.isnan(row['start_time']):
+            data['start_time'], data['end_time'] = float(row['start_time']), float(row['end_time'])
+        if row['start_frame'] != -1:
+            data['start_frame'], data['end_frame'] = int(row['start_frame']), int(row['end_frame'])
+        return data
+
+    # 获取保存的标签索引，词汇表有变化时返回None
+    def get_tokens(self, key):
+        if not self.has_tokens:
+            return None
+        return np.array(self.tokens[self.token_offsets[key]:self.token_offsets[key + 1]], dtype=np.int32)
+
     # 获取keys
     def get_keys(self):
         return self.keys
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from masr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def feature_cache_key(data_manifest, manifest_type, preprocess_configs, vocab_filepath, min_duration, max_duration):
+    """
+    根据数据列表的内容和预处理参数计算缓存的key，数据列表、预处理参数或者词汇表有变化时key也会变化
+    :return: key字符串
+    """
+    md5 = hashlib.md5()
+    # 二进制数据列表只计算索引文件，数据文件可能很大
+    if manifest_type == 'txt':
+        manifest_path = data_manifest
+    elif os.path.exists(os.path.join(data_manifest + '.v2', 'meta.json')):
+        manifest_path = os.path.join(data_manifest + '.v2', 'meta.json')
+    else:
+        manifest_path = data_manifest + '.header'
+    for path in [manifest_path, vocab_filepath]:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+    params = {'manifest_type': manifest_type, 'preprocess_configs': dict(preprocess_configs),
+              'min_duration': min_duration, 'max_duration': max_duration}
+    md5.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return md5.hexdigest()
+
+
+class FeatureCacheWriter:
+    def __init__(self, cache_dir, num_data, feature_dim):
+        """
+        把数据集的音频特征和标签写入磁盘，写入之后可以使用FeatureCache以内存映射的方式读取
+        :param cache_dir: 缓存的文件夹路径
+        :param num_data: 数据的数量
+        :param feature_dim: 音频特征的大小
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        # 先删除旧的索引文件，写入中断时不会把不完整的缓存当作可用的缓存
+        if os.path.exists(os.path.join(cache_dir, 'index.npz')):
+            os.remove(os.path.join(cache_dir, 'index.npz'))
+        self.cache_dir = cache_dir
+        self.feature_dim = feature_dim
+        self.feature_offsets = np.zeros(num_data, dtype=np.int64)
+        self.feature_lens = np.zeros(num_data, dtype=np.int64)
+        self.label_offsets = np.zeros(num_data, dtype=np.int64)
+        self.label_lens = np.zeros(num_data, dtype=np.int64)
+        self.num_frames, self.num_tokens = 0, 0
+        self._features_file = open(os.path.join(cache_dir, 'features.bin'), 'wb')
+        self._labels_file = open(os.path.join(cache_dir, 'labels.bin'), 'wb')
+
+    def add(self, idx, feature, transcript):
+        """
+        写入一条数据，可以按任意顺序写入，例如按长度排序之后写入，读取同一个批次时读取的是连续的内存
+        :param idx: 数据在数据集中的索引
+        :param feature: 音频特征，形状为(T, feature_dim)
+        :param transcript: 标签的索引
+        """
+        np.ascontiguousarray(feature, dtype=np.float32).tofile(self._features_file)
+        np.ascontiguousarray(transcript, dtype=np.int32).tofile(self._labels_file)
+        self.feature_offsets[idx], self.feature_lens[idx] = self.num_frames, len(feature)
+        self.label_offsets[idx], self.label_lens[idx] = self.num_tokens, len(transcript)
+        self.num_frames += len(feature)
+        self.num_tokens += len(transcript)
+
+    def close(self):
+        """写入索引文件，写入索引文件之后缓存才可以使用"""
+        self._features_file.close()
+        self._labels_file.close()
+        np.savez(os.path.join(self.cache_dir, 'index.npz'),
+                 feature_dim=self.feature_dim,
+                 feature_offsets=self.feature_offsets,
+                 feature_lens=self.feature_lens,
+                 label_offsets=self.label_offsets,
+                 label_lens=self.label_lens)
+        logger.info(f'已缓存{len(self.feature_lens)}条数据的特征，共{self.num_frames}帧：{self.cache_dir}')
+
+
+class FeatureCache:
+    def __init__(self, cache_dir):
+        """
+        以内存映射的方式读取FeatureCacheWriter保存的音频特征和标签，读取过的数据会留在系统的页缓存中
+        :param cache_dir: 缓存的文件夹路径
+        """
+        index = np.load(os.path.join(cache_dir, 'index.npz'))
+        self.feature_dim = int(index['feature_dim'])
+        self.feature_offsets = index['feature_offsets']
+        self.feature_lens = index['feature_lens']
+        self.label_offsets = index['label_offsets']
+        self.label_lens = index['label_lens']
+        num_frames = int(self.feature_lens.sum())
+        num_tokens = int(self.label_lens.sum())
+        self._features = self._memmap(os.path.join(cache_dir, 'features.bin'), np.float32,
+                                      (num_frames, self.feature_dim))
+        self._labels = self._memmap(os.path.join(cache_dir, 'labels.bin'), np.int32, (num_tokens,))
+
+    @staticmethod
+    def _memmap(path, dtype, shape):
+        # 没有任何数据时不能创建内存映射
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+    @staticmethod
+    def exists(cache_dir):
+        return os.path.exists(os.path.join(cache_dir, 'index.npz'))
+
+    def __len__(self):
+        return len(self.feature_lens)
+
+    def get(self, idx):
+        """
+        获取一条数据
+        :param idx: 数据在数据集中的索引
+        :return: 音频特征和标签的索引
+        """
+        start = self.feature_offsets[idx]
+        feature = np.array(self._features[start:start + self.feature_lens[idx]])
+        start = self.label_offsets[idx]
+        transcript = np.array(self._labels[start:start + self.label_lens[idx]])
+        return feature, transcript
@@ -42,32 +42,64 @@ class AudioFeaturizer(object):
         :return: Spectrogram audio feature in 2darray.
         :rtype: ndarray
         """
+        samples = self._preprocess(audio_segment)
+        return self._compute(samples=samples, sample_rate=audio_segment.sample_rate)
+
+    def _preprocess(self, audio_segment):
+        """对音频重采样和音量归一化，并转换为计算特征需要的数据类型"""
         # upsampling or downsampling
         if audio_segment.sample_rate != self._target_sample_rate:
             audio_segment.resample(self._target_sample_rate)
         # decibel normalization
         if self._use_dB_normalization:
             audio_segment.normalize(target_db=self._target_dB)
+        if self._feature_method == 'linear':
+            return audio_segment.samples
+        return audio_segment.to('int16')
+
+    def _compute(self, samples, sample_rate):
+        """从预处理后的音频数据中提取特征"""
         # extract spectrogram
         if self._feature_method == 'linear':
-            samples = audio_segment.samples
-            return self._compute_linear(samples=samples, sample_rate=audio_segment.sample_rate)
+            return self._compute_linear(samples=samples, sample_rate=sample_rate)
         elif self._feature_method == 'mfcc':
-            samples = audio_segment.to('int16')
             return self._compute_mfcc(samples=samples,
-                                      sample_rate=audio_segment.sample_rate,
+                                      sample_rate=sample_rate,
                                       n_mels=self._n_mels,
                                       n_mfcc=self._n_mfcc,
                                       train=self._train)
         elif self._feature_method == 'fbank':
-            samples = audio_segment.to('int16')
             return self._compute_fbank(samples=samples,
-                                       sample_rate=audio_segment.sample_rate,
+                                       sample_rate=sample_rate,
                                        n_mels=self._n_mels,
                                        train=self._train)
         else:
             raise Exception('没有{}预处理方法'.format(self._feature_method))
 
+    @property
+    def frame_geometry(self):
+        """返回每帧的采样点数和帧移的采样点数
+
+        :return: 窗口大小和帧移大小
+        :rtype: tuple
+        """
+        frame_length = 20 if self._feature_method == 'linear' else 25
+        window_size = int(0.001 * self._target_sample_rate * frame_length)
+        stride_size = int(0.001 * self._target_sample_rate * 10)
+        return window_size, stride_size
+
+    def num_frames(self, durations):
+        """根据音频长度估计特征的帧数，不需要读取音频
+
+        :param durations: 音频长度，单位为秒
+        :type durations: ndarray
+        :return: 每条音频特征的帧数
+        :rtype: ndarray
+        """
+        window_size, stride_size = self.frame_geometry
+        num_samples = np.asarray(durations, dtype=np.float64) * self._target_sample_rate
+        return np.maximum((num_samples - window_size) // stride_size + 1, 0).astype(np.int64)
+
     # 线性谱图
     @staticmethod
     def _compute_linear(samples, sample_rate, frame_shift=10.0, frame_length=20.0, eps=1e-14):
@@ -152,3 +184,55 @@ class AudioFeaturizer(object):
             return self._n_mels
         else:
             raise Exception('没有{}预处理方法'.format(self._feature_method))
+
+
+class StreamingAudioFeaturizer(object):
+    """流式音频特征器
+
+    每一帧的特征只和这一帧的音频数据有关，所以只需要保存不足一帧的剩余音频，
+    新的音频数据写入预先分配的缓存中，每次只计算新增加的帧，拼接起来和一次性提取整条音频的特征完全相同。
+    音量归一化和重采样只作用于新输入的音频数据。
+
+    :param audio_featurizer: 音频特征器，使用相同的预处理参数
+    :type audio_featurizer: AudioFeaturizer
+    :param max_chunk_samples: 预先分配的缓存可以容纳的单次输入采样点数，超过时自动扩大缓存
+    :type max_chunk_samples: int
+    """
+
+    def __init__(self, audio_featurizer, max_chunk_samples=16000):
+        self._audio_featurizer = audio_featurizer
+        self._window_size, self._stride_size = audio_featurizer.frame_geometry
+        self._buffer = np.zeros(self._window_size + max_chunk_samples, dtype=np.float32)
+        self._num_samples = 0
+
+    def featurize(self, audio_segment):
+        """输入新的音频数据，返回新增加的帧的特征
+
+        :param audio_segment: 新输入的音频数据
+        :type audio_segment: AudioSegment
+        :return: 新增加的帧的特征，形状为(T, D)，T可能为0
+        :rtype: ndarray
+        """
+        sample_rate = self._audio_featurizer._target_sample_rate
+        samples = self._audio_featurizer._preprocess(audio_segment)
+        num_samples = self._num_samples + len(samples)
+        if num_samples > len(self._buffer):
+            buffer = np.zeros(num_samples + self._window_size, dtype=np.float32)
+            buffer[:self._num_samples] = self._buffer[:self._num_samples]
+            self._buffer = buffer
+        self._buffer[self._num_samples:num_samples] = samples
+        self._num_samples = num_samples
+        if num_samples < self._window_size:
+            return np.zeros((0, self._audio_featurizer.feature_dim), dtype=np.float32)
+        # 只计算完整的帧，剩余的音频留到下一次
+        num_frames = 1 + (num_samples - self._window_size) // self._stride_size
+        used_samples = (num_frames - 1) * self._stride_size + self._window_size
+        feature = self._audio_featurizer._compute(samples=self._buffer[:used_samples], sample_rate=sample_rate)
+        consumed_samples = num_frames * self._stride_size
+        self._num_samples = num_samples - consumed_samples
+        self._buffer[:self._num_samples] = self._buffer[consumed_samples:num_samples]
+        return np.asarray(feature, dtype=np.float32)
+
+    def reset(self):
+        """清空剩余的音频数据"""
+        self._num_samples = 0
@@ -1,3 +1,8 @@
+import hashlib
+
+import numpy as np
+
+
 class TextFeaturizer(object):
     """文本特征器，用于处理或从文本中提取特征。支持字符级的令牌化和转换为令牌索引列表
 
@@ -7,7 +12,11 @@ class TextFeaturizer(object):
 
     def __init__(self, vocab_filepath):
         self.unk = "<unk>"
-        self._vocab_dict, self._vocab_list = self._load_vocabulary_from_file(vocab_filepath)
+        self._vocab_dict, self._vocab_list, self.vocab_md5 = self._load_vocabulary_from_file(vocab_filepath)
+        # 不在词汇表中的令牌使用<unk>的索引，词汇表中没有<unk>时为-1
+        self._unk_id = self._vocab_dict.get(self.unk, -1)
+        self._space_id = self._vocab_dict.get('<space>', self._unk_id)
+        self._char_table = self._create_char_table()
 
     def featurize(self, text):
         """将文本字符串转换为字符级的令牌索引列表
@@ -18,15 +27,39 @@ class TextFeaturizer(object):
         :rtype: list
         """
         tokens = self._char_tokenize(text)
-        token_indices = []
-        for token in tokens:
-            if token == ' ': token = '<space>'
-            # 跳过词汇表不存在的字符
-            if token not in self._vocab_list:
-                token = self.unk
-            token_indices.append(self._vocab_dict[token])
+        token_indices = [self._space_id if token == ' ' else self._vocab_dict.get(token, self._unk_id)
+                         for token in tokens]
+        if self._unk_id == -1 and -1 in token_indices:
+            raise Exception(f'词汇表中没有{self.unk}，无法转换不在词汇表中的令牌')
         return token_indices
 
+    def featurize_many(self, texts):
+        """批量将多条文本转换为令牌索引，全部是字符串时使用NumPy查表一次完成转换
+
+        :param texts: 文本列表，每条文本为字符串或者令牌列表
+        :type texts: list
+        :return: 全部文本连接在一起的令牌索引，形状为(N,)的int32数组，和每条文本在其中的起始位置，形状为(len(texts)+1,)
+        :rtype: tuple
+        """
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts)), out=offsets[1:])
+        token_indices = None
+        if all(isinstance(t, str) for t in texts):
+            try:
+                codes = np.frombuffer(''.join(texts).encode('utf-32-le'), dtype=np.uint32)
+                token_indices = np.full(len(codes), self._unk_id, dtype=np.int32)
+                in_table = codes < len(self._char_table)
+                token_indices[in_table] = self._char_table[codes[in_table]]
+            except UnicodeEncodeError:
+                token_indices = None
+        if token_indices is None:
+            tokens = (token for text in texts for token in self._char_tokenize(text))
+            token_indices = np.fromiter((self._space_id if token == ' ' else self._vocab_dict.get(token, self._unk_id)
+                                         for token in tokens), dtype=np.int32, count=int(offsets[-1]))
+        if self._unk_id == -1 and (token_indices == -1).any():
+            raise Exception(f'词汇表中没有{self.unk}，无法转换不在词汇表中的令牌')
+        return token_indices, offsets
+
     @property
     def vocab_size(self):
         """返回词汇表大小
@@ -49,6 +82,15 @@ class TextFeaturizer(object):
         """Character tokenizer."""
         return text
 
+    def _create_char_table(self):
+        """按Unicode码位查找单个字符令牌索引的数组，用于批量转换字符串"""
+        chars = [token for token in self._vocab_dict.keys() if len(token) == 1]
+        table = np.full(max([ord(c) for c in chars] + [ord(' ')]) + 1, self._unk_id, dtype=np.int32)
+        for c in chars:
+            table[ord(c)] = self._vocab_dict[c]
+        table[ord(' ')] = self._space_id
+        return table
+
     def _load_vocabulary_from_file(self, vocab_filepath):
         """Load vocabulary from file."""
         vocab_lines = []
@@ -56,4 +98,6 @@ class TextFeaturizer(object):
             vocab_lines.extend(file.readlines())
         vocab_list = [line.split('\t')[0].replace('\n', '') for line in vocab_lines]
         vocab_dict = dict([(token, id) for (id, token) in enumerate(vocab_list)])
-        return vocab_dict, vocab_list
+        with open(vocab_filepath, 'rb') as file:
+            vocab_md5 = hashlib.md5(file.read()).hexdigest()
+        return vocab_dict, vocab_list, vocab_md5
@@ -1,17 +1,26 @@
-import json
+import os
 
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
 
 from masr.data_utils.audio import AudioSegment
 from masr.data_utils.augmentor.augmentation import AugmentationPipeline
-from masr.data_utils.binary import DatasetReader
+from masr.data_utils.binary import ColumnarDatasetReader, DatasetReader, TextDatasetReader
+from masr.data_utils.feature_cache import FeatureCache, FeatureCacheWriter, feature_cache_key
 from masr.data_utils.featurizer.audio_featurizer import AudioFeaturizer
 from masr.data_utils.featurizer.text_featurizer import TextFeaturizer
 from masr.utils.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+# 每个读取数据的进程最多保持打开的特征分片数量
+MAX_OPEN_FEATURE_SHARDS = 64
+
+
+def _no_collate(sample):
+    return sample
+
 
 # 音频数据加载器
 class MASRDataset(Dataset):
@@ -23,41 +32,52 @@ class MASRDataset(Dataset):
                  max_duration=20,
                  augmentation_config='{}',
                  manifest_type='txt',
-                 train=False):
+                 train=False,
+                 token_cache_dir=None):
         super(MASRDataset, self).__init__()
+        self._preprocess_configs = preprocess_configs
+        self._data_manifest = data_manifest
+        self._vocab_filepath = vocab_filepath
+        self._min_duration = min_duration
+        self._max_duration = max_duration
+        self._feature_cache = None
+        # 已经打开的特征分片
+        self._feature_shards = {}
         self._augmentation_pipeline = AugmentationPipeline(augmentation_config=augmentation_config)
         self._audio_featurizer = AudioFeaturizer(train=train, **preprocess_configs)
         self._text_featurizer = TextFeaturizer(vocab_filepath)
         self.manifest_type = manifest_type
         if self.manifest_type == 'txt':
-            # 获取文本格式数据列表
-            with open(data_manifest, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            self.data_list = []
-            for line in lines:
-                line = json.loads(line)
-                # 跳过超出长度限制的音频
-                if line["duration"] < min_duration:
-                    continue
-                if max_duration != -1 and line["duration"] > max_duration:
-                    continue
-                self.data_list.append(dict(line))
+            # 获取文本格式数据列表，保存为紧凑的数组，读取时才解析，标签在加载时一次转换为索引
+            self.dataset_reader = TextDatasetReader(data_path=data_manifest,
+                                                    min_duration=min_duration,
+                                                    max_duration=max_duration,
+                                                    text_featurizer=self._text_featurizer,
+                                                    cache_dir=token_cache_dir)
         else:
-            # 获取二进制的数据列表
-            self.dataset_reader = DatasetReader(data_path=data_manifest,
-                                                min_duration=min_duration,
-                                                max_duration=max_duration)
-            self.data_list = self.dataset_reader.get_keys()
+            # 获取二进制的数据列表，优先使用第二版的二进制数据列表
+            if ColumnarDatasetReader.exists(data_manifest):
+                self.dataset_reader = ColumnarDatasetReader(data_path=data_manifest,
+                                                            min_duration=min_duration,
+                                                            max_duration=max_duration,
+                                                            vocab_filepath=vocab_filepath)
+            else:
+                self.dataset_reader = DatasetReader(data_path=data_manifest,
+                                                    min_duration=min_duration,
+                                                    max_duration=max_duration)
+        self.data_list = self.dataset_reader.get_keys()
 
     def __getitem__(self, idx):
+        if self._feature_cache is not None:
+            return self._feature_cache.get(idx)
         data_list = self.get_one_list(idx)
         # 分割音频路径和标签
         audio_file, transcript = data_list["audio_filepath"], data_list["text"]
         # 如果后缀名为.npy的文件，那么直接读取
         if audio_file.endswith('.npy'):
             start_frame, end_frame = data_list["start_frame"], data_list["end_frame"]
-            feature = np.load(audio_file)
-            feature = feature[start_frame:end_frame, :]
+            # 以内存映射的方式打开特征分片，只读取需要的帧
+            feature = np.array(self._get_feature_shard(audio_file)[start_frame:end_frame, :], dtype=np.float32)
         else:
             if 'start_time' not in data_list.keys():
                 # 读取音频
@@ -70,25 +90,84 @@ class MASRDataset(Dataset):
             self._augmentation_pipeline.transform_audio(audio_segment)
             # 预处理，提取特征
             feature = self._audio_featurizer.featurize(audio_segment)
-        transcript = self._text_featurizer.featurize(transcript)
+        # 文本数据列表和第二版二进制数据列表已经转换好标签索引，不需要每次都转换文本
+        tokens = self.dataset_reader.get_tokens(self.data_list[idx])
+        transcript = self._text_featurizer.featurize(transcript) if tokens is None else tokens
         # 特征增强
         feature = self._augmentation_pipeline.transform_feature(feature)
         transcript = np.array(transcript, dtype=np.int32)
-        return feature.astype(np.float32), transcript
+        return feature.astype(np.float32, copy=False), transcript
 
     def __len__(self):
         return len(self.data_list)
 
+    def _get_feature_shard(self, shard_path):
+        """获取特征分片的内存映射，每个读取数据的进程最多保持打开MAX_OPEN_FEATURE_SHARDS个最近使用的分片"""
+        shard = self._feature_shards.pop(shard_path, None)
+        if shard is None:
+            shard = np.load(shard_path, mmap_mode='r')
+            if len(self._feature_shards) >= MAX_OPEN_FEATURE_SHARDS:
+                self._feature_shards.pop(next(iter(self._feature_shards)))
+        # 重新插入到最后，字典的第一个就是最久没有使用的分片
+        self._feature_shards[shard_path] = shard
+        return shard
+
+    def enable_feature_cache(self, cache_dir, num_workers=0):
+        """
+        缓存全部数据的特征和标签，之后直接读取缓存，不再读取音频和提取特征，只能用于没有数据增强的测试数据
+        缓存按数据列表的内容和预处理参数保存，数据列表或者预处理参数有变化时会重新生成，已经启用时不再重复检查
+        :param cache_dir: 缓存的根目录
+        :param num_workers: 生成缓存时提取特征的线程数量
+        """
+        if self._feature_cache is not None: return
+        if not self._augmentation_pipeline.is_empty:
+            raise Exception('使用数据增强的数据集不能缓存特征')
+        key = feature_cache_key(data_manifest=self._data_manifest,
+                                manifest_type=self.manifest_type,
+                                preprocess_configs=self._preprocess_configs,
+                                vocab_filepath=self._vocab_filepath,
+                                min_duration=self._min_duration,
+                                max_duration=self._max_duration)
+        cache_path = os.path.join(cache_dir, key)
+        if not FeatureCache.exists(cache_path):
+            logger.info(f'正在生成数据列表{self._data_manifest}的特征缓存...')
+            # 按长度排序之后写入，评估时同一个批次的数据在文件中是连续的
+            indices = np.argsort(-np.asarray(self.durations, dtype=np.float64), kind='stable').tolist()
+            loader = DataLoader(dataset=self, batch_size=None, sampler=indices,
+                                collate_fn=_no_collate, num_workers=num_workers)
+            writer = FeatureCacheWriter(cache_path, num_data=len(self), feature_dim=self.feature_dim)
+            for idx, (feature, transcript) in zip(indices, tqdm(loader)):
+                writer.add(idx, feature, transcript)
+            writer.close()
+        self._feature_cache = FeatureCache(cache_path)
+        logger.info(f'使用特征缓存：{cache_path}')
+
     def get_one_list(self, idx):
         # 获取数据列表
-        if self.manifest_type == 'txt':
-            data_list = self.data_list[idx]
-        elif self.manifest_type == 'binary':
+        if self.manifest_type in ['txt', 'binary']:
             data_list = self.dataset_reader.get_data(self.data_list[idx])
         else:
             raise Exception(f'没有该类型：{self.manifest_type}')
         return data_list
 
+    @property
+    def durations(self):
+        """返回每条音频的长度
+
+        :return: 音频长度列表，单位为秒
+        :rtype: list
+        """
+        return self.dataset_reader.durations
+
+    @property
+    def num_frames(self):
+        """返回每条音频特征的估计帧数
+
+        :return: 特征帧数数组
+        :rtype: ndarray
+        """
+        return self._audio_featurizer.num_frames(self.durations)
+
     @property
     def feature_dim(self):
         """返回音频特征大小
@@ -2,12 +2,15 @@ import math
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch.utils.data import DistributedSampler
 from torch.utils.data import Sampler
 
 __all__ = [
+    "DSBucketingBatchSampler",
     "DSElasticDistributedSampler",
     "DSRandomSampler",
+    "DSSortedBatchSampler",
 ]
 
 
@@ -68,6 +71,8 @@ class DSRandomSampler(Sampler):
 
         self.drop_last = drop_last
         self.epoch = 0
+        # 下一个要返回的批次，用于从一轮的中间恢复训练
+        self.batch_id = 0
         self.num_samples = int(math.ceil(len(self.dataset) * 1.0))
         self.total_size = self.num_samples
         self._sortagrad = sortagrad
@@ -91,17 +96,16 @@ class DSRandomSampler(Sampler):
         assert len(indices) == self.total_size, f"batch shuffle examples error: {len(indices)} : {self.total_size}"
 
         assert len(indices) == self.num_samples
-        _sample_iter = iter(indices)
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches.pop()
 
-        batch_indices = []
-        for idx in _sample_iter:
-            batch_indices.append(idx)
-            if len(batch_indices) == self.batch_size:
-                yield batch_indices
-                batch_indices = []
-        if not self.drop_last and len(batch_indices) > 0:
-            yield batch_indices
+        # 从一轮的中间恢复训练时跳过已经训练过的批次
+        for batch_id in range(self.batch_id, len(batches)):
+            self.batch_id = batch_id + 1
+            yield batches[batch_id]
 
+        self.batch_id = 0
         self.epoch += 1
 
     def __len__(self):
@@ -109,6 +113,23 @@ class DSRandomSampler(Sampler):
         num_samples += int(not self.drop_last) * (self.batch_size - 1)
         return num_samples // self.batch_size
 
+    def state_dict(self):
+        """返回Sampler的状态，DataLoader预读取数据时这里的位置会超前于实际训练的位置
+
+        :return: 当前的轮数和下一个要返回的批次
+        :rtype: dict
+        """
+        return {'epoch': self.epoch, 'batch_id': self.batch_id}
+
+    def load_state_dict(self, state_dict):
+        """恢复Sampler的状态，下一次迭代从指定轮数的指定批次开始
+
+        :param state_dict: state_dict()返回的状态
+        :type state_dict: dict
+        """
+        self.epoch = state_dict['epoch']
+        self.batch_id = state_dict['batch_id']
+
 
 class DSElasticDistributedSampler(DistributedSampler):
     def __init__(self,
@@ -143,6 +164,8 @@ class DSElasticDistributedSampler(DistributedSampler):
 
         self.drop_last = drop_last
         self.epoch = 0
+        # 下一个要返回的批次，用于从一轮的中间恢复训练
+        self.batch_id = 0
         self.num_samples = int(math.ceil(float(len(self.dataset)) / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
         self._sortagrad = sortagrad
@@ -166,20 +189,174 @@ class DSElasticDistributedSampler(DistributedSampler):
                     raise ValueError("Unknown shuffle method %s." % self._shuffle_method)
 
         assert len(indices) == self.num_samples
-        _sample_iter = iter(indices)
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches.pop()
 
-        batch_indices = []
-        for idx in _sample_iter:
-            batch_indices.append(idx)
-            if len(batch_indices) == self.batch_size:
-                yield batch_indices
-                batch_indices = []
-        if not self.drop_last and len(batch_indices) > 0:
-            yield batch_indices
+        # 从一轮的中间恢复训练时跳过已经训练过的批次
+        for batch_id in range(self.batch_id, len(batches)):
+            self.batch_id = batch_id + 1
+            yield batches[batch_id]
 
+        self.batch_id = 0
         self.epoch += 1
 
     def __len__(self):
         num_samples = self.num_samples
         num_samples += int(not self.drop_last) * (self.batch_size - 1)
         return num_samples // self.batch_size
+
+    def state_dict(self):
+        """返回Sampler的状态，DataLoader预读取数据时这里的位置会超前于实际训练的位置
+
+        :return: 当前的轮数和下一个要返回的批次
+        :rtype: dict
+        """
+        return {'epoch': self.epoch, 'batch_id': self.batch_id}
+
+    def load_state_dict(self, state_dict):
+        """恢复Sampler的状态，下一次迭代从指定轮数的指定批次开始
+
+        :param state_dict: state_dict()返回的状态
+        :type state_dict: dict
+        """
+        self.epoch = state_dict['epoch']
+        self.batch_id = state_dict['batch_id']
+
+
+class DSSortedBatchSampler(Sampler):
+    def __init__(self, dataset, batch_size):
+        """按音频长度排序之后再分批的Sampler，同一批次的音频长度接近，补齐的部分最少，用于评估
+
+        Args:
+            dataset (MASRDataset): 数据集，需要有durations属性
+            batch_size (int): batch size for one gpu
+        """
+        assert isinstance(batch_size, int) and batch_size > 0, "batch_size should be a positive integer"
+        self.batch_size = batch_size
+        # 从长到短排序，第一个批次就可以暴露显存不足的问题
+        self.indices = np.argsort(-np.asarray(dataset.durations, dtype=np.float64), kind='stable').tolist()
+
+    def __iter__(self):
+        for i in range(0, len(self.indices), self.batch_size):
+            yield self.indices[i:i + self.batch_size]
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+
+class DSBucketingBatchSampler(Sampler):
+    def __init__(self,
+                 dataset,
+                 max_frames,
+                 padded=True,
+                 num_replicas=None,
+                 rank=None,
+                 shuffle=False,
+                 drop_last=False,
+                 sortagrad=False,
+                 seed=0):
+        """按特征帧数动态分批的Sampler，长度接近的音频放在同一个批次，每个批次的帧数不超过max_frames，
+        短音频的批次包含更多的音频，长音频的批次包含更少的音频，每个批次占用的内存接近
+
+        Args:
+            dataset (MASRDataset): 数据集，需要有num_frames属性
+            max_frames (int): 每个批次最多的特征帧数，单条音频超过这个帧数时单独作为一个批次
+            padded (bool, optional): True时按补齐之后的帧数计算，即最长的帧数乘以音频数量；否则按帧数之和计算. Defaults to True.
+            num_replicas (int, optional): 分布式训练的进程数量，为None时从分布式环境获取. Defaults to None.
+            rank (int, optional): 当前进程的编号，为None时从分布式环境获取. Defaults to None.
+            shuffle (bool, optional): True for do shuffle, or else. Defaults to False.
+            drop_last (bool, optional): 批次数量不能被进程数量整除时丢弃多出来的批次，否则重复前面的批次补齐. Defaults to False.
+            sortagrad (bool, optional): True, do sortgrad in first epoch, then shuffle as usual; or else. Defaults to False.
+            seed (int, optional): 打乱批次的随机种子，所有进程必须相同. Defaults to 0.
+        """
+        assert isinstance(max_frames, int) and max_frames > 0, "max_frames should be a positive integer"
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.max_frames = max_frames
+        self.padded = padded
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        # 下一个要返回的批次，用于从一轮的中间恢复训练
+        self.batch_id = 0
+        self._sortagrad = sortagrad
+        self.frames = np.asarray(dataset.num_frames, dtype=np.int64)
+        batches = self._pack(np.argsort(self.frames, kind='stable'))
+        # 打乱时批次的起点在第一个批次的范围内随机移动，和_batch_shuffle()一样每一轮的批次组成都不同
+        self._max_shift = len(batches[0]) if len(batches) > 0 else 1
+        # 一段音频可以放入一个批次时，其中的任意一段也可以，所以按顺序放入得到的批次数量最少，
+        # 移动起点之后前面的音频单独作为一个批次，批次数量只会和不移动时相同或者多一个
+        num_batches = len(batches)
+        max_num_batches = num_batches + 1 if self.shuffle else num_batches
+        if self.drop_last:
+            self.num_batches = num_batches // self.num_replicas
+        else:
+            self.num_batches = int(math.ceil(max_num_batches / self.num_replicas))
+
+    def _pack(self, indices):
+        # 按顺序把音频放入批次，加入下一条音频会超过帧数限制时开始新的批次
+        batches, batch, max_len, sum_len = [], [], 0, 0
+        for idx, num_frames in zip(indices.tolist(), self.frames[indices].tolist()):
+            if self.padded:
+                cost = max(max_len, num_frames) * (len(batch) + 1)
+            else:
+                cost = sum_len + num_frames
+            if len(batch) > 0 and cost > self.max_frames:
+                batches.append(batch)
+                batch, max_len, sum_len = [], 0, 0
+            batch.append(idx)
+            max_len, sum_len = max(max_len, num_frames), sum_len + num_frames
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def _epoch_batches(self, epoch):
+        # 所有进程使用相同的随机种子，得到相同的批次列表之后再按进程编号分配
+        rng = np.random.RandomState(self.seed + epoch)
+        shuffle = self.shuffle and (epoch != 0 or not self._sortagrad)
+        if shuffle:
+            # 帧数相同的音频随机排序，再随机移动批次的起点，移动的音频单独作为一个批次，每一轮的批次组成不同
+            indices = np.lexsort((rng.permutation(len(self.frames)), self.frames))
+            shift = rng.randint(0, self._max_shift)
+            batches = ([indices[:shift].tolist()] if shift > 0 else []) + self._pack(indices[shift:])
+            rng.shuffle(batches)
+        else:
+            batches = self._pack(np.argsort(self.frames, kind='stable'))
+        # 每个进程的批次数量必须相同，否则多卡训练时会互相等待
+        batches = [batches[i % len(batches)] for i in range(self.num_batches * self.num_replicas)]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        batches = self._epoch_batches(self.epoch)
+        start_batch = self.batch_id
+        for batch_id in range(start_batch, len(batches)):
+            self.batch_id = batch_id + 1
+            yield batches[batch_id]
+        self.batch_id = 0
+        self.epoch += 1
+
+    def __len__(self):
+        return self.num_batches
+
+    def state_dict(self):
+        """返回Sampler的状态，DataLoader预读取数据时这里的位置会超前于实际训练的位置
+
+        :return: 当前的轮数和下一个要返回的批次
+        :rtype: dict
+        """
+        return {'epoch': self.epoch, 'batch_id': self.batch_id}
+
+    def load_state_dict(self, state_dict):
+        """恢复Sampler的状态，下一次迭代从指定轮数的指定批次开始
+
+        :param state_dict: state_dict()返回的状态
+        :type state_dict: dict
+        """
+        self.epoch = state_dict['epoch']
+        self.batch_id = state_dict['batch_id']
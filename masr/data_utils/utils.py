@@ -13,7 +13,7 @@ import soundfile
 # from pydub import AudioSegment
 from tqdm import tqdm
 
-from masr.data_utils.binary import DatasetWriter
+from masr.data_utils.binary import ColumnarDatasetWriter
 from masr.utils.logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -292,16 +292,17 @@ def count_manifest(counter, manifest_path):
                     counter[char] += 1
 
 
-def create_manifest_binary(train_manifest_path, test_manifest_path):
+def create_manifest_binary(train_manifest_path, test_manifest_path, vocab_filepath=None):
     """
-    生成数据列表的二进制文件
+    生成第二版的数据列表二进制文件
     :param train_manifest_path: 训练列表的路径
     :param test_manifest_path: 测试列表的路径
+    :param vocab_filepath: 词汇表的路径，不为None时同时保存转换好的标签索引
     :return:
     """
     for manifest_path in [train_manifest_path, test_manifest_path]:
-        dataset_writer = DatasetWriter(manifest_path)
-        with open(train_manifest_path, 'r', encoding='utf-8') as f:
+        dataset_writer = ColumnarDatasetWriter(manifest_path, vocab_filepath=vocab_filepath)
+        with open(manifest_path, 'r', encoding='utf-8') as f:
             lines = f.readlines()
         for line in tqdm(lines):
             line = line.replace('\n', '')
@@ -1,13 +1,36 @@
 import os
 
-from masr.decoders.swig_wrapper import Scorer, CTCBeamSearchDecoder
-from masr.decoders.swig_wrapper import ctc_beam_search_decoding_batch, ctc_beam_search_decoding
+import numpy as np
+
+from masr.decoders.blank_skip import skip_blank_frames
 from masr.utils.utils import download
 
+try:
+    from masr.decoders.swig_wrapper import Scorer, CTCBeamSearchDecoder
+    from masr.decoders.swig_wrapper import ctc_beam_search_decoding_batch, ctc_beam_search_decoding, to_decoder_input
+
+    NATIVE_DECODER = True
+except ModuleNotFoundError:
+    # 没有安装paddlespeech_ctcdecoders时使用NumPy实现的前缀集束搜索，解码结果相同，速度较慢
+    from masr.decoders.ctc_prefix_beam_search import Scorer, CTCBeamSearchDecoder, KENLM_AVAILABLE
+    from masr.decoders.ctc_prefix_beam_search import ctc_beam_search_decoding_batch, ctc_beam_search_decoding
+
+    NATIVE_DECODER = False
+
+    # NumPy实现的解码器直接使用NumPy数组，不需要转换
+    def to_decoder_input(probs_seq, cutoff_top_n=None):
+        return np.asarray(probs_seq)
+
 
 class BeamSearchDecoder:
     def __init__(self, alpha, beta, beam_size, cutoff_prob, cutoff_top_n, vocab_list, num_processes=10,
-                 blank_id=0, language_model_path='lm/zh_giga.no_cna_cmn.prune01244.klm'):
+                 blank_id=0, language_model_path='lm/zh_giga.no_cna_cmn.prune01244.klm', blank_skip_threshold=1.0,
+                 ext_scorer=None):
+        """
+        CTC集束搜索解码器，没有安装paddlespeech_ctcdecoders时使用NumPy实现的前缀集束搜索
+        :param ext_scorer: 自定义的外部评分，为None时加载language_model_path的语言模型，
+                           只有NumPy实现的解码器支持，需要继承ctc_prefix_beam_search.NgramScorer
+        """
         self.alpha = alpha
         self.beta = beta
         self.beam_size = beam_size
@@ -16,6 +39,26 @@ class BeamSearchDecoder:
         self.vocab_list = vocab_list
         self.num_processes = num_processes
         self.blank_id = blank_id
+        # 空白概率大于该值的连续帧只保留一帧再执行集束搜索，大于等于1时不跳过
+        self.blank_skip_threshold = blank_skip_threshold
+        print('=' * 70)
+        print("初始化解码器...")
+        if not NATIVE_DECODER:
+            print('没有安装paddlespeech_ctcdecoders库，使用NumPy实现的集束搜索解码器，解码速度较慢')
+        if ext_scorer is not None or (not NATIVE_DECODER and not KENLM_AVAILABLE):
+            if ext_scorer is None:
+                print('没有安装kenlm库，集束搜索解码器不使用语言模型，可以执行 python -m pip install kenlm 安装')
+            self._ext_scorer = ext_scorer
+        else:
+            self._ext_scorer = self.__load_language_model(language_model_path)
+        batch_size = 1
+        self.beam_search_decoder = CTCBeamSearchDecoder(vocab_list, batch_size, beam_size, num_processes, cutoff_prob,
+                                                        cutoff_top_n, self._ext_scorer, self.blank_id)
+        print("初始化解码器完成!")
+        print('=' * 70)
+
+    # 加载语言模型，默认的语言模型不存在时自动下载
+    def __load_language_model(self, language_model_path):
         if not os.path.exists(language_model_path) and language_model_path == 'lm/zh_giga.no_cna_cmn.prune01244.klm':
             print('=' * 70)
             language_model_url = 'https://deepspeech.bj.bcebos.com/zh_lm/zh_giga.no_cna_cmn.prune01244.klm'
@@ -23,28 +66,23 @@ class BeamSearchDecoder:
             os.makedirs(os.path.dirname(language_model_path), exist_ok=True)
             download(url=language_model_url, download_target=language_model_path)
             print('=' * 70)
-        print('=' * 70)
-        print("初始化解码器...")
         assert os.path.exists(language_model_path), f'语言模型不存在：{language_model_path}'
-        self._ext_scorer = Scorer(alpha, beta, language_model_path, vocab_list)
-        lm_char_based = self._ext_scorer.is_character_based()
-        lm_max_order = self._ext_scorer.get_max_order()
-        lm_dict_size = self._ext_scorer.get_dict_size()
+        ext_scorer = Scorer(self.alpha, self.beta, language_model_path, self.vocab_list)
+        lm_char_based = ext_scorer.is_character_based()
+        lm_max_order = ext_scorer.get_max_order()
+        lm_dict_size = ext_scorer.get_dict_size()
         print(f"language model: "
               f"model path = {language_model_path}, "
               f"is_character_based = {lm_char_based}, "
               f"max_order = {lm_max_order}, "
               f"dict_size = {lm_dict_size}")
-        batch_size = 1
-        self.beam_search_decoder = CTCBeamSearchDecoder(vocab_list, batch_size, beam_size, num_processes, cutoff_prob,
-                                                        cutoff_top_n, self._ext_scorer, self.blank_id)
-        print("初始化解码器完成!")
-        print('=' * 70)
+        return ext_scorer
 
-    # 单个数据解码
-    def decode_beam_search_offline(self, probs_split):
+    # 单个数据解码，return_nbest为True时返回按得分降序排列的全部结果
+    def decode_beam_search_offline(self, probs_split, return_nbest=False):
         if self._ext_scorer is not None:
             self._ext_scorer.reset_params(self.alpha, self.beta)
+        probs_split, _ = skip_blank_frames(probs_split, self.blank_skip_threshold, blank_id=self.blank_id)
         # beam search decode
         beam_search_result = ctc_beam_search_decoding(probs_seq=probs_split,
                                                       vocabulary=self.vocab_list,
@@ -53,44 +91,70 @@ class BeamSearchDecoder:
                                                       cutoff_prob=self.cutoff_prob,
                                                       cutoff_top_n=self.cutoff_top_n,
                                                       blank_id=self.blank_id)
+        if return_nbest:
+            return beam_search_result
         return beam_search_result[0]
 
     # 一批数据解码
-    def decode_batch_beam_search_offline(self, probs_split):
+    def decode_batch_beam_search_offline(self, probs_split, return_score=False):
         if self._ext_scorer is not None:
             self._ext_scorer.reset_params(self.alpha, self.beta)
+        probs_split = [skip_blank_frames(probs, self.blank_skip_threshold, blank_id=self.blank_id)[0]
+                       for probs in probs_split]
         # beam search decode
-        self.num_processes = min(self.num_processes, len(probs_split))
+        num_processes = min(self.num_processes, len(probs_split))
         beam_search_results = ctc_beam_search_decoding_batch(probs_split=probs_split,
                                                              vocabulary=self.vocab_list,
                                                              beam_size=self.beam_size,
-                                                             num_processes=self.num_processes,
+                                                             num_processes=num_processes,
                                                              ext_scoring_func=self._ext_scorer,
                                                              cutoff_prob=self.cutoff_prob,
                                                              cutoff_top_n=self.cutoff_top_n,
                                                              blank_id=self.blank_id)
+        if return_score:
+            return [result[0] for result in beam_search_results]
         results = [result[0][1] for result in beam_search_results]
         return results
 
-    def decode_chunk(self, probs, logits_lens):
+    # 创建一个新的流式解码状态，和当前解码器共用语言模型，用于同时解码多条流式音频
+    def create_stream_state(self):
+        batch_size = 1
+        return CTCBeamSearchDecoder(self.vocab_list, batch_size, self.beam_size, self.num_processes,
+                                    self.cutoff_prob, self.cutoff_top_n, self._ext_scorer, self.blank_id)
+
+    def decode_chunk(self, probs, logits_lens, stream_state=None):
         """流式解码
 
         Args:
             probs (list(list(float))):一个batch模型输入的结构
             logits_lens (list(int)): 一个batch模型输出的长度
+            stream_state (CTCBeamSearchDecoder): 流式解码状态，为None时使用解码器默认的状态
         """
-        has_value = (logits_lens > 0).tolist()
-        has_value = ["true" if has_value[i] is True else "false" for i in range(len(has_value))]
-        probs_split = [probs[i, :l, :].tolist() if has_value[i] else probs[i].tolist()
-                       for i, l in enumerate(logits_lens)]
-        self.beam_search_decoder.next(probs_split, has_value)
+        if stream_state is None:
+            stream_state = self.beam_search_decoder
+        probs_split = [probs[i, :l, :] for i, l in enumerate(logits_lens)]
+        if self.blank_skip_threshold < 1.0:
+            # 上一个数据块最后的空白帧和这个数据块开头的空白帧是连续的，只保留一帧
+            probs_split[0], stream_state.last_frame_blank = \
+                skip_blank_frames(probs_split[0], self.blank_skip_threshold, blank_id=self.blank_id,
+                                  prev_blank=stream_state.last_frame_blank)
+        # 这个数据块全部帧都被跳过时不需要执行集束搜索
+        if any(len(p) > 0 for p in probs_split):
+            has_value = ["true" if len(p) > 0 else "false" for p in probs_split]
+            # 没有数据的会话会被解码器忽略，只传入一帧占位
+            probs_split = [to_decoder_input(p if len(p) > 0 else probs[i, :1], cutoff_top_n=self.cutoff_top_n)
+                           for i, p in enumerate(probs_split)]
+            stream_state.next(probs_split, has_value)
 
-        batch_beam_results = self.beam_search_decoder.decode()
+        batch_beam_results = stream_state.decode()
         batch_beam_results = [[(res[0], res[1]) for res in beam_results] for beam_results in batch_beam_results]
         results_best = [result for result in batch_beam_results]
         return results_best[0][0]
 
-    def reset_decoder(self):
+    def reset_decoder(self, stream_state=None):
+        if stream_state is None:
+            stream_state = self.beam_search_decoder
         batch_size = 1
-        self.beam_search_decoder.reset_state(batch_size, self.beam_size, self.num_processes,
-                                             self.cutoff_prob, self.cutoff_top_n)
+        stream_state.last_frame_blank = False
+        stream_state.reset_state(batch_size, self.beam_size, self.num_processes,
+                                 self.cutoff_prob, self.cutoff_top_n)
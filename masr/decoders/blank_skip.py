@@ -0,0 +1,29 @@
+import numpy as np
+
+
+def skip_blank_frames(probs_seq, threshold, blank_id=0, prev_blank=False):
+    """在集束搜索之前合并连续的空白帧
+
+    空白概率大于threshold的帧为空白帧，连续的空白帧只保留第一帧，
+    保留一帧是为了继续分隔前后相同的字符，解码结果和使用全部帧基本一致，但集束搜索需要处理的帧数大大减少
+
+    :param probs_seq: 2D的概率表，形状为(T, vocab_size)
+    :type probs_seq: numpy.ndarray
+    :param threshold: 空白帧的概率阈值，大于等于1时不跳过任何帧
+    :type threshold: float
+    :param blank_id: 空白索引
+    :type blank_id: int
+    :param prev_blank: 上一个数据块的最后一帧是否为空白帧，流式解码时用于合并跨数据块的连续空白帧
+    :type prev_blank: bool
+    :return: 保留的帧的概率表和这个数据块的最后一帧是否为空白帧
+    :rtype: tuple
+    """
+    probs_seq = np.asarray(probs_seq)
+    if threshold >= 1.0 or len(probs_seq) == 0:
+        return probs_seq, prev_blank
+    is_blank = probs_seq[:, blank_id] > threshold
+    prev_is_blank = np.concatenate([[prev_blank], is_blank[:-1]])
+    keep = ~(is_blank & prev_is_blank)
+    if keep.all():
+        return probs_seq, bool(is_blank[-1])
+    return probs_seq[keep], bool(is_blank[-1])
@@ -31,7 +31,7 @@ def greedy_decoder(probs_seq, vocabulary, blank_index=0):
     return score, text
 
 
-def greedy_decoder_batch(probs_split, vocabulary, blank_index=0):
+def greedy_decoder_batch(probs_split, vocabulary, blank_index=0, return_score=False):
     """CTC贪婪(最佳路径)解码器
     :param probs_split: 一批包含2D的概率表
     :type probs_split: list
@@ -39,28 +39,31 @@ def greedy_decoder_batch(probs_split, vocabulary, blank_index=0):
     :type vocabulary: list
     :param blank_index 需要移除的空白索引
     :type blank_index int
-    :return: 字符串列表
+    :param return_score: 是否同时返回解码的得分
+    :type return_score: bool
+    :return: 字符串列表，如果return_score为True，则为得分和字符串的元组列表
     :rtype: list
     """
     results = []
     for i, probs in enumerate(probs_split):
         output_transcription = greedy_decoder(probs, vocabulary, blank_index=blank_index)
-        results.append(output_transcription[1])
+        results.append(output_transcription if return_score else output_transcription[1])
     return results
 
 
 def greedy_decoder_chunk(probs_seq, vocabulary, last_max_prob_list=None, last_max_index_list=None, blank_index=0):
     """CTC贪婪(最佳路径)流式解码器
 
-    由最可能的令牌组成的路径将被进一步后处理到去掉连续重复和所有空白
+    由最可能的令牌组成的路径将被进一步后处理到去掉连续重复和所有空白，
+    每次都会重新处理全部历史结果，长时间的流式识别请使用GreedyStreamDecoder
 
     :param probs_seq: 每一条都是2D的概率表。每个元素都是浮点数概率的列表一个字符
     :type probs_seq: numpy.ndarray
     :param vocabulary: 词汇列表
     :type vocabulary: list
-    :param last_max_prob_list 上次解码的最大索引
+    :param last_max_prob_list 之前解码的非空白帧的最大概率
     :type last_max_prob_list list
-    :param last_max_index_list 上次解码得分
+    :param last_max_index_list 之前解码每一帧的最大索引
     :type last_max_index_list list
     :param blank_index 需要移除的空白索引
     :type blank_index int
@@ -75,15 +78,98 @@ def greedy_decoder_chunk(probs_seq, vocabulary, last_max_prob_list=None, last_ma
     max_index_list = list(np.array(probs_seq).argmax(axis=1))
     max_prob_list = [probs_seq[i][max_index_list[i]] for i in range(len(max_index_list)) if max_index_list[i] != blank_index]
     # 加入之前的结果
-    last_max_prob_list.extend(max_index_list)
-    last_max_index_list.extend(max_prob_list)
+    last_max_index_list.extend(max_index_list)
+    last_max_prob_list.extend(max_prob_list)
 
     # 删除连续的重复索引和空索引
-    index_list = [index_group[0] for index_group in groupby(last_max_prob_list)]
+    index_list = [index_group[0] for index_group in groupby(last_max_index_list)]
     index_list = [index for index in index_list if index != blank_index]
     # 索引列表转换为字符串
     text = [vocabulary[index].replace('<space>', ' ') for index in index_list]
     score = 0
-    if len(last_max_index_list) > 0:
-        score = float(sum(last_max_index_list) / len(last_max_index_list)) * 100.0
+    if len(last_max_prob_list) > 0:
+        score = float(sum(last_max_prob_list) / len(last_max_prob_list)) * 100.0
     return score, text, last_max_prob_list, last_max_index_list
+
+
+def tokens_to_text(token_ids, vocabulary):
+    """把解码得到的索引列表转换为字符列表
+
+    :param token_ids: 已经删除连续重复索引和空白索引的索引列表
+    :type token_ids: list
+    :param vocabulary: 词汇列表
+    :type vocabulary: list
+    :return: 字符列表
+    :rtype: list
+    """
+    return [vocabulary[index].replace('<space>', ' ') for index in token_ids]
+
+
+class GreedyStreamDecoder(object):
+    """CTC贪婪(最佳路径)流式解码器，保存解码状态，每个数据块只处理新的帧
+
+    :param vocabulary: 词汇列表
+    :type vocabulary: list
+    :param blank_index 需要移除的空白索引
+    :type blank_index int
+    """
+
+    def __init__(self, vocabulary, blank_index=0):
+        self.vocabulary = vocabulary
+        self.blank_index = blank_index
+        self.reset()
+
+    def reset(self):
+        # 上一帧的最大索引，用于删除跨数据块的连续重复索引
+        self.last_index = -1
+        # 非空白帧最大概率的累加和以及帧数，用于计算得分
+        self.prob_sum = 0.0
+        self.prob_count = 0
+        self.token_ids = []
+        # 累加的识别结果字符串，每个数据块只拼接新解码的字符，不需要每次复制全部结果
+        self.text = ''
+
+    @property
+    def score(self):
+        if self.prob_count == 0: return 0
+        return self.prob_sum / self.prob_count * 100.0
+
+    def decode_chunk(self, probs_seq):
+        """解码一个数据块，只处理这个数据块的帧
+
+        :param probs_seq: 这个数据块的2D概率表，形状为(T, vocab_size)
+        :type probs_seq: numpy.ndarray
+        :return: 当前全部结果的得分和这个数据块新解码得到的字符列表
+        :rtype: tuple
+        """
+        probs_seq = np.asarray(probs_seq)
+        if len(probs_seq) == 0:
+            return self.score, []
+        max_index = probs_seq.argmax(axis=1)
+        max_prob = probs_seq[np.arange(len(max_index)), max_index]
+        return self.decode_chunk_indices(max_index, max_prob)
+
+    def decode_chunk_indices(self, max_index, max_prob):
+        """解码一个数据块已经在模型所在设备上计算好的每帧最大索引和最大概率
+
+        :param max_index: 这个数据块每一帧的最大索引，形状为(T,)
+        :type max_index: numpy.ndarray
+        :param max_prob: 这个数据块每一帧的最大概率，形状为(T,)
+        :type max_prob: numpy.ndarray
+        :return: 当前全部结果的得分和这个数据块新解码得到的字符列表
+        :rtype: tuple
+        """
+        max_index, max_prob = np.asarray(max_index), np.asarray(max_prob)
+        if len(max_index) == 0:
+            return self.score, []
+        non_blank = max_index != self.blank_index
+        self.prob_sum += float(max_prob[non_blank].sum(dtype=np.float64))
+        self.prob_count += int(non_blank.sum())
+        # 和前一帧索引不同的非空白帧才输出
+        prev_index = np.concatenate([[self.last_index], max_index[:-1]])
+        new_ids = max_index[(max_index != prev_index) & non_blank].tolist()
+        self.last_index = int(max_index[-1])
+        new_text = tokens_to_text(new_ids, self.vocabulary)
+        self.token_ids.extend(new_ids)
+        self.text += ''.join(new_text)
+        return self.score, new_text
@@ -0,0 +1,440 @@
+from array import array
+
+import numpy as np
+
+try:
+    import kenlm
+
+    KENLM_AVAILABLE = True
+except ImportError:
+    kenlm = None
+    KENLM_AVAILABLE = False
+
+# 语言模型中不存在的词的得分，和paddlespeech_ctcdecoders一致
+OOV_SCORE = -1000.0
+# log10转换为自然对数
+LOG10_TO_LN = float(np.log(10.0))
+# 前缀树的节点数量超过该值之后才开始删除不在集束中的节点
+MIN_COMPACT_NODES = 4096
+
+
+class NgramScorer(object):
+    """前缀集束搜索使用的外部评分接口，可以继承该类实现自定义的语言模型
+
+    状态是不可变的对象，每个前缀保存自己的状态，所以相同的状态可以被多个前缀共用
+
+    :param alpha: 与语言模型相关的参数。当alpha = 0时不要使用语言模型
+    :type alpha: float
+    :param beta: 与字计数相关的参数。当beta = 0时不要使用统计字
+    :type beta: float
+    """
+
+    def __init__(self, alpha, beta):
+        self.alpha = alpha
+        self.beta = beta
+
+    def reset_params(self, alpha, beta):
+        self.alpha = alpha
+        self.beta = beta
+
+    def is_character_based(self):
+        return True
+
+    def get_max_order(self):
+        return 0
+
+    def get_dict_size(self):
+        return 0
+
+    def start_state(self):
+        """空前缀的状态"""
+        return None
+
+    def score(self, state, token_id):
+        """前缀增加一个字符之后的得分
+
+        :param state: 前缀的状态
+        :param token_id: 增加的字符索引，不会是空白索引
+        :type token_id: int
+        :return: 增加的得分和新前缀的状态，得分已经乘以alpha和加上beta
+        :rtype: tuple
+        """
+        return 0.0, state
+
+    def final_score(self, state):
+        """解码结束时前缀需要增加的得分，例如基于词的语言模型最后一个还没有结束的词"""
+        return 0.0
+
+
+class Scorer(NgramScorer):
+    """基于kenlm的n-gram语言模型评分，和paddlespeech_ctcdecoders.Scorer的参数相同
+
+    :param alpha: 与语言模型相关的参数。当alpha = 0时不要使用语言模型
+    :type alpha: float
+    :param beta: 与字计数相关的参数。当beta = 0时不要使用统计字
+    :type beta: float
+    :model_path: 语言模型的路径
+    :type model_path: str
+    :param vocabulary: 词汇列表
+    :type vocabulary: list
+    """
+
+    def __init__(self, alpha, beta, model_path, vocabulary):
+        super().__init__(alpha, beta)
+        if kenlm is None:
+            raise ModuleNotFoundError('没有安装kenlm库，不能使用语言模型')
+        self.model = kenlm.Model(model_path)
+        self.vocabulary = [v.replace('<space>', ' ') for v in vocabulary]
+        # 词汇表中有空格时为基于词的语言模型，遇到空格时才对前面的词评分
+        self._character_based = ' ' not in self.vocabulary
+        self._space_id = self.vocabulary.index(' ') if not self._character_based else -1
+
+    def is_character_based(self):
+        return self._character_based
+
+    def get_max_order(self):
+        return self.model.order
+
+    def get_dict_size(self):
+        return len(self.vocabulary)
+
+    def start_state(self):
+        lm_state = kenlm.State()
+        self.model.BeginSentenceWrite(lm_state)
+        return lm_state, ''
+
+    def _score_word(self, lm_state, word):
+        if word not in self.model:
+            return OOV_SCORE, lm_state
+        out_state = kenlm.State()
+        log_prob = self.model.BaseScore(lm_state, word, out_state) * LOG10_TO_LN
+        return log_prob, out_state
+
+    def score(self, state, token_id):
+        lm_state, word = state
+        if self._character_based:
+            log_prob, lm_state = self._score_word(lm_state, self.vocabulary[token_id])
+            return self.alpha * log_prob + self.beta, (lm_state, '')
+        if token_id != self._space_id:
+            return 0.0, (lm_state, word + self.vocabulary[token_id])
+        if word == '':
+            return 0.0, state
+        log_prob, lm_state = self._score_word(lm_state, word)
+        return self.alpha * log_prob + self.beta, (lm_state, '')
+
+    def final_score(self, state):
+        lm_state, word = state
+        if self._character_based or word == '':
+            return 0.0
+        return self.alpha * self._score_word(lm_state, word)[0] + self.beta
+
+
+def pruned_candidates(probs, cutoff_prob=1.0, cutoff_top_n=40):
+    """一帧剪枝之后参与集束搜索的字符，概率从大到小，累加概率达到cutoff_prob或者数量达到cutoff_top_n为止
+
+    :param probs: 一帧的概率，形状为(vocab_size,)
+    :type probs: numpy.ndarray
+    :return: 参与集束搜索的字符索引
+    :rtype: numpy.ndarray
+    """
+    vocab_size = len(probs)
+    if cutoff_prob >= 1.0 and cutoff_top_n >= vocab_size:
+        return np.arange(vocab_size)
+    top_n = min(cutoff_top_n, vocab_size)
+    indexes = np.argpartition(-probs, top_n - 1)[:top_n] if top_n < vocab_size else np.arange(vocab_size)
+    indexes = indexes[np.argsort(-probs[indexes], kind='stable')]
+    if cutoff_prob < 1.0:
+        cutoff_len = int(np.searchsorted(np.cumsum(probs[indexes]), cutoff_prob)) + 1
+        indexes = indexes[:cutoff_len]
+    return indexes
+
+
+class PrefixBeamState(object):
+    """一条音频的CTC前缀集束搜索状态
+
+    前缀保存在用数组实现的前缀树中，每个节点只保存父节点和最后一个字符，相同的前缀只有一个节点，
+    当前的集束保存为节点索引和对数概率的数组，每一帧的扩展、合并和剪枝都是向量化计算。
+    节点数量超过上限时删除不是当前集束前缀的节点，长时间的流式解码占用的内存不会一直增加
+
+    :param vocab_size: 词汇表大小，包括空白，即每一帧概率的长度
+    :type vocab_size: int
+    :param ext_scorer: 外部评分，为None时不使用语言模型
+    :type ext_scorer: NgramScorer
+    """
+
+    def __init__(self, vocab_size, ext_scorer=None):
+        self.vocab_size = vocab_size
+        self.ext_scorer = ext_scorer
+        self.reset()
+
+    def reset(self):
+        # 前缀树，0为空前缀
+        self.node_parents = array('q', [-1])
+        self.node_tokens = array('q', [-1])
+        self.lm_states = [self.ext_scorer.start_state() if self.ext_scorer is not None else None]
+        # (父节点, 字符) -> 子节点，前缀离开集束之后再次出现时使用原来的节点，才能和集束中它的扩展合并
+        self.children = {}
+        self.max_nodes = MIN_COMPACT_NODES
+        # 当前的集束，按得分从大到小排列
+        self.nodes = np.zeros(1, dtype=np.int64)
+        self.parents = np.full(1, -1, dtype=np.int64)
+        self.last = np.full(1, -1, dtype=np.int64)
+        self.log_prob_b = np.zeros(1, dtype=np.float64)
+        self.log_prob_nb = np.full(1, -np.inf, dtype=np.float64)
+        self.lm_scores = np.zeros(1, dtype=np.float64)
+
+    def _lm_scores(self, beam_indexes, tokens):
+        new_scores = np.empty(len(tokens), dtype=np.float64)
+        new_states = []
+        for i, (b, token) in enumerate(zip(beam_indexes.tolist(), tokens.tolist())):
+            score, lm_state = self.ext_scorer.score(self.lm_states[self.nodes[b]], token)
+            new_scores[i] = score
+            new_states.append(lm_state)
+        return new_scores, new_states
+
+    def step(self, probs, beam_size, cutoff_prob=1.0, cutoff_top_n=40, blank_id=0):
+        """处理一帧的概率
+
+        :param probs: 一帧的概率，形状为(vocab_size,)
+        :type probs: numpy.ndarray
+        """
+        probs = np.asarray(probs, dtype=np.float64)
+        candidates = pruned_candidates(probs, cutoff_prob, cutoff_top_n)
+        with np.errstate(divide='ignore'):
+            log_probs = np.log(probs)
+        in_candidates = np.zeros(self.vocab_size, dtype=bool)
+        in_candidates[candidates] = True
+        total = np.logaddexp(self.log_prob_b, self.log_prob_nb)
+        # 前缀不变：后面接空白，或者重复最后一个字符
+        if in_candidates[blank_id]:
+            stay_b = total + log_probs[blank_id]
+        else:
+            stay_b = np.full(len(total), -np.inf)
+        last = np.maximum(self.last, 0)
+        stay_nb = np.where((self.last >= 0) & in_candidates[last], self.log_prob_nb + log_probs[last], -np.inf)
+
+        # 前缀增加一个非空白字符，和最后一个字符相同时只能从空白结尾的路径扩展
+        tokens = candidates[candidates != blank_id]
+        ext_beams = np.zeros(0, dtype=np.int64)
+        ext_tokens = np.zeros(0, dtype=np.int64)
+        ext_nb = np.zeros(0, dtype=np.float64)
+        if len(tokens) > 0:
+            ext = np.where(tokens[np.newaxis, :] == self.last[:, np.newaxis],
+                           self.log_prob_b[:, np.newaxis], total[:, np.newaxis]) + log_probs[tokens][np.newaxis, :]
+            # 扩展之后的前缀已经在集束中时合并概率
+            beam_keys = self.parents * self.vocab_size + self.last
+            ext_keys = self.nodes[:, np.newaxis] * self.vocab_size + tokens[np.newaxis, :]
+            sorter = np.argsort(beam_keys)
+            pos = np.minimum(np.searchsorted(beam_keys[sorter], ext_keys), len(sorter) - 1)
+            matched = (beam_keys[sorter][pos] == ext_keys) & np.isfinite(ext)
+            if matched.any():
+                np.logaddexp.at(stay_nb, sorter[pos[matched]], ext[matched])
+            ext_beams, token_indexes = np.nonzero(~matched & np.isfinite(ext))
+            ext_tokens = tokens[token_indexes]
+            ext_nb = ext[ext_beams, token_indexes]
+
+        stay_scores = np.logaddexp(stay_b, stay_nb) + self.lm_scores
+        # 语言模型的得分不会大于beta，上界都进不了集束的扩展不需要计算语言模型
+        ext_lm = self.lm_scores[ext_beams]
+        ext_states = None
+        if self.ext_scorer is not None and len(ext_beams) > 0:
+            if len(stay_scores) >= beam_size:
+                threshold = np.partition(stay_scores, len(stay_scores) - beam_size)[len(stay_scores) - beam_size]
+                keep = ext_nb + ext_lm + max(self.ext_scorer.beta, 0.0) >= threshold
+                ext_beams, ext_tokens, ext_nb, ext_lm = ext_beams[keep], ext_tokens[keep], ext_nb[keep], ext_lm[keep]
+            lm_scores, ext_states = self._lm_scores(ext_beams, ext_tokens)
+            ext_lm = ext_lm + lm_scores
+        ext_scores = ext_nb + ext_lm
+
+        # 选出得分最大的beam_size个前缀
+        scores = np.concatenate([stay_scores, ext_scores])
+        valid = np.nonzero(np.isfinite(scores))[0]
+        # 这一帧全部路径的概率都为0时跳过这一帧
+        if len(valid) == 0: return
+        if len(valid) > beam_size:
+            valid = valid[np.argpartition(-scores[valid], beam_size - 1)[:beam_size]]
+        selected = valid[np.argsort(-scores[valid], kind='stable')]
+        num_stay = len(stay_scores)
+        is_stay = selected < num_stay
+        stay_idx = np.where(is_stay, selected, 0)
+        ext_idx = np.where(is_stay, 0, selected - num_stay)
+
+        # 为新的前缀创建前缀树节点
+        nodes = np.where(is_stay, self.nodes[stay_idx], 0)
+        for i in np.nonzero(~is_stay)[0].tolist():
+            e = int(ext_idx[i])
+            key = (int(self.nodes[ext_beams[e]]), int(ext_tokens[e]))
+            node = self.children.get(key)
+            if node is None:
+                node = len(self.node_parents)
+                self.children[key] = node
+                self.node_parents.append(key[0])
+                self.node_tokens.append(key[1])
+                self.lm_states.append(ext_states[e] if ext_states is not None else None)
+            nodes[i] = node
+        if len(ext_beams) > 0:
+            self.parents = np.where(is_stay, self.parents[stay_idx], self.nodes[ext_beams[ext_idx]])
+            self.last = np.where(is_stay, self.last[stay_idx], ext_tokens[ext_idx])
+            self.log_prob_b = np.where(is_stay, stay_b[stay_idx], -np.inf)
+            self.log_prob_nb = np.where(is_stay, stay_nb[stay_idx], ext_nb[ext_idx])
+            self.lm_scores = np.where(is_stay, self.lm_scores[stay_idx], ext_lm[ext_idx])
+        else:
+            self.parents = self.parents[stay_idx]
+            self.last = self.last[stay_idx]
+            self.log_prob_b = stay_b[stay_idx]
+            self.log_prob_nb = stay_nb[stay_idx]
+            self.lm_scores = self.lm_scores[stay_idx]
+        self.nodes = nodes
+        if len(self.node_parents) > self.max_nodes:
+            self._compact()
+
+    def _compact(self):
+        """删除不是当前集束前缀的节点，并重新编号剩下的节点"""
+        node_parents = np.frombuffer(self.node_parents, dtype=np.int64)
+        keep = np.zeros(len(node_parents), dtype=bool)
+        keep[0] = True
+        frontier = np.unique(self.nodes)
+        while len(frontier) > 0:
+            keep[frontier] = True
+            frontier = np.unique(node_parents[frontier])
+            frontier = frontier[(frontier >= 0) & ~keep[np.maximum(frontier, 0)]]
+        old_ids = np.nonzero(keep)[0]
+        new_ids = np.cumsum(keep) - 1
+        parents = node_parents[old_ids]
+        parents = np.where(parents >= 0, new_ids[np.maximum(parents, 0)], -1)
+        tokens = np.frombuffer(self.node_tokens, dtype=np.int64)[old_ids]
+        self.node_parents = array('q', parents.tolist())
+        self.node_tokens = array('q', tokens.tolist())
+        self.lm_states = [self.lm_states[i] for i in old_ids.tolist()]
+        self.children = {(p, t): i for i, (p, t) in enumerate(zip(parents.tolist(), tokens.tolist())) if i > 0}
+        self.nodes = new_ids[self.nodes]
+        self.parents = np.where(self.parents >= 0, new_ids[np.maximum(self.parents, 0)], -1)
+        # 保留的节点越多下一次整理前允许的节点越多，整理的时间平均到每一帧是常数
+        self.max_nodes = max(2 * len(self.node_parents), MIN_COMPACT_NODES)
+
+    def get_tokens(self, node):
+        tokens = []
+        while node > 0:
+            tokens.append(self.node_tokens[node])
+            node = self.node_parents[node]
+        return tokens[::-1]
+
+    def results(self, vocabulary, beam_size):
+        """当前集束的解码结果
+
+        :return: 解码结果为CTC的log概率和句子的元组列表，按包括语言模型的得分降序排列
+        :rtype: list
+        """
+        ctc_scores = np.logaddexp(self.log_prob_b, self.log_prob_nb)
+        scores = ctc_scores + self.lm_scores
+        if self.ext_scorer is not None:
+            scores = scores + np.array([self.ext_scorer.final_score(self.lm_states[n]) for n in self.nodes.tolist()])
+        results = []
+        for b in np.argsort(-scores, kind='stable')[:beam_size].tolist():
+            text = ''.join(vocabulary[t].replace('<space>', ' ') for t in self.get_tokens(int(self.nodes[b])))
+            results.append((float(ctc_scores[b]), text))
+        return results
+
+
+def ctc_beam_search_decoding(probs_seq,
+                             vocabulary,
+                             beam_size,
+                             cutoff_prob=1.0,
+                             cutoff_top_n=40,
+                             blank_id=0,
+                             ext_scoring_func=None):
+    """NumPy实现的CTC前缀集束搜索解码器，参数和swig_wrapper.ctc_beam_search_decoding()相同
+
+    :param probs_seq: 2D的概率表，形状为(T, vocab_size)
+    :type probs_seq: numpy.ndarray
+    :param vocabulary: 词汇列表
+    :type vocabulary: list
+    :param beam_size: 集束搜索宽度
+    :type beam_size: int
+    :param cutoff_prob: 剪枝中的截断概率，默认1.0，没有剪枝
+    :type cutoff_prob: float
+    :param cutoff_top_n: 剪枝时的截断数，仅在词汇表中具有最大probs的cutoff_top_n字符用于光束搜索，默认为40
+    :type cutoff_top_n: int
+    :param blank_id 空白索引
+    :type blank_id int
+    :param ext_scoring_func: 外部评分，NgramScorer的实例
+    :type ext_scoring_func: NgramScorer
+    :return: 解码结果为log概率和句子的元组列表，按概率降序排列
+    :rtype: list
+    """
+    probs_seq = np.asarray(probs_seq)
+    state = PrefixBeamState(vocab_size=probs_seq.shape[1], ext_scorer=ext_scoring_func)
+    for probs in probs_seq:
+        state.step(probs, beam_size, cutoff_prob=cutoff_prob, cutoff_top_n=cutoff_top_n, blank_id=blank_id)
+    return state.results(vocabulary, beam_size)
+
+
+def ctc_beam_search_decoding_batch(probs_split,
+                                   vocabulary,
+                                   beam_size,
+                                   num_processes,
+                                   cutoff_prob=1.0,
+                                   cutoff_top_n=40,
+                                   blank_id=0,
+                                   ext_scoring_func=None):
+    """NumPy实现的批量CTC前缀集束搜索解码器，参数和swig_wrapper.ctc_beam_search_decoding_batch()相同，
+    语言模型不能在进程之间共享，num_processes不起作用，逐条解码
+
+    :return: 解码结果为log概率和句子的元组列表，按概率降序排列的列表
+    :rtype: list
+    """
+    return [ctc_beam_search_decoding(probs_seq, vocabulary, beam_size, cutoff_prob=cutoff_prob,
+                                     cutoff_top_n=cutoff_top_n, blank_id=blank_id,
+                                     ext_scoring_func=ext_scoring_func)
+            for probs_seq in probs_split]
+
+
+class CTCBeamSearchDecoder(object):
+    """NumPy实现的流式CTC前缀集束搜索解码器，接口和swig_wrapper.CTCBeamSearchDecoder相同
+
+    Args:
+        vocab_list (list): 词汇列表
+        batch_size (int): 同时解码的音频数量
+        beam_size (int): 集束搜索宽度
+        num_processes (int): 并行解码进程数，不起作用
+        cutoff_prob (float): 剪枝中的截断概率，默认1.0，没有剪枝
+        cutoff_top_n (int): 剪枝时的截断数，仅在词汇表中具有最大probs的cutoff_top_n字符用于光束搜索，默认为40
+        _ext_scorer (NgramScorer): 外部评分，为None时不使用语言模型
+        blank_id (int): 空白索引
+    """
+
+    def __init__(self, vocab_list, batch_size, beam_size, num_processes,
+                 cutoff_prob, cutoff_top_n, _ext_scorer, blank_id):
+        self.vocab_list = vocab_list
+        self.ext_scorer = _ext_scorer
+        self.blank_id = blank_id
+        # 上一个数据块的最后一帧是否为空白帧，流式解码跳过空白帧时使用
+        self.last_frame_blank = False
+        self.reset_state(batch_size, beam_size, num_processes, cutoff_prob, cutoff_top_n)
+
+    def reset_state(self, batch_size, beam_size, num_processes, cutoff_prob, cutoff_top_n):
+        self.beam_size = beam_size
+        self.cutoff_prob = cutoff_prob
+        self.cutoff_top_n = cutoff_top_n
+        self.states = [PrefixBeamState(vocab_size=len(self.vocab_list), ext_scorer=self.ext_scorer)
+                       for _ in range(batch_size)]
+
+    def next(self, probs_split, has_value):
+        """解码每条音频新的一段概率
+
+        :param probs_split: 每条音频新的2D概率表列表
+        :param has_value: 每条音频是否有新的数据，值为"true"或者"false"
+        """
+        for state, probs, value in zip(self.states, probs_split, has_value):
+            if value != 'true': continue
+            for frame in np.asarray(probs):
+                state.step(frame, self.beam_size, cutoff_prob=self.cutoff_prob,
+                           cutoff_top_n=self.cutoff_top_n, blank_id=self.blank_id)
+
+    def decode(self):
+        """当前每条音频的解码结果
+
+        :return: 每条音频的解码结果列表，解码结果为log概率和句子的元组列表
+        :rtype: list
+        """
+        return [state.results(self.vocab_list, self.beam_size) for state in self.states]
@@ -1,3 +1,4 @@
+import numpy as np
 import paddlespeech_ctcdecoders
 
 
@@ -18,6 +19,41 @@ class Scorer(paddlespeech_ctcdecoders.Scorer):
         paddlespeech_ctcdecoders.Scorer.__init__(self, alpha, beta, model_path, vocabulary)
 
 
+# 词汇表大小至少是cutoff_top_n的这个倍数时，只转换每一帧概率最大的cutoff_top_n个值，否则转换全部的值更快
+SPARSE_INPUT_RATIO = 8
+
+
+def to_decoder_input(probs_seq, cutoff_top_n=None):
+    """把2D的概率表转换为解码器的输入
+
+    paddlespeech_ctcdecoders的SWIG接口参数为std::vector<std::vector<double>>，只能接收Python列表，
+    不能接收NumPy数组或者其他实现了缓冲区协议的对象。集束搜索每一帧只使用概率最大的cutoff_top_n个值，
+    所以其他位置可以共用同一个0.0，不需要为每个值创建Python浮点数，解码结果和转换全部的值相同
+
+    :param probs_seq: 2D的概率表，形状为(T, vocab_size)
+    :type probs_seq: numpy.ndarray
+    :param cutoff_top_n: 解码器剪枝时的截断数，为None时转换全部的值，贪婪解码不剪枝，不能指定
+    :type cutoff_top_n: int
+    :return: 解码器的输入
+    :rtype: list
+    """
+    if isinstance(probs_seq, list):
+        return probs_seq
+    probs_seq = np.asarray(probs_seq)
+    if cutoff_top_n is None or len(probs_seq) == 0 or probs_seq.shape[1] < cutoff_top_n * SPARSE_INPUT_RATIO:
+        return probs_seq.tolist()
+    top_indexes = np.argpartition(probs_seq, -cutoff_top_n, axis=1)[:, -cutoff_top_n:]
+    top_probs = np.take_along_axis(probs_seq, top_indexes, axis=1).tolist()
+    zeros = [0.0] * probs_seq.shape[1]
+    results = []
+    for indexes, probs in zip(top_indexes.tolist(), top_probs):
+        row = zeros[:]
+        for index, prob in zip(indexes, probs):
+            row[index] = prob
+        results.append(row)
+    return results
+
+
 def ctc_greedy_decoding(probs_seq, vocabulary, blank_id):
     """CTC贪婪(最佳路径)解码器
 
@@ -28,7 +64,7 @@ def ctc_greedy_decoding(probs_seq, vocabulary, blank_id):
     :return:解码结果
     :rtype: str
     """
-    result = paddlespeech_ctcdecoders.ctc_greedy_decoding(probs_seq.tolist(), vocabulary, blank_id)
+    result = paddlespeech_ctcdecoders.ctc_greedy_decoding(to_decoder_input(probs_seq), vocabulary, blank_id)
     return result
 
 
@@ -59,7 +95,8 @@ def ctc_beam_search_decoding(probs_seq,
     :rtype: list
     """
     beam_results = paddlespeech_ctcdecoders.ctc_beam_search_decoding(
-        probs_seq.tolist(), vocabulary, beam_size, cutoff_prob, cutoff_top_n, ext_scoring_func, blank_id)
+        to_decoder_input(probs_seq, cutoff_top_n=cutoff_top_n), vocabulary, beam_size, cutoff_prob, cutoff_top_n,
+        ext_scoring_func, blank_id)
     beam_results = [(res[0], res[1]) for res in beam_results]
     return beam_results
 
@@ -93,7 +130,7 @@ def ctc_beam_search_decoding_batch(probs_split,
     :return: 解码结果为log概率和句子的元组列表，按概率降序排列的列表
     :rtype: list
     """
-    probs_split = [probs_seq.tolist() for probs_seq in probs_split]
+    probs_split = [to_decoder_input(probs_seq, cutoff_top_n=cutoff_top_n) for probs_seq in probs_split]
 
     batch_beam_results = paddlespeech_ctcdecoders.ctc_beam_search_decoding_batch(
         probs_split, vocabulary, beam_size, num_processes, cutoff_prob,
@@ -119,3 +156,5 @@ class CTCBeamSearchDecoder(paddlespeech_ctcdecoders.CtcBeamSearchDecoderBatch):
         paddlespeech_ctcdecoders.CtcBeamSearchDecoderBatch.__init__(
             self, vocab_list, batch_size, beam_size, num_processes, cutoff_prob,
             cutoff_top_n, _ext_scorer, blank_id)
+        # 上一个数据块的最后一帧是否为空白帧，流式解码跳过空白帧时使用
+        self.last_frame_blank = False
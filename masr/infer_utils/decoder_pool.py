@@ -0,0 +1,115 @@
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from masr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# 每个解码进程独立的集束搜索解码器
+_process_decoder = None
+
+
+def _init_process_decoder(vocab_list, decoder_conf):
+    global _process_decoder
+    from masr.decoders.beam_search_decoder import BeamSearchDecoder
+    _process_decoder = BeamSearchDecoder(vocab_list=vocab_list, **decoder_conf)
+
+
+def _decode_beam_search(output_data):
+    return _process_decoder.decode_beam_search_offline(probs_split=output_data)
+
+
+def _decode_shared_batch(shm_name, shape, dtype, rows, lens):
+    # 直接读取共享内存中的模型输出，不需要序列化整个批次
+    shm = shared_memory.SharedMemory(name=shm_name)
+    probs = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # 只复制这个进程需要的行，复制之后就可以释放共享内存
+    rows_probs = [np.array(probs[r, :l]) for r, l in zip(rows, lens)]
+    del probs
+    shm.close()
+    return [_process_decoder.decode_beam_search_offline(probs_split=p, return_nbest=True) for p in rows_probs]
+
+
+class DecoderPool:
+    def __init__(self, vocab_list, decoder_conf, num_processes=2):
+        """
+        集束搜索解码进程池，每个进程加载一份语言模型，解码不会占用推理线程的GIL
+        :param vocab_list: 词汇列表
+        :param decoder_conf: 集束搜索解码器的参数，即配置文件中的ctc_beam_search_decoder_conf
+        :param num_processes: 解码进程的数量
+        """
+        self.num_processes = num_processes
+        # 使用spawn启动进程，避免在已经加载模型和创建线程的进程中fork
+        self.executor = ProcessPoolExecutor(max_workers=num_processes,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_process_decoder,
+                                            initargs=(list(vocab_list), dict(decoder_conf)))
+        logger.info(f'已创建集束搜索解码进程池，进程数量：{num_processes}')
+
+    def submit(self, output_data):
+        """
+        提交一条音频的模型输出进行解码
+        :param output_data: 模型输出结果，形状为(T, vocab_size)
+        :return: concurrent.futures.Future，结果为解码的得分和文本
+        """
+        return self.executor.submit(_decode_beam_search, output_data)
+
+    def submit_batch(self, output_datas, output_lens=None):
+        """
+        提交一个批次的模型输出进行解码，批次写入共享内存之后按行分给全部解码进程，不会阻塞调用的线程
+        :param output_datas: 模型输出结果，形状为(B, T, vocab_size)的数组，或者是每个形状为(T, vocab_size)的列表
+        :param output_lens: 每条音频模型输出的长度，为None时使用全部的帧
+        :return: concurrent.futures.Future，结果为每条音频的n-best列表，每个元素为解码的得分和文本，按得分降序排列
+        """
+        if isinstance(output_datas, np.ndarray):
+            probs = np.ascontiguousarray(output_datas, dtype=np.float32)
+            if output_lens is None:
+                output_lens = [probs.shape[1]] * probs.shape[0]
+        else:
+            output_lens = [len(o) for o in output_datas] if output_lens is None else output_lens
+            probs = np.zeros((len(output_datas), max(output_lens, default=0), output_datas[0].shape[-1]),
+                             dtype=np.float32)
+            for i, o in enumerate(output_datas):
+                probs[i, :len(o)] = o
+        output_lens = [int(l) for l in output_lens]
+        result_future = Future()
+        batch_size = probs.shape[0]
+        if batch_size == 0:
+            result_future.set_result([])
+            return result_future
+        shm = shared_memory.SharedMemory(create=True, size=max(probs.nbytes, 1))
+        np.ndarray(probs.shape, dtype=probs.dtype, buffer=shm.buf)[:] = probs
+        # 按行平均分给每个解码进程
+        num_splits = min(self.num_processes, batch_size)
+        splits = [list(r) for r in np.array_split(np.arange(batch_size), num_splits)]
+        results = [None] * num_splits
+        state = {'remained': num_splits, 'error': None}
+        lock = threading.Lock()
+
+        def on_done(i, future):
+            with lock:
+                if future.exception() is not None:
+                    state['error'] = future.exception()
+                else:
+                    results[i] = future.result()
+                state['remained'] -= 1
+                if state['remained'] > 0: return
+            shm.close()
+            shm.unlink()
+            if state['error'] is not None:
+                result_future.set_exception(state['error'])
+            else:
+                result_future.set_result([nbest for split_results in results for nbest in split_results])
+
+        for i, rows in enumerate(splits):
+            future = self.executor.submit(_decode_shared_batch, shm.name, probs.shape, probs.dtype.str,
+                                          rows, [output_lens[r] for r in rows])
+            future.add_done_callback(lambda f, i=i: on_done(i, f))
+        return result_future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
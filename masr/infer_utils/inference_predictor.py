@@ -1,6 +1,9 @@
 import os
+
+import numpy as np
 import torch
 
+from masr.infer_utils.stream_session import StreamSession
 from masr.utils.logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -12,18 +15,30 @@ class InferencePredictor:
                  use_model,
                  streaming=True,
                  model_path='models/conformer_streaming_fbank/inference.pt',
-                 use_gpu=True):
+                 use_gpu=True,
+                 output_type='probs',
+                 top_k=40,
+                 blank_index=0):
         """
         语音识别预测工具
         :param configs: 配置参数
         :param use_model: 使用模型的名称
         :param model_path: 导出的预测模型文件夹路径
         :param use_gpu: 是否使用GPU预测
+        :param output_type: 模型输出的传输方式，probs为传输完整的概率，
+                            greedy为在模型所在设备上完成贪心解码，只传输索引和得分，
+                            topk为只传输每帧最大的top_k个概率和空白概率，在CPU上恢复成完整形状的概率
+        :param top_k: output_type为topk时每帧传输的概率数量，不能小于集束搜索的cutoff_top_n
+        :param blank_index: 空白索引
         """
+        assert output_type in ['probs', 'greedy', 'topk'], f'不支持该输出类型：{output_type}'
         self.configs = configs
         self.use_gpu = use_gpu
         self.use_model = use_model
         self.streaming = streaming
+        self.output_type = output_type
+        self.top_k = top_k
+        self.blank_index = blank_index
         # 创建模型
         if not os.path.exists(model_path):
             raise Exception(f"模型文件不存在，请检查{model_path}是否存在！")
@@ -41,12 +56,14 @@ class InferencePredictor:
         self.predictor.eval()
         logger.info(f'已加载模型：{model_path}')
 
-        # 流式参数
-        self.output_state_h = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.output_state_c = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.cnn_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.att_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.offset = torch.tensor([0], dtype=torch.int32, device=self.device)
+        # 默认的流式识别会话，没有指定会话时使用
+        self.stream_session = StreamSession(device=self.device)
+        # 多个会话批量流式预测时，同一批次内填充的缓存长度必须是该值的整数倍，squeezeformer有时间降采样层
+        self.cache_align = 1
+        if self.use_model == 'squeezeformer':
+            reduce_idx = self.configs.encoder_conf.get('reduce_idx', 5)
+            if reduce_idx is not None:
+                self.cache_align = 2 ** (1 if isinstance(reduce_idx, int) else len(reduce_idx))
 
     # 预测音频
     def predict(self, speech, speech_lengths):
@@ -61,42 +78,239 @@ class InferencePredictor:
 
         # 非流式模型的输入
         output_data = self.predictor.get_encoder_out(speech=audio_data, speech_lengths=audio_len)
-        return output_data.cpu().detach().numpy()
+        return self._convert_outputs(output_data)
+
+    def predict_batch(self, speeches):
+        """
+        批量预测函数，多条音频补齐到相同长度之后只执行一次模型
+        :param speeches: 经过处理的音频数据列表，每个形状为(T, D)
+        :return: 每条音频去掉补齐部分之后的模型输出列表，输出的格式由output_type决定
+        """
+        # 旧版本导出的模型没有批量预测方法，逐条执行
+        if not hasattr(self.predictor, 'get_encoder_out_batch'):
+            return [self.predict(speech[np.newaxis, :], np.array([speech.shape[0]]))[0] for speech in speeches]
+        # deepspeech2的RNN要求长度从大到小排序
+        sorted_indexes = sorted(range(len(speeches)), key=lambda i: speeches[i].shape[0], reverse=True)
+        max_len = speeches[sorted_indexes[0]].shape[0]
+        feature_dim = speeches[sorted_indexes[0]].shape[1]
+        inputs = np.zeros((len(speeches), max_len, feature_dim), dtype=np.float32)
+        input_lens = np.zeros(len(speeches), dtype=np.int64)
+        for b, i in enumerate(sorted_indexes):
+            inputs[b, :speeches[i].shape[0], :] = speeches[i]
+            input_lens[b] = speeches[i].shape[0]
+        audio_data = torch.tensor(inputs, dtype=torch.float32, device=self.device)
+        audio_len = torch.tensor(input_lens, dtype=torch.int64, device=self.device)
 
-    def predict_chunk_deepspeech(self, x_chunk):
+        output_data, output_lens = self.predictor.get_encoder_out_batch(speech=audio_data, speech_lengths=audio_len)
+        batch_outputs = self._convert_outputs(output_data, output_lens)
+        outputs = [None] * len(speeches)
+        for b, i in enumerate(sorted_indexes):
+            outputs[i] = batch_outputs[b]
+        return outputs
+
+    def _convert_outputs(self, output_data, output_lens=None):
+        """
+        把完整音频的模型输出转换为需要的格式再传输到CPU，补齐的部分会被去掉
+        :param output_data: 模型输出的概率，形状为(B, T, vocab_size)
+        :param output_lens: 每条音频输出的长度，为None时全部有效
+        :return: 每条音频的输出列表，output_type为greedy时为得分和索引的元组，否则为形状(T, vocab_size)的概率
+        """
+        output_data = output_data.detach()
+        batch_size, max_len = output_data.shape[0], output_data.shape[1]
+        if output_lens is None:
+            output_lens = torch.full([batch_size], max_len, dtype=torch.int64, device=output_data.device)
+        if self.output_type == 'greedy':
+            max_prob, max_index = output_data.max(dim=-1)
+            valid = torch.arange(max_len, device=output_data.device).unsqueeze(0) < output_lens.unsqueeze(1)
+            non_blank = (max_index != self.blank_index) & valid
+            # 和前一帧索引不同的非空白帧才输出
+            prev_index = torch.nn.functional.pad(max_index[:, :-1], [1, 0], value=-1)
+            emit = non_blank & (max_index != prev_index)
+            num_non_blank = non_blank.sum(dim=1)
+            scores = (max_prob * non_blank).sum(dim=1) / num_non_blank.clamp(min=1) * 100.0
+            scores, max_index, emit = scores.cpu().numpy(), max_index.cpu().numpy(), emit.cpu().numpy()
+            return [(float(scores[b]), max_index[b][emit[b]].tolist()) for b in range(batch_size)]
+        output_lens = output_lens.cpu().numpy()
+        output_data = self._transfer_probs(output_data)
+        return [output_data[b, :output_lens[b]] for b in range(batch_size)]
+
+    def _convert_chunk_outputs(self, output_data):
+        """
+        把流式数据块的模型输出转换为需要的格式再传输到CPU
+        :param output_data: 模型输出的概率，形状为(B, T, vocab_size)
+        :return: output_type为greedy时为每帧最大索引和最大概率的元组，形状都为(B, T)，否则为形状(B, T, vocab_size)的概率
+        """
+        output_data = output_data.detach()
+        if self.output_type == 'greedy':
+            max_prob, max_index = output_data.max(dim=-1)
+            return max_index.cpu().numpy(), max_prob.cpu().numpy()
+        return self._transfer_probs(output_data)
+
+    def _transfer_probs(self, output_data):
+        """把概率传输到CPU，output_type为topk时只传输每帧最大的top_k个概率和空白概率"""
+        vocab_size = output_data.shape[-1]
+        if self.output_type != 'topk' or self.top_k >= vocab_size - 1:
+            return output_data.cpu().numpy()
+        top_probs, top_indexes = output_data.topk(self.top_k, dim=-1)
+        blank_probs = output_data[..., self.blank_index]
+        top_probs, top_indexes = top_probs.cpu().numpy(), top_indexes.cpu().numpy()
+        # 其他的概率都设置为0，集束搜索剪枝之后只会使用最大的cutoff_top_n个概率，解码结果不变
+        probs = np.zeros(output_data.shape, dtype=top_probs.dtype)
+        np.put_along_axis(probs, top_indexes, top_probs, axis=-1)
+        probs[..., self.blank_index] = blank_probs.cpu().numpy()
+        return probs
+
+    def predict_chunk_deepspeech(self, x_chunk, session=None):
+        """
+        deepspeech2模型的流式预测
+        :param x_chunk: 经过处理的音频数据块
+        :param session: 流式识别会话，为None时使用默认会话
+        :return: 模型输出和长度，模型输出的格式由output_type决定
+        """
         if not (self.use_model == 'deepspeech2' and self.streaming):
             raise Exception(f'当前模型不支持该方法，当前模型为：{self.use_model}，参数streaming为：{self.streaming}')
+        if session is None:
+            session = self.stream_session
 
         x_chunk = torch.tensor(x_chunk, dtype=torch.float32, device=self.device)
         audio_len = torch.tensor([x_chunk.shape[1]], dtype=torch.int64, device=self.device)
 
-        output_chunk_probs, output_lens, self.output_state_h, self.output_state_c = \
+        output_chunk_probs, output_lens, session.output_state_h, session.output_state_c = \
             self.predictor.get_encoder_out_chunk(speech=x_chunk,
                                                  speech_lengths=audio_len,
-                                                 init_state_h=self.output_state_h,
-                                                 init_state_c=self.output_state_c)
-        return output_chunk_probs.cpu().detach().numpy(), output_lens.cpu().detach().numpy()
+                                                 init_state_h=session.output_state_h,
+                                                 init_state_c=session.output_state_c)
+        return self._convert_chunk_outputs(output_chunk_probs), output_lens.cpu().detach().numpy()
 
-    def predict_chunk_conformer(self, x_chunk, required_cache_size):
+    def predict_chunk_conformer(self, x_chunk, required_cache_size, session=None):
+        """
+        conformer类模型的流式预测
+        :param x_chunk: 经过处理的音频数据块
+        :param required_cache_size: 下一个数据块需要的缓存大小，小于0为使用全部缓存
+        :param session: 流式识别会话，为None时使用默认会话
+        :return: 模型输出，格式由output_type决定
+        """
         if not ('former' in self.use_model and self.streaming):
             raise Exception(f'当前模型不支持该方法，当前模型为：{self.use_model}，参数streaming为：{self.streaming}')
+        if session is None:
+            session = self.stream_session
+        # 限制了缓存大小时使用固定形状的缓存，每个数据块的计算量和内存保持不变
+        if required_cache_size > 0 and hasattr(self.predictor, 'get_encoder_out_chunk_batch'):
+            return self.predict_chunk_conformer_batch([x_chunk], required_cache_size, [session])[0]
         x_chunk = torch.tensor(x_chunk, dtype=torch.float32, device=self.device)
         required_cache_size = torch.tensor([required_cache_size], dtype=torch.int32, device=self.device)
 
-        output_chunk_probs, self.att_cache, self.cnn_cache = \
+        output_chunk_probs, session.att_cache, session.cnn_cache = \
             self.predictor.get_encoder_out_chunk(speech=x_chunk,
-                                                 offset=self.offset,
+                                                 offset=session.offset,
                                                  required_cache_size=required_cache_size,
-                                                 att_cache=self.att_cache,
-                                                 cnn_cache=self.cnn_cache)
+                                                 att_cache=session.att_cache,
+                                                 cnn_cache=session.cnn_cache)
+
+        session.offset += output_chunk_probs.shape[1]
+        session.att_cache_len = session.att_cache.size(2)
+        return self._convert_chunk_outputs(output_chunk_probs)
+
+    def predict_chunk_conformer_batch(self, x_chunks, required_cache_size, sessions):
+        """
+        conformer类模型多个会话的批量流式预测，数据块长度相同的会话合并成一个批次执行一次模型
+        :param x_chunks: 每个会话经过处理的音频数据块列表，每个形状为(1, T, D)
+        :param required_cache_size: 下一个数据块需要的缓存大小，小于0为使用全部缓存，
+                                    大于0时每个会话使用该长度的固定形状缓存
+        :param sessions: 每个数据块对应的流式识别会话列表
+        :return: 每个会话模型输出的列表，格式由output_type决定
+        """
+        if not ('former' in self.use_model and self.streaming):
+            raise Exception(f'当前模型不支持该方法，当前模型为：{self.use_model}，参数streaming为：{self.streaming}')
+        assert len(x_chunks) == len(sessions), '数据块数量和会话数量不一致'
+        outputs = [None] * len(x_chunks)
+        # 旧版本导出的模型和efficient_conformer不支持批量流式预测，逐个会话执行
+        if not hasattr(self.predictor, 'get_encoder_out_chunk_batch'):
+            for i, (x_chunk, session) in enumerate(zip(x_chunks, sessions)):
+                outputs[i] = self.predict_chunk_conformer(x_chunk, required_cache_size, session=session)
+            return outputs
+        fixed_cache = required_cache_size > 0
+        # 会话修改了数据块大小之后，缓存大小可能比需要的大，只使用最后需要的部分
+        cache_lens = [min(s.att_cache_len, required_cache_size) if fixed_cache else s.att_cache_len
+                      for s in sessions]
+        # 按数据块长度分组，同一组才能拼接成一个批次
+        groups = {}
+        for i, x_chunk in enumerate(x_chunks):
+            key = (x_chunk.shape[1], cache_lens[i] % self.cache_align)
+            groups.setdefault(key, []).append(i)
+        for indexes in groups.values():
+            if len(indexes) == 1 and not fixed_cache:
+                i = indexes[0]
+                outputs[i] = self.predict_chunk_conformer(x_chunks[i], required_cache_size, session=sessions[i])
+                continue
+            group_sessions = [sessions[i] for i in indexes]
+            x_batch = torch.tensor(np.concatenate([x_chunks[i] for i in indexes], axis=0),
+                                   dtype=torch.float32, device=self.device)
+            offsets = torch.cat([s.offset for s in group_sessions], dim=0)
+            group_cache_lens = [cache_lens[i] for i in indexes]
+            cache_t = required_cache_size if fixed_cache else max(group_cache_lens)
+            att_cache, cnn_cache = self._stack_stream_cache(group_sessions, group_cache_lens, cache_t)
+            att_cache_lens = torch.tensor(group_cache_lens, dtype=torch.int32, device=self.device)
 
-        self.offset += output_chunk_probs.shape[1]
-        return output_chunk_probs.cpu().detach().numpy()
+            output_chunk_probs, new_att_cache, new_cnn_cache = \
+                self.predictor.get_encoder_out_chunk_batch(speech=x_batch,
+                                                           offsets=offsets,
+                                                           required_cache_size=required_cache_size,
+                                                           att_cache=att_cache,
+                                                           att_cache_lens=att_cache_lens,
+                                                           cnn_cache=cnn_cache)
+            chunk_len = output_chunk_probs.shape[1]
+            chunk_outputs = self._convert_chunk_outputs(output_chunk_probs)
+            # 把批次结果拆分回每个会话，只保留每个会话真实的缓存
+            for b, (i, session) in enumerate(zip(indexes, group_sessions)):
+                keep_len = group_cache_lens[b] + chunk_len
+                if required_cache_size >= 0:
+                    keep_len = min(keep_len, required_cache_size)
+                new_cache = new_att_cache[:, b, :, new_att_cache.size(3) - keep_len:, :]
+                if fixed_cache:
+                    # 写入会话预先分配的固定形状缓存，缓存前面没有数据的部分由att_cache_lens屏蔽
+                    if session.att_cache.size(2) != required_cache_size:
+                        session.att_cache = torch.zeros([new_cache.size(0), new_cache.size(1), required_cache_size,
+                                                         new_cache.size(3)], dtype=torch.float32, device=self.device)
+                        session.cnn_cache = torch.zeros_like(new_cnn_cache[:, b:b + 1])
+                    session.att_cache[:, :, required_cache_size - keep_len:, :] = new_cache
+                    session.cnn_cache.copy_(new_cnn_cache[:, b:b + 1])
+                else:
+                    session.att_cache = new_cache.contiguous()
+                    session.cnn_cache = new_cnn_cache[:, b:b + 1].contiguous()
+                session.att_cache_len = keep_len
+                session.offset = session.offset + chunk_len
+                if isinstance(chunk_outputs, tuple):
+                    outputs[i] = (chunk_outputs[0][b:b + 1], chunk_outputs[1][b:b + 1])
+                else:
+                    outputs[i] = chunk_outputs[b:b + 1]
+        return outputs
+
+    def _stack_stream_cache(self, sessions, cache_lens, cache_t):
+        """把多个会话最后cache_lens帧的缓存左填充到cache_t帧后拼接，没有缓存的会话使用全0缓存"""
+        ref_att = next((s.att_cache for s, cache_len in zip(sessions, cache_lens) if cache_len > 0), None)
+        ref_cnn = next((s.cnn_cache for s in sessions if s.cnn_cache.size(0) > 0), None)
+        if ref_att is None:
+            att_cache = torch.zeros([0, 0, 0, 0, 0], dtype=torch.float32, device=self.device)
+        elif all(s.att_cache.size(2) == cache_t for s in sessions):
+            # 缓存已经是相同长度的固定形状缓存，直接拼接
+            att_cache = torch.stack([s.att_cache for s in sessions], dim=1)
+        else:
+            elayers, head, _, d = ref_att.shape
+            att_cache = torch.zeros([elayers, len(sessions), head, cache_t, d],
+                                    dtype=torch.float32, device=self.device)
+            for b, (s, cache_len) in enumerate(zip(sessions, cache_lens)):
+                if cache_len > 0:
+                    att_cache[:, b, :, cache_t - cache_len:, :] = s.att_cache[:, :, s.att_cache.size(2) - cache_len:, :]
+        if ref_cnn is None:
+            cnn_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
+        else:
+            cnn_cache = torch.cat([s.cnn_cache if s.cnn_cache.size(0) > 0 else torch.zeros_like(ref_cnn)
+                                   for s in sessions], dim=1)
+        return att_cache, cnn_cache
 
     # 重置流式识别，每次流式识别完成之后都要执行
-    def reset_stream(self):
-        self.output_state_h = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.output_state_c = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.cnn_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.att_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
-        self.offset = torch.tensor([0], dtype=torch.int32, device=self.device)
+    def reset_stream(self, session=None):
+        if session is None:
+            session = self.stream_session
+        session.reset()
@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+
+from masr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class PosteriorStoreWriter:
+    def __init__(self, store_dir, vocab_size, top_k=0, blank_index=0, metadata=None):
+        """
+        把模型输出的CTC概率逐条写入磁盘，写入之后可以使用PosteriorStore以内存映射的方式读取
+        :param store_dir: 保存的文件夹路径
+        :param vocab_size: 词汇表大小，包括空白
+        :param top_k: 每帧只保存最大的top_k个概率和空白概率，为0时保存完整的概率
+        :param blank_index: 空白索引
+        :param metadata: 额外保存的信息，例如模型路径，用于判断缓存是否过期
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        # 先删除旧的索引文件，写入中断时不会把不完整的缓存当作可用的缓存
+        if os.path.exists(os.path.join(store_dir, 'index.json')):
+            os.remove(os.path.join(store_dir, 'index.json'))
+        self.store_dir = store_dir
+        self.vocab_size = vocab_size
+        # top_k不小于vocab_size - 1时和保存完整的概率没有区别
+        self.top_k = top_k if 0 < top_k < vocab_size - 1 else 0
+        self.blank_index = blank_index
+        self.metadata = metadata or {}
+        self.utterances = []
+        self.num_frames = 0
+        self._probs_file = open(os.path.join(store_dir, 'probs.bin'), 'wb')
+        self._indexes_file = open(os.path.join(store_dir, 'indexes.bin'), 'wb') if self.top_k else None
+        self._blank_file = open(os.path.join(store_dir, 'blank.bin'), 'wb') if self.top_k else None
+
+    def add(self, key, probs, label):
+        """
+        写入一条音频的模型输出
+        :param key: 音频的唯一标识，例如音频路径
+        :param probs: 模型输出的概率，形状为(T, vocab_size)
+        :param label: 音频的标注文本
+        """
+        probs = np.asarray(probs, dtype=np.float32)
+        if self.top_k:
+            indexes = np.argpartition(-probs, self.top_k - 1, axis=-1)[:, :self.top_k].astype(np.int32)
+            np.take_along_axis(probs, indexes, axis=-1).tofile(self._probs_file)
+            indexes.tofile(self._indexes_file)
+            np.ascontiguousarray(probs[:, self.blank_index]).tofile(self._blank_file)
+        else:
+            probs.tofile(self._probs_file)
+        self.utterances.append({'key': key, 'offset': self.num_frames, 'length': len(probs), 'label': label})
+        self.num_frames += len(probs)
+
+    def close(self):
+        """写入索引文件，写入索引文件之后缓存才可以使用"""
+        for f in [self._probs_file, self._indexes_file, self._blank_file]:
+            if f is not None:
+                f.close()
+        index = {'vocab_size': self.vocab_size,
+                 'top_k': self.top_k,
+                 'blank_index': self.blank_index,
+                 'num_frames': self.num_frames,
+                 'metadata': self.metadata,
+                 'utterances': self.utterances}
+        with open(os.path.join(self.store_dir, 'index.json'), 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        logger.info(f'已保存{len(self.utterances)}条音频的模型输出，共{self.num_frames}帧：{self.store_dir}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+class PosteriorStore:
+    def __init__(self, store_dir):
+        """
+        以内存映射的方式读取PosteriorStoreWriter保存的模型输出，多个进程读取同一个缓存时共用系统的页缓存
+        :param store_dir: 保存的文件夹路径
+        """
+        with open(os.path.join(store_dir, 'index.json'), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.vocab_size = index['vocab_size']
+        self.top_k = index['top_k']
+        self.blank_index = index['blank_index']
+        self.metadata = index['metadata']
+        self.utterances = index['utterances']
+        self.key_to_index = {u['key']: i for i, u in enumerate(self.utterances)}
+        num_frames = index['num_frames']
+        width = self.top_k or self.vocab_size
+        self._probs = self._memmap(os.path.join(store_dir, 'probs.bin'), np.float32, (num_frames, width))
+        if self.top_k:
+            self._indexes = self._memmap(os.path.join(store_dir, 'indexes.bin'), np.int32, (num_frames, width))
+            self._blank = self._memmap(os.path.join(store_dir, 'blank.bin'), np.float32, (num_frames,))
+
+    @staticmethod
+    def _memmap(path, dtype, shape):
+        # 没有任何帧时不能创建内存映射
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, 'index.json'))
+
+    def __len__(self):
+        return len(self.utterances)
+
+    def get(self, idx):
+        """
+        获取一条音频的模型输出
+        :param idx: 音频的索引，或者是写入时的key
+        :return: 形状为(T, vocab_size)的概率和标注文本，只保存了top_k个概率时其他的概率为0
+        """
+        if not isinstance(idx, (int, np.integer)):
+            idx = self.key_to_index[idx]
+        utterance = self.utterances[idx]
+        start, end = utterance['offset'], utterance['offset'] + utterance['length']
+        if not self.top_k:
+            return np.array(self._probs[start:end]), utterance['label']
+        probs = np.zeros((end - start, self.vocab_size), dtype=np.float32)
+        np.put_along_axis(probs, np.array(self._indexes[start:end]), self._probs[start:end], axis=-1)
+        probs[:, self.blank_index] = self._blank[start:end]
+        return probs, utterance['label']
@@ -0,0 +1,90 @@
+import numpy as np
+import torch
+
+
+class FeatureCache(object):
+    def __init__(self, capacity=512):
+        """
+        流式识别的特征缓存，使用预先分配的数组保存还没有识别的特征帧，避免每次拼接数组
+        :param capacity: 预先分配的特征帧数，超过时自动扩大
+        """
+        self.capacity = capacity
+        self._feat = None
+        self._start = 0
+        self._end = 0
+
+    @property
+    def num_frames(self):
+        return self._end - self._start
+
+    def append(self, feature):
+        """
+        添加新的特征帧，之前通过get()获取的数据块在调用之后失效
+        :param feature: 新的特征，形状为(T, D)
+        """
+        num_frames = self.num_frames
+        if self._feat is None:
+            self._feat = np.zeros((max(self.capacity, len(feature)), feature.shape[1]), dtype=np.float32)
+        # 把剩余的特征移动到缓存开头
+        if self._start > 0:
+            self._feat[:num_frames] = self._feat[self._start:self._end]
+            self._start, self._end = 0, num_frames
+        if num_frames + len(feature) > len(self._feat):
+            feat = np.zeros((2 * (num_frames + len(feature)), self._feat.shape[1]), dtype=np.float32)
+            feat[:num_frames] = self._feat[:num_frames]
+            self._feat = feat
+        self._feat[self._end:self._end + len(feature)] = feature
+        self._end += len(feature)
+
+    def get(self, start, end):
+        """获取缓存中第start到end帧的特征，形状为(1, T, D)"""
+        return self._feat[np.newaxis, self._start + start:self._start + end]
+
+    def drop(self, num_frames):
+        """丢弃最前面的num_frames帧"""
+        self._start = min(self._start + num_frames, self._end)
+
+    def reset(self):
+        self._start = 0
+        self._end = 0
+
+
+class StreamSession(object):
+    def __init__(self, device=torch.device("cpu"), beam_search_state=None, featurizer=None,
+                 decoding_chunk_size=16, num_decoding_left_chunks=-1, greedy_decoder=None):
+        """
+        流式识别会话，保存一条流式识别的全部状态，多个会话可以共用同一个预测器
+        :param device: 模型缓存所在的设备
+        :param beam_search_state: 集束搜索解码器的流式解码状态，每个会话独立一个，不使用集束搜索时为None
+        :param featurizer: 流式音频特征器StreamingAudioFeaturizer，每个会话独立一个
+        :param decoding_chunk_size: 该会话的数据块大小，可以在识别过程中修改
+        :param num_decoding_left_chunks: 该会话使用左边数据块的数量，小于0为使用全部历史数据
+        :param greedy_decoder: 贪心解码器的流式解码状态GreedyStreamDecoder，每个会话独立一个，不使用贪心解码时为None
+        """
+        self.device = device
+        self.decoding_chunk_size = decoding_chunk_size
+        self.num_decoding_left_chunks = num_decoding_left_chunks
+        self.beam_search_state = beam_search_state
+        self.greedy_decoder = greedy_decoder
+        self.featurizer = featurizer
+        self.cached_feat = FeatureCache()
+        self.reset()
+
+    # 重置会话状态，不重置集束搜索解码状态，集束搜索解码状态由解码器重置
+    def reset(self):
+        # 音频和特征缓存
+        if self.featurizer is not None:
+            self.featurizer.reset()
+        self.cached_feat.reset()
+        # 贪心解码状态
+        if self.greedy_decoder is not None:
+            self.greedy_decoder.reset()
+        # deepspeech2模型的流式状态
+        self.output_state_h = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
+        self.output_state_c = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
+        # conformer类模型的流式状态
+        self.cnn_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
+        self.att_cache = torch.zeros([0, 0, 0, 0], dtype=torch.float32, device=self.device)
+        # 注意力缓存中有效的帧数，限制缓存大小时att_cache是固定形状的，只有最后att_cache_len帧有效
+        self.att_cache_len = 0
+        self.offset = torch.tensor([0], dtype=torch.int32, device=self.device)
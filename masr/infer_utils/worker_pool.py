@@ -0,0 +1,234 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+
+import torch
+
+from masr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# 每个工作进程记住的最近关闭的会话数量，用于拒绝关闭之后才处理的数据块
+MAX_CLOSED_SESSIONS = 10000
+
+
+def _worker_loop(worker_id, predictor, request_queue, result_queue, num_threads, cpus):
+    """
+    工作进程的主循环，每次把队列中已经到达的请求全部取出，合并成批次执行识别
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    logger.info(f'工作进程{worker_id}已启动，进程ID：{os.getpid()}，线程数量：{num_threads}，绑定CPU：{cpus}')
+    sessions = {}
+    closed_sessions = OrderedDict()
+    running = True
+    while running:
+        requests = [request_queue.get()]
+        while True:
+            try:
+                requests.append(request_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in requests:
+            running = False
+            requests = [r for r in requests if r is not None]
+        predict_requests = [r for r in requests if r[1] == 'predict']
+        # 按到达的顺序处理，关闭之后才到达的数据块不能重新创建会话，直接返回错误
+        stream_requests, close_ids = [], []
+        for r in requests:
+            if r[1] == 'close':
+                close_ids.append(r[2])
+                closed_sessions[r[2]] = None
+                if len(closed_sessions) > MAX_CLOSED_SESSIONS:
+                    closed_sessions.popitem(last=False)
+            elif r[1] == 'stream':
+                if r[2][0] in closed_sessions:
+                    result_queue.put((r[0], False, '流式识别会话已关闭'))
+                else:
+                    stream_requests.append(r)
+        # 短语音识别，后处理参数相同的请求合并成一个批次
+        predict_groups = {}
+        for r in predict_requests:
+            predict_groups.setdefault(r[2][1:], []).append(r)
+        for (use_pun, is_itn), batch in predict_groups.items():
+            try:
+                features = [predictor.featurize(audio_data=r[2][0]) for r in batch]
+                results = predictor.predict_features(features, use_pun=use_pun, is_itn=is_itn)
+                for r, result in zip(batch, results):
+                    result_queue.put((r[0], True, result))
+            except Exception as e:
+                for r in batch:
+                    result_queue.put((r[0], False, str(e)))
+        # 流式识别，同一个批次中一个会话只能出现一次，多余的留到下一个批次
+        while len(stream_requests) > 0:
+            batch, remained, session_ids = [], [], set()
+            for r in stream_requests:
+                if r[2][0] in session_ids:
+                    remained.append(r)
+                else:
+                    session_ids.add(r[2][0])
+                    batch.append(r)
+            stream_requests = remained
+            batch_sessions = []
+            for r in batch:
+                session_id, decoding_chunk_size = r[2][0], r[2][5]
+                if session_id not in sessions:
+                    sessions[session_id] = predictor.create_stream_session()
+                if decoding_chunk_size is not None:
+                    predictor.set_stream_chunk_size(decoding_chunk_size, session=sessions[session_id])
+                batch_sessions.append(sessions[session_id])
+            try:
+                _, _, _, use_pun, is_itn, _ = batch[0][2]
+                results = predictor.predict_stream_batch(audio_datas=[r[2][1] for r in batch],
+                                                         sessions=batch_sessions,
+                                                         is_ends=[r[2][2] for r in batch],
+                                                         use_pun=use_pun, is_itn=is_itn)
+                for r, result in zip(batch, results):
+                    result_queue.put((r[0], True, result))
+            except Exception as e:
+                for r in batch:
+                    result_queue.put((r[0], False, str(e)))
+        # 关闭会话，在关闭之前已经到达的数据块处理完之后再关闭
+        for session_id in close_ids:
+            session = sessions.pop(session_id, None)
+            if session is not None:
+                predictor.reset_stream(session=session)
+
+
+class PredictorWorkerPool:
+    def __init__(self, predictor, num_workers=2, num_threads=1, pin_cpus=False):
+        """
+        多进程识别工作池，在主进程加载完模型、词汇表、语言模型和VAD之后fork出多个工作进程，
+        工作进程通过写时复制共享这些只读的内存，每个请求会分配到当前负载最小的工作进程，
+        fork之后的子进程不能使用主进程初始化的CUDA，所以只支持CPU识别，
+        OpenMP的线程池也不能在fork之后使用，工作进程使用多个线程时主进程在加载模型之前要执行torch.set_num_threads(1)
+        :param predictor: 已经加载好的语音识别预测器
+        :param num_workers: 工作进程的数量
+        :param num_threads: 每个工作进程PyTorch使用的线程数量
+        :param pin_cpus: 是否把每个工作进程绑定到固定的CPU核心上
+        """
+        if torch.cuda.is_initialized():
+            raise Exception('CUDA已经初始化，fork出的工作进程不能使用CUDA，多进程识别工作池只支持CPU识别')
+        if num_threads > 1 and torch.get_num_threads() > 1:
+            raise Exception('主进程PyTorch使用了多个线程，fork出的工作进程使用多个线程时会死锁，'
+                            '请在加载模型之前执行torch.set_num_threads(1)')
+        ctx = multiprocessing.get_context('fork')
+        self.num_workers = num_workers
+        self.result_queue = ctx.Queue()
+        self.request_queues = []
+        self.processes = []
+        # 每个工作进程正在处理的请求数量和流式会话数量
+        self.loads = [0] * num_workers
+        self.num_sessions = [0] * num_workers
+        self.session_workers = {}
+        self.futures = {}
+        self.lock = threading.Lock()
+        self._request_ids = itertools.count()
+        cpus = sorted(os.sched_getaffinity(0)) if pin_cpus else []
+        for i in range(num_workers):
+            worker_cpus = [cpus[(i * num_threads + j) % len(cpus)] for j in range(num_threads)] if cpus else []
+            request_queue = ctx.Queue()
+            process = ctx.Process(target=_worker_loop,
+                                  args=(i, predictor, request_queue, self.result_queue, num_threads, worker_cpus),
+                                  daemon=True)
+            process.start()
+            self.request_queues.append(request_queue)
+            self.processes.append(process)
+        # 在fork之后才启动接收结果的线程
+        self.result_thread = threading.Thread(target=self._receive_results, daemon=True)
+        self.result_thread.start()
+        logger.info(f'已启动{num_workers}个识别工作进程')
+
+    # 接收工作进程返回的结果，并唤醒等待结果的协程
+    def _receive_results(self):
+        while True:
+            request_id, success, result = self.result_queue.get()
+            with self.lock:
+                loop, future, worker_id = self.futures.pop(request_id, (None, None, None))
+                if worker_id is not None:
+                    self.loads[worker_id] -= 1
+            if future is None: continue
+            if success:
+                loop.call_soon_threadsafe(self._set_result, future, result)
+            else:
+                loop.call_soon_threadsafe(self._set_exception, future, Exception(result))
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.done(): future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, exception):
+        if not future.done(): future.set_exception(exception)
+
+    # 当前负载最小的工作进程
+    def _least_loaded_worker(self):
+        with self.lock:
+            return min(range(self.num_workers), key=lambda i: (self.loads[i] + self.num_sessions[i], i))
+
+    async def _submit(self, worker_id, method, payload):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_id = next(self._request_ids)
+        with self.lock:
+            self.futures[request_id] = (loop, future, worker_id)
+            self.loads[worker_id] += 1
+        self.request_queues[worker_id].put((request_id, method, payload))
+        return await future
+
+    async def predict(self, audio_data, use_pun=False, is_itn=False):
+        """
+        在负载最小的工作进程中识别一条短语音
+        :param audio_data: 音频文件路径或者完整的音频字节
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :return: 识别的文本结果和解码的得分数
+        """
+        return await self._submit(self._least_loaded_worker(), 'predict', (audio_data, use_pun, is_itn))
+
+    def create_session(self):
+        """
+        创建流式识别会话，会话固定在创建时负载最小的工作进程中
+        :return: 会话ID
+        """
+        session_id = uuid.uuid4().hex
+        worker_id = self._least_loaded_worker()
+        with self.lock:
+            self.session_workers[session_id] = worker_id
+            self.num_sessions[worker_id] += 1
+        return session_id
+
+    async def predict_stream(self, session_id, audio_data, is_end=False, use_pun=False, is_itn=False,
+                             decoding_chunk_size=None):
+        """
+        在会话所在的工作进程中执行流式识别
+        :param session_id: create_session()创建的会话ID
+        :param audio_data: 音频字节流数据
+        :param is_end: 是否结束语音识别
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :param decoding_chunk_size: 修改会话的数据块大小，为None时不修改
+        :return: 识别的文本结果和解码的得分数
+        """
+        worker_id = self.session_workers[session_id]
+        return await self._submit(worker_id, 'stream',
+                                  (session_id, audio_data, is_end, use_pun, is_itn, decoding_chunk_size))
+
+    def close_session(self, session_id):
+        with self.lock:
+            worker_id = self.session_workers.pop(session_id, None)
+            if worker_id is None: return
+            self.num_sessions[worker_id] -= 1
+        self.request_queues[worker_id].put((None, 'close', session_id))
+
+    def close(self):
+        for request_queue in self.request_queues:
+            request_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
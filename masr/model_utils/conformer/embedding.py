@@ -1,7 +1,8 @@
 import math
-from typing import Tuple
+from typing import Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 __all__ = ["PositionalEncoding", "RelPositionalEncoding"]
@@ -36,24 +37,24 @@ class PositionalEncoding(nn.Module):
         self.pe[:, :, 0::2] = torch.sin(position * div_term)  # TODO
         self.pe[:, :, 1::2] = torch.cos(position * div_term)
 
-    def forward(self, x: torch.Tensor, offset: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor, offset: Union[int, torch.Tensor] = 0) -> Tuple[torch.Tensor, torch.Tensor]:
         """Add positional encoding.
         Args:
             x (torch.Tensor): Input. Its shape is (batch, time, ...)
-            offset (int): position offset
+            offset (int or torch.Tensor): position offset, a tensor of shape (batch,)
+                means every utterance in the batch has its own offset
         Returns:
             torch.Tensor: Encoded tensor. Its shape is (batch, time, ...)
             torch.Tensor: for compatibility to RelPositionalEncoding, (batch=1, time, ...)
+                or (batch, time, ...) when offset is a tensor
         """
-        assert offset + x.shape[
-            1] < self.max_len, "offset: {} + x.shape[1]: {} is larger than the max_len: {}".format(
-            offset, x.shape[1], self.max_len)
         self.pe = self.pe.to(x.device)
-        pos_emb = self.pe[:, offset:offset + x.shape[1]]  # TODO
+        pos_emb = self.position_encoding(offset, x.size(1), False)
         x = x * self.xscale + pos_emb
         return self.dropout(x), self.dropout(pos_emb)
 
-    def position_encoding(self, offset: int, size: int) -> torch.Tensor:
+    def position_encoding(self, offset: Union[int, torch.Tensor], size: int,
+                          apply_dropout: bool = True) -> torch.Tensor:
         """ For getting encoding in a streaming fashion
         Attention!!!!!
         we apply dropout only once at the whole utterance level in a none
@@ -61,13 +62,47 @@ class PositionalEncoding(nn.Module):
         increasing input size in a streaming scenario, so the dropout will
         be applied several times.
         Args:
-            offset (int): start offset
+            offset (int or torch.Tensor): start offset, a tensor of shape (batch,)
+                is used for batched streaming decoding, negative positions are
+                clipped to 0 and should be masked by the caller
             size (int): requried size of position encoding
+            apply_dropout (bool): whether to apply dropout
         Returns:
-            torch.Tensor: Corresponding position encoding, #[1, T, D].
+            torch.Tensor: Corresponding position encoding, #[1, T, D] or #[B, T, D].
         """
-        assert offset + size < self.max_len
-        return self.dropout(self.pe[:, offset:offset + size])
+        if isinstance(offset, int):
+            if offset + size < self.max_len:
+                pos_emb = self.pe[:, offset:offset + size]
+            else:
+                index = torch.arange(offset, offset + size, device=self.pe.device).unsqueeze(0)  # [1, T]
+                pos_emb = self._position_encoding_by_index(index)
+        else:
+            self.pe = self.pe.to(offset.device)
+            index = offset.unsqueeze(1).long() + torch.arange(0, size, device=offset.device)  # [B, T]
+            index = index.clamp(min=0)
+            pos_emb = self._position_encoding_by_index(index)  # [B, T, D]
+        if apply_dropout:
+            pos_emb = self.dropout(pos_emb)
+        return pos_emb
+
+    def _position_encoding_by_index(self, index: torch.Tensor) -> torch.Tensor:
+        """ Get position encoding of arbitrary non-negative positions
+        Positions beyond max_len are computed on the fly, so that long
+        running streams never run out of the precomputed table.
+        Args:
+            index (torch.Tensor): positions, (B, T)
+        Returns:
+            torch.Tensor: position encoding, (B, T, D)
+        """
+        if int(torch.max(index)) < self.max_len:
+            return F.embedding(index, self.pe[0])
+        div_term = torch.exp(torch.arange(0, self.d_model, 2, dtype=torch.float64, device=index.device) *
+                             -(math.log(10000.0) / self.d_model))
+        # 位置很大时使用float64计算，避免角度的精度损失
+        angle = index.unsqueeze(2).to(torch.float64) * div_term  # [B, T, D/2]
+        pe = torch.stack([torch.sin(angle), torch.cos(angle)], dim=3).flatten(2).to(self.pe.dtype)
+        in_table = (index < self.max_len).unsqueeze(2)
+        return torch.where(in_table, F.embedding(index.clamp(max=self.max_len - 1), self.pe[0]), pe)
 
 
 class RelPositionalEncoding(PositionalEncoding):
@@ -84,20 +119,18 @@ class RelPositionalEncoding(PositionalEncoding):
         """
         super().__init__(d_model, dropout_rate, max_len, reverse=True)
 
-    def forward(self, x: torch.Tensor, offset: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor, offset: Union[int, torch.Tensor] = 0) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute positional encoding.
         Args:
             x (torch.Tensor): Input tensor (batch, time, `*`).
+            offset (int or torch.Tensor): position offset, int or tensor of shape (batch,)
         Returns:
             torch.Tensor: Encoded tensor (batch, time, `*`).
-            torch.Tensor: Positional embedding tensor (1, time, `*`).
+            torch.Tensor: Positional embedding tensor (1, time, `*`) or (batch, time, `*`).
         """
-        assert offset + x.shape[
-            1] < self.max_len, "offset: {} + x.shape[1]: {} is larger than the max_len: {}".format(
-            offset, x.shape[1], self.max_len)
         x = x * self.xscale
         self.pe = self.pe.to(x.device)
-        pos_emb = self.pe[:, offset:offset + x.shape[1]]
+        pos_emb = self.position_encoding(offset, x.size(1), False)
         return self.dropout(x), self.dropout(pos_emb)
 
 
@@ -418,3 +418,78 @@ class ConformerEncoder(nn.Module):
         r_att_cache = torch.concat(r_att_cache, dim=0)
         r_cnn_cache = torch.stack(r_cnn_cache, dim=0)
         return xs, r_att_cache, r_cnn_cache
+
+    def forward_chunk_batch(
+            self,
+            xs: torch.Tensor,
+            offsets: torch.Tensor,
+            required_cache_size: int,
+            att_cache: torch.Tensor = torch.zeros([0, 0, 0, 0, 0]),
+            att_cache_lens: torch.Tensor = torch.zeros([0], dtype=torch.int32),
+            cnn_cache: torch.Tensor = torch.zeros([0, 0, 0, 0])
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Forward one chunk of several independent streams at once
+        Args:
+            xs (torch.Tensor): chunk audio feat input of B streams, [B, T, D],
+                every stream has the same chunk length
+            offsets (torch.Tensor): current offset of every stream in encoder
+                output time stamp, (B,)
+            required_cache_size (int): cache size required for next chunk compuation
+                >=0: actual cache size
+                <0: means all history cache is required
+            att_cache (torch.Tensor): left padded attention cache of every stream,
+                (elayers, B, head, cache_t1, d_k * 2), (0, 0, 0, 0, 0) means
+                all streams have no cache
+            att_cache_lens (torch.Tensor): real cache length of every stream, (B,),
+                the first `cache_t1 - att_cache_lens[b]` frames of stream b are padding
+            cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
+                (elayers, B, hidden-dim, cache_t2), streams without cache use zeros
+        Returns:
+            torch.Tensor: output of current input xs, (B, chunk_size, hidden-dim)
+            torch.Tensor: new left padded attention cache required for next chunk,
+                (elayers, B, head, T, d_k*2) depending on required_cache_size
+            torch.Tensor: new conformer cnn cache required for next chunk, with
+                same shape as the original cnn_cache
+        """
+        batch_size = xs.size(0)
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(batch_size, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, offsets)
+        elayers, cache_t1 = att_cache.size(0), att_cache.size(3)
+        chunk_size = xs.size(1)
+        attention_key_size = cache_t1 + chunk_size
+
+        # 每条流的位置编码从自己的缓存起点开始，填充部分的位置由att_mask屏蔽
+        pos_emb = self.embed.position_encoding(offset=offsets - cache_t1, size=attention_key_size)
+        if cache_t1 > 0:
+            key_index = torch.arange(0, attention_key_size, device=xs.device).unsqueeze(0)
+            att_mask = (key_index >= (cache_t1 - att_cache_lens).unsqueeze(1)).unsqueeze(1)  # (B, 1, T)
+        else:
+            att_mask = torch.ones([0, 0, 0], dtype=torch.bool, device=xs.device)
+
+        if required_cache_size < 0:
+            next_cache_start = 0
+        elif required_cache_size == 0:
+            next_cache_start = attention_key_size
+        else:
+            next_cache_start = max(attention_key_size - required_cache_size, 0)
+
+        r_att_cache = []
+        r_cnn_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, new_cnn_cache = layer(
+                xs, att_mask, pos_emb,
+                att_cache=att_cache[i] if elayers > 0 else torch.zeros([0, 0, 0, 0], device=xs.device),
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else torch.zeros([0, 0, 0, 0], device=xs.device))
+            r_att_cache.append(new_att_cache[:, :, next_cache_start:, :])
+            r_cnn_cache.append(new_cnn_cache)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+
+        # r_att_cache (elayers, B, head, T, d_k*2)
+        # r_cnn_cache (elayers, B, hidden-dim, cache_t2)
+        r_att_cache = torch.stack(r_att_cache, dim=0)
+        r_cnn_cache = torch.stack(r_cnn_cache, dim=0)
+        return xs, r_att_cache, r_cnn_cache
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Tuple, Union
 
 import torch
 from torch import nn
@@ -15,7 +15,7 @@ class BaseSubsampling(nn.Module):
         self.right_context = 0
         self.subsampling_rate = 1
 
-    def position_encoding(self, offset: int, size: int) -> torch.Tensor:
+    def position_encoding(self, offset: Union[int, torch.Tensor], size: int) -> torch.Tensor:
         return self.pos_enc.position_encoding(offset, size)
 
 
@@ -43,13 +43,13 @@ class LinearNoSubsampling(BaseSubsampling):
         self.right_context = 0
         self.subsampling_rate = 1
 
-    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: int = 0
+    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: Union[int, torch.Tensor] = 0
                 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Input x.
         Args:
             x (torch.Tensor): Input tensor (#batch, time, idim).
             x_mask (torch.Tensor): Input mask (#batch, 1, time).
-            offset (int): position encoding offset.
+            offset (int or torch.Tensor): position encoding offset.
         Returns:
             torch.Tensor: linear input tensor (#batch, time', odim),
                 where time' = time .
@@ -90,13 +90,13 @@ class Conv2dSubsampling4(BaseSubsampling):
         # 6 = (3 - 1) * 1 + (3 - 1) * 2
         self.right_context = 6
 
-    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: int = 0
+    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: Union[int, torch.Tensor] = 0
                 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Subsample x.
         Args:
             x (torch.Tensor): Input tensor (#batch, time, idim).
             x_mask (torch.Tensor): Input mask (#batch, 1, time).
-            offset (int): position encoding offset.
+            offset (int or torch.Tensor): position encoding offset.
         Returns:
             torch.Tensor: Subsampled tensor (#batch, time', odim),
                 where time' = time // 4.
@@ -109,7 +109,7 @@ class Conv2dSubsampling4(BaseSubsampling):
         b, c, t, f = x.shape
         x = self.out(x.transpose(1, 2).reshape([b, -1, c * f])) # TODO
         x, pos_emb = self.pos_enc(x, offset)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-2:2]
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 2::2]
 
 
 class Conv2dSubsampling6(BaseSubsampling):
@@ -139,13 +139,13 @@ class Conv2dSubsampling6(BaseSubsampling):
         self.subsampling_rate = 6
         self.right_context = 10
 
-    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: int = 0
+    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: Union[int, torch.Tensor] = 0
                 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Subsample x.
         Args:
             x (torch.Tensor): Input tensor (#batch, time, idim).
             x_mask (torch.Tensor): Input mask (#batch, 1, time).
-            offset (int): position encoding offset.
+            offset (int or torch.Tensor): position encoding offset.
         Returns:
             torch.Tensor: Subsampled tensor (#batch, time', odim),
                 where time' = time // 6.
@@ -158,7 +158,7 @@ class Conv2dSubsampling6(BaseSubsampling):
         b, c, t, f = x.shape
         x = self.linear(x.transpose(1, 2).reshape([b, -1, c * f])) # TODO
         x, pos_emb = self.pos_enc(x, offset)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-4:3]
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 4::3]
 
 
 class Conv2dSubsampling8(BaseSubsampling):
@@ -189,13 +189,13 @@ class Conv2dSubsampling8(BaseSubsampling):
         # 14 = (3 - 1) * 1 + (3 - 1) * 2 + (3 - 1) * 4
         self.right_context = 14
 
-    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: int = 0
+    def forward(self, x: torch.Tensor, x_mask: torch.Tensor, offset: Union[int, torch.Tensor] = 0
                 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Subsample x.
         Args:
             x (torch.Tensor): Input tensor (#batch, time, idim).
             x_mask (torch.Tensor): Input mask (#batch, 1, time).
-            offset (int): position encoding offset.
+            offset (int or torch.Tensor): position encoding offset.
         Returns:
             torch.Tensor: Subsampled tensor (#batch, time', odim),
                 where time' = time // 8.
@@ -208,4 +208,4 @@ class Conv2dSubsampling8(BaseSubsampling):
         b, c, t, f = x.shape
         x = self.linear(x.transpose(1, 2).reshape([b, -1, c * f]))
         x, pos_emb = self.pos_enc(x, offset)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-2:2][:, :, :-2:2]
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 2::2][:, :, 2::2]
@@ -61,12 +61,35 @@ class DeepSpeech2Model(nn.Module):
         loss = self.decoder(eouts, eouts_len, text, text_lengths)
         return {'loss': loss}
 
+    def forward_with_encoder_out(self, speech, speech_lengths, text, text_lengths):
+        """Compute Model loss and ctc softmax output of the same encoder forward, used for evaluation
+
+        Args:
+            speech (Tensor): [B, T, D]
+            speech_lengths (Tensor): [B]
+            text (Tensor): [B, U]
+            text_lengths (Tensor): [B]
+
+        Returns:
+            loss dict, ctc softmax output [B, T, vocab_size], valid length of ctc softmax output [B]
+        """
+        eouts, eouts_len, _, _ = self.encoder(speech, speech_lengths)
+        loss = self.decoder(eouts, eouts_len, text, text_lengths)
+        ctc_probs = self.decoder.softmax(eouts)
+        return {'loss': loss}, ctc_probs, eouts_len
+
     @torch.jit.export
     def get_encoder_out(self, speech, speech_lengths):
         eouts, _, _, _ = self.encoder(speech, speech_lengths)
         ctc_probs = self.decoder.softmax(eouts)
         return ctc_probs
 
+    @torch.jit.export
+    def get_encoder_out_batch(self, speech, speech_lengths):
+        eouts, eouts_len, _, _ = self.encoder(speech, speech_lengths)
+        ctc_probs = self.decoder.softmax(eouts)
+        return ctc_probs, eouts_len
+
     @torch.jit.export
     def get_encoder_out_chunk(self, speech, speech_lengths,
                               init_state_h: torch.Tensor = torch.zeros([0, 0, 0, 0]),
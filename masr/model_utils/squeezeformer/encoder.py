@@ -360,6 +360,123 @@ class SqueezeformerEncoder(nn.Module):
             xs = self.final_proj(xs)
         return xs, r_att_cache, r_cnn_cache
 
+    def forward_chunk_batch(
+            self,
+            xs: torch.Tensor,
+            offsets: torch.Tensor,
+            required_cache_size: int,
+            att_cache: torch.Tensor = torch.zeros(0, 0, 0, 0, 0),
+            att_cache_lens: torch.Tensor = torch.zeros(0, dtype=torch.int32),
+            cnn_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Forward one chunk of several independent streams at once
+
+        Args:
+            xs (torch.Tensor): chunk input of B streams, with shape (B, time, mel-dim),
+                every stream has the same chunk length
+            offsets (torch.Tensor): current offset of every stream in encoder
+                output time stamp, with shape (B,)
+            required_cache_size (int): cache size required for next chunk
+                compuation
+                >=0: actual cache size
+                <0: means all history cache is required
+            att_cache (torch.Tensor): left padded cache tensor for KEY & VALUE,
+                with shape (elayers, B, head, cache_t1, d_k * 2),
+                (0, 0, 0, 0, 0) means all streams have no cache.
+                The padding length `cache_t1 - att_cache_lens[b]` must be a
+                multiple of the time reduction factor.
+            att_cache_lens (torch.Tensor): real cache length of every stream, (B,)
+            cnn_cache (torch.Tensor): cache tensor for cnn_module,
+                (elayers, B, hidden-dim, cache_t2), streams without cache use zeros
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (B, chunk_size, hidden-dim).
+            torch.Tensor: new left padded attention cache required for next chunk,
+                with shape (elayers, B, head, ?, d_k * 2)
+            torch.Tensor: new cnn cache required for next chunk, with
+                same shape as the original cnn_cache.
+
+        """
+        batch_size = xs.size(0)
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(batch_size, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, offsets)
+        elayers, cache_t1 = att_cache.size(0), att_cache.size(3)
+        chunk_size = xs.size(1)
+        attention_key_size = cache_t1 + chunk_size
+        # 每条流的位置编码从自己的缓存起点开始，填充部分的位置由att_mask屏蔽
+        pos_emb = self.embed.position_encoding(offset=offsets - cache_t1, size=attention_key_size)
+        if cache_t1 > 0:
+            key_index = torch.arange(0, attention_key_size, device=xs.device).unsqueeze(0)
+            att_mask = (key_index >= (cache_t1 - att_cache_lens).unsqueeze(1)).unsqueeze(1)  # (B, 1, T)
+        else:
+            att_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=xs.device)
+        if required_cache_size < 0:
+            next_cache_start = 0
+        elif required_cache_size == 0:
+            next_cache_start = attention_key_size
+        else:
+            next_cache_start = max(attention_key_size - required_cache_size, 0)
+
+        r_att_cache = []
+        r_cnn_cache = []
+
+        mask_pad = torch.ones(batch_size, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        max_att_len: int = 0
+        recover_activations: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]] = []
+        index = 0
+        xs_lens = torch.full([batch_size], xs.size(1), device=xs.device, dtype=torch.int)
+        xs = self.preln(xs)
+        for i, layer in enumerate(self.encoders):
+            if self.reduce_idx is not None:
+                if self.time_reduce is not None and i in self.reduce_idx:
+                    recover_activations.append((xs, att_mask, pos_emb, mask_pad))
+                    xs, xs_lens, att_mask, mask_pad = \
+                        self.time_reduction_layer(xs, xs_lens, att_mask, mask_pad)
+                    pos_emb = pos_emb[:, ::2, :]
+                    index += 1
+
+            if self.recover_idx is not None:
+                if self.time_reduce == 'recover' and i in self.recover_idx:
+                    index -= 1
+                    recover_tensor, recover_att_mask, recover_pos_emb, recover_mask_pad = recover_activations[index]
+                    # recover output length for ctc decode
+                    xs = torch.repeat_interleave(xs, repeats=2, dim=1)
+                    xs = self.time_recover_layer(xs)
+                    recoverd_t = recover_tensor.size(1)
+                    xs = recover_tensor + xs[:, :recoverd_t, :].contiguous()
+                    att_mask = recover_att_mask
+                    pos_emb = recover_pos_emb
+                    mask_pad = recover_mask_pad
+
+            factor = self.calculate_downsampling_factor(i)
+
+            xs, _, new_att_cache, new_cnn_cache = layer(
+                xs, att_mask, pos_emb,
+                att_cache=att_cache[i][:, :, ::factor, :]
+                [:, :, :pos_emb.size(1) - xs.size(1), :] if
+                elayers > 0 else torch.zeros(0, 0, 0, 0, device=xs.device),
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else torch.zeros(0, 0, 0, 0, device=xs.device))
+            cached_att = new_att_cache[:, :, next_cache_start // factor:, :]
+            cached_cnn = new_cnn_cache.unsqueeze(0)
+            cached_att = cached_att.repeat_interleave(repeats=factor, dim=2)
+            if i == 0:
+                # record length for the first block as max length
+                max_att_len = cached_att.size(2)
+            r_att_cache.append(cached_att[:, :, :max_att_len, :].unsqueeze(0))
+            r_cnn_cache.append(cached_cnn)
+        # NOTE: shape(r_att_cache) is (elayers, B, head, ?, d_k * 2)
+        r_att_cache = torch.cat(r_att_cache, dim=0)
+        # NOTE: shape(r_cnn_cache) is (elayers, B, hidden-dim, cache_t2)
+        r_cnn_cache = torch.cat(r_cnn_cache, dim=0)
+
+        if self.final_proj is not None:
+            xs = self.final_proj(xs)
+        return xs, r_att_cache, r_cnn_cache
+
 
 class SqueezeformerEncoderLayer(nn.Module):
     """Encoder layer module.
@@ -90,6 +90,40 @@ class SqueezeformerModel(torch.nn.Module):
                 text_lengths.shape[0]), (speech.shape, speech_lengths.shape, text.shape, text_lengths.shape)
         # 1. Encoder
         encoder_out, encoder_mask = self.encoder(speech, speech_lengths)
+        return self._calc_loss(encoder_out, encoder_mask, text, text_lengths)
+
+    def forward_with_encoder_out(
+            self,
+            speech: torch.Tensor,
+            speech_lengths: torch.Tensor,
+            text: torch.Tensor,
+            text_lengths: torch.Tensor,
+    ):
+        """Encoder + Decoder + Calc loss, and ctc softmax output of the same encoder forward, used for evaluation
+        Args:
+            speech: (Batch, Length, ...)
+            speech_lengths: (Batch, )
+            text: (Batch, Length)
+            text_lengths: (Batch,)
+        Returns:
+            loss dict, ctc softmax output (Batch, Tmax, vocab_size), valid length of ctc softmax output (Batch,)
+        """
+        # 使用完整的上下文，和get_encoder_out的输出相同
+        encoder_out, encoder_mask = self.encoder(speech,
+                                                 speech_lengths,
+                                                 decoding_chunk_size=-1,
+                                                 num_decoding_left_chunks=-1)
+        loss_dict = self._calc_loss(encoder_out, encoder_mask, text, text_lengths)
+        ctc_probs = self.ctc.softmax(encoder_out)
+        encoder_out_lens = encoder_mask.squeeze(1).sum(1)
+        return loss_dict, ctc_probs, encoder_out_lens
+
+    def _calc_loss(self,
+                   encoder_out: torch.Tensor,
+                   encoder_mask: torch.Tensor,
+                   text: torch.Tensor,
+                   text_lengths: torch.Tensor):
+        """Calc attention loss and ctc loss from encoder output."""
         encoder_out_lens = encoder_mask.squeeze(1).sum(1)  # [B, 1, T] -> [B]
 
         # 2a. Attention-decoder branch
@@ -172,6 +206,26 @@ class SqueezeformerModel(torch.nn.Module):
         ctc_probs = self.ctc.softmax(encoder_out)
         return ctc_probs
 
+    @torch.jit.export
+    def get_encoder_out_batch(self, speech: torch.Tensor, speech_lengths: torch.Tensor) -> \
+            Tuple[torch.Tensor, torch.Tensor]:
+        """ Get encoder output and output lengths of a padded batch
+
+        Args:
+            speech (torch.Tensor): (batch, max_len, feat_dim)
+            speech_lengths (torch.Tensor): (batch, )
+        Returns:
+            Tensor: ctc softmax output
+            Tensor: valid length of every ctc softmax output, (batch, )
+        """
+        encoder_out, encoder_mask = self.encoder(speech,
+                                                 speech_lengths,
+                                                 decoding_chunk_size=-1,
+                                                 num_decoding_left_chunks=-1)  # (B, maxlen, encoder_dim)
+        ctc_probs = self.ctc.softmax(encoder_out)
+        encoder_out_lens = encoder_mask.squeeze(1).sum(1)
+        return ctc_probs, encoder_out_lens
+
     @torch.jit.export
     def get_encoder_out_chunk(self,
                               speech: torch.Tensor,
@@ -195,6 +249,35 @@ class SqueezeformerModel(torch.nn.Module):
         ctc_probs = self.ctc.softmax(xs)
         return ctc_probs, att_cache, cnn_cache
 
+    @torch.jit.export
+    def get_encoder_out_chunk_batch(self,
+                                    speech: torch.Tensor,
+                                    offsets: torch.Tensor,
+                                    required_cache_size: int,
+                                    att_cache: torch.Tensor = torch.zeros([0, 0, 0, 0, 0]),
+                                    att_cache_lens: torch.Tensor = torch.zeros([0], dtype=torch.int32),
+                                    cnn_cache: torch.Tensor = torch.zeros([0, 0, 0, 0])) -> \
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Get encoder output of one chunk from several streams
+
+        Args:
+            speech (torch.Tensor): (batch, chunk_len, feat_dim)
+            offsets (torch.Tensor): offset of every stream, (batch,)
+            att_cache (torch.Tensor): left padded attention cache, (elayers, batch, head, cache_t1, d_k * 2)
+            att_cache_lens (torch.Tensor): real attention cache length of every stream, (batch,)
+            cnn_cache (torch.Tensor): (elayers, batch, hidden-dim, cache_t2)
+        Returns:
+            Tensor: ctc softmax output
+        """
+        xs, att_cache, cnn_cache = self.encoder.forward_chunk_batch(xs=speech,
+                                                                    offsets=offsets,
+                                                                    required_cache_size=required_cache_size,
+                                                                    att_cache=att_cache,
+                                                                    att_cache_lens=att_cache_lens,
+                                                                    cnn_cache=cnn_cache)
+        ctc_probs = self.ctc.softmax(xs)
+        return ctc_probs, att_cache, cnn_cache
+
     @torch.no_grad()
     def export(self):
         static_model = torch.jit.script(self.eval())
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -12,7 +12,7 @@ class BaseSubsampling(nn.Module):
         # stride = subsampling_rate * chunk_size
         self.subsampling_rate = 1
 
-    def position_encoding(self, offset: int, size: int) -> torch.Tensor:
+    def position_encoding(self, offset: Union[int, torch.Tensor], size: int) -> torch.Tensor:
         return self.pos_enc.position_encoding(offset, size)
 
 
@@ -61,7 +61,7 @@ class DepthwiseConv2DSubsampling4(BaseSubsampling):
             self,
             x: torch.Tensor,
             x_mask: torch.Tensor,
-            offset: int = 0
+            offset: Union[int, torch.Tensor] = 0
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         x = x.unsqueeze(1)  # (b, c=1, t, f)
         x = self.pw_conv(x)
@@ -73,4 +73,4 @@ class DepthwiseConv2DSubsampling4(BaseSubsampling):
         x = x.contiguous().view(b, t, c * f)
         x, pos_emb = self.pos_enc(x, offset)
         x = self.input_proj(x)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-2:2]
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 2::2]
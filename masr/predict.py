@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from io import BufferedReader
 
 import numpy as np
@@ -6,10 +7,11 @@ import yaml
 
 from masr import SUPPORT_MODEL
 from masr.data_utils.audio import AudioSegment
-from masr.data_utils.featurizer.audio_featurizer import AudioFeaturizer
+from masr.data_utils.featurizer.audio_featurizer import AudioFeaturizer, StreamingAudioFeaturizer
 from masr.data_utils.featurizer.text_featurizer import TextFeaturizer
-from masr.decoders.ctc_greedy_decoder import greedy_decoder, greedy_decoder_chunk
+from masr.decoders.ctc_greedy_decoder import greedy_decoder, greedy_decoder_batch, GreedyStreamDecoder, tokens_to_text
 from masr.infer_utils.inference_predictor import InferencePredictor
+from masr.infer_utils.stream_session import StreamSession
 from masr.utils.logger import setup_logger
 from masr.utils.utils import dict_to_object, print_arguments, download_model
 
@@ -23,7 +25,10 @@ class MASRPredictor:
                  model_path='models/conformer_streaming_fbank/inference.pt',
                  use_pun=False,
                  pun_model_dir='models/pun_models/',
-                 use_gpu=True):
+                 use_gpu=True,
+                 decoding_chunk_size=16,
+                 num_decoding_left_chunks=-1,
+                 output_top_k=True):
         """
         语音识别预测工具
         :param configs: 配置文件路径或者是yaml读取到的配置参数
@@ -32,6 +37,11 @@ class MASRPredictor:
         :param use_pun: 是否使用加标点符号的模型
         :param pun_model_dir: 给识别结果加标点符号的模型文件夹路径
         :param use_gpu: 是否使用GPU预测
+        :param decoding_chunk_size: 流式识别默认的数据块大小，单位为降采样之前的模型输出帧，越大延迟越高，吞吐量越大
+        :param num_decoding_left_chunks: 流式识别时conformer类模型使用左边数据块的数量，小于0为使用全部历史数据，
+                                         长时间的流式识别建议设置，这样每个数据块的计算量和内存保持不变
+        :param output_top_k: 使用集束搜索解码时是否只从模型所在设备传输每帧最大的cutoff_top_n个概率，解码结果不变，
+                             贪心解码总是在模型所在设备上完成，只传输解码得到的索引和得分
         """
         if configs:
             if isinstance(configs, str):
@@ -61,16 +71,13 @@ class MASRPredictor:
         assert self.configs.use_model in SUPPORT_MODEL, f'没有该模型：{self.configs.use_model}'
         self.running = False
         self.use_gpu = use_gpu
+        self.decoding_chunk_size = decoding_chunk_size
+        self.num_decoding_left_chunks = num_decoding_left_chunks
         self.inv_normalizer = None
         self.pun_predictor = None
         self.vad_predictor = None
         self._text_featurizer = TextFeaturizer(vocab_filepath=self.configs.dataset_conf.dataset_vocab)
         self._audio_featurizer = AudioFeaturizer(**self.configs.preprocess_conf)
-        # 流式解码参数
-        self.remained_wav = None
-        self.cached_feat = None
-        self.greedy_last_max_prob_list = None
-        self.greedy_last_max_index_list = None
         self.__init_decoder()
         # 创建模型
         if not os.path.exists(model_path):
@@ -79,12 +86,21 @@ class MASRPredictor:
         if use_pun:
             from masr.infer_utils.pun_predictor import PunctuationPredictor
             self.pun_predictor = PunctuationPredictor(model_dir=pun_model_dir, use_gpu=use_gpu)
-        # 获取预测器
+        # 获取预测器，贪心解码直接在模型所在设备上完成
+        output_type, top_k = 'greedy', None
+        if self.configs.decoder == 'ctc_beam_search':
+            output_type = 'topk' if output_top_k else 'probs'
+            top_k = self.configs.ctc_beam_search_decoder_conf.get('cutoff_top_n', 40)
         self.predictor = InferencePredictor(configs=self.configs,
                                             use_model=self.configs.use_model,
                                             streaming=self.configs.streaming,
                                             model_path=model_path,
-                                            use_gpu=self.use_gpu)
+                                            use_gpu=self.use_gpu,
+                                            output_type=output_type,
+                                            top_k=top_k)
+        self.__init_chunk_geometry()
+        # 默认的流式识别会话，没有指定会话时使用
+        self.stream_session = self.create_stream_session()
         # 预热
         warmup_audio = np.random.uniform(low=-2.0, high=2.0, size=(134240,))
         self.predict(audio_data=warmup_audio, is_itn=False)
@@ -96,17 +112,68 @@ class MASRPredictor:
     def __init_decoder(self):
         # 集束搜索方法的处理
         if self.configs.decoder == "ctc_beam_search":
-            try:
-                from masr.decoders.beam_search_decoder import BeamSearchDecoder
-                self.beam_search_decoder = BeamSearchDecoder(vocab_list=self._text_featurizer.vocab_list,
-                                                             **self.configs.ctc_beam_search_decoder_conf)
-            except ModuleNotFoundError:
-                logger.warning('==================================================================')
-                logger.warning('缺少 paddlespeech_ctcdecoders 库，请执行以下命令安装。')
+            from masr.decoders.beam_search_decoder import BeamSearchDecoder, NATIVE_DECODER
+            if not NATIVE_DECODER:
+                logger.warning('缺少 paddlespeech_ctcdecoders 库，使用NumPy实现的前缀集束搜索，解码速度较慢，可以执行以下命令安装。')
                 logger.warning('python -m pip install paddlespeech_ctcdecoders -U -i https://ppasr.yeyupiaoling.cn/pypi/simple/')
-                logger.warning('【注意】现在已自动切换为ctc_greedy解码器，ctc_greedy解码器准确率相对较低。')
-                logger.warning('==================================================================\n')
-                self.configs.decoder = 'ctc_greedy'
+            self.beam_search_decoder = BeamSearchDecoder(vocab_list=self._text_featurizer.vocab_list,
+                                                         **self.configs.ctc_beam_search_decoder_conf)
+
+    # 从加载的模型中获取流式识别数据块的计算参数
+    def __init_chunk_geometry(self):
+        # 旧版本导出的模型和deepspeech2没有这些属性，根据配置文件的降采样层推算
+        input_layer = self.configs.get('encoder_conf', {}).get('input_layer', 'conv2d')
+        subsampling_rate, right_context = {'conv2d6': (6, 10), 'conv2d8': (8, 14)}.get(input_layer, (4, 6))
+        # efficient_conformer的编码器中间有降采样层，数据块大小必须是该值的整数倍
+        downsampling_factor = 1
+        encoder = getattr(self.predictor.predictor, 'encoder', None)
+        embed = getattr(encoder, 'embed', None)
+        if embed is not None and hasattr(embed, 'subsampling_rate') and hasattr(embed, 'right_context'):
+            subsampling_rate, right_context = int(embed.subsampling_rate), int(embed.right_context)
+        if encoder is not None and hasattr(encoder, 'stride_layer_idx') and hasattr(encoder, 'num_blocks'):
+            downsampling_factor = int(encoder.calculate_downsampling_factor(encoder.num_blocks + 1))
+        self.subsampling_rate = subsampling_rate
+        self.right_context = right_context
+        self.downsampling_factor = downsampling_factor
+        self._check_chunk_size(self.decoding_chunk_size)
+
+    def _check_chunk_size(self, decoding_chunk_size):
+        if decoding_chunk_size <= 0 or decoding_chunk_size % self.downsampling_factor != 0:
+            raise Exception(f'数据块大小必须是{self.downsampling_factor}的正整数倍，当前为：{decoding_chunk_size}')
+
+    # 创建流式识别会话，每条流式音频使用一个独立的会话，所有会话共用同一个模型
+    def create_stream_session(self, decoding_chunk_size=None, num_decoding_left_chunks=None):
+        """
+        创建流式识别会话，每条流式音频使用一个独立的会话，所有会话共用同一个模型
+        :param decoding_chunk_size: 该会话的数据块大小，为None时使用预测器的默认值
+        :param num_decoding_left_chunks: 该会话使用左边数据块的数量，为None时使用预测器的默认值
+        :return: 流式识别会话
+        """
+        beam_search_state, greedy_stream_decoder = None, None
+        if self.configs.decoder == 'ctc_beam_search':
+            beam_search_state = self.beam_search_decoder.create_stream_state()
+        else:
+            greedy_stream_decoder = GreedyStreamDecoder(vocabulary=self._text_featurizer.vocab_list)
+        decoding_chunk_size = decoding_chunk_size or self.decoding_chunk_size
+        self._check_chunk_size(decoding_chunk_size)
+        if num_decoding_left_chunks is None:
+            num_decoding_left_chunks = self.num_decoding_left_chunks
+        return StreamSession(device=self.predictor.device, beam_search_state=beam_search_state,
+                             featurizer=StreamingAudioFeaturizer(self._audio_featurizer),
+                             decoding_chunk_size=decoding_chunk_size,
+                             num_decoding_left_chunks=num_decoding_left_chunks,
+                             greedy_decoder=greedy_stream_decoder)
+
+    def set_stream_chunk_size(self, decoding_chunk_size, session=None):
+        """
+        修改流式识别会话的数据块大小，从下一次输入的音频开始生效，可以在识别过程中根据负载调整
+        :param decoding_chunk_size: 新的数据块大小
+        :param session: 流式识别会话，为None时使用默认会话
+        """
+        if session is None:
+            session = self.stream_session
+        self._check_chunk_size(decoding_chunk_size)
+        session.decoding_chunk_size = decoding_chunk_size
 
     # 初始化VAD工具
     def init_vad(self):
@@ -118,13 +185,16 @@ class MASRPredictor:
     def decode(self, output_data, use_pun, is_itn):
         """
         解码模型输出结果
-        :param output_data: 模型输出结果
+        :param output_data: 模型输出结果，在模型所在设备上完成贪心解码时为得分和索引的元组
         :param use_pun: 是否使用加标点符号的模型
         :param is_itn: 是否对文本进行反标准化
         :return:
         """
         # 执行解码
-        if self.configs.decoder == 'ctc_beam_search':
+        if isinstance(output_data, tuple):
+            # 已经在模型所在设备上完成贪心解码，只需要把索引转换为文本
+            result = output_data[0], tokens_to_text(output_data[1], self._text_featurizer.vocab_list)
+        elif self.configs.decoder == 'ctc_beam_search':
             # 集束搜索解码策略
             result = self.beam_search_decoder.decode_beam_search_offline(probs_split=output_data)
         else:
@@ -132,6 +202,17 @@ class MASRPredictor:
             result = greedy_decoder(probs_seq=output_data, vocabulary=self._text_featurizer.vocab_list)
 
         score, text = result[0], result[1]
+        text = self.postprocess(text, use_pun=use_pun, is_itn=is_itn)
+        return score, text
+
+    def postprocess(self, text, use_pun=False, is_itn=False):
+        """
+        对解码得到的文本加标点符号和反标准化
+        :param text: 解码得到的文本
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :return: 处理后的文本
+        """
         # 加标点符号
         if use_pun and len(text) > 0:
             if self.pun_predictor is not None:
@@ -141,7 +222,7 @@ class MASRPredictor:
         # 是否对文本进行反标准化
         if is_itn:
             text = self.inverse_text_normalization(text)
-        return score, text
+        return text
 
     @staticmethod
     def _load_audio(audio_data, sample_rate=16000):
@@ -178,9 +259,7 @@ class MASRPredictor:
         :return: 识别的文本结果和解码的得分数
         """
         # 加载音频文件，并进行预处理
-        audio_segment = self._load_audio(audio_data=audio_data, sample_rate=sample_rate)
-        audio_feature = self._audio_featurizer.featurize(audio_segment)
-        input_data = np.array(audio_feature).astype(np.float32)[np.newaxis, :]
+        input_data = self.featurize(audio_data=audio_data, sample_rate=sample_rate)[np.newaxis, :]
         audio_len = np.array([input_data.shape[1]]).astype(np.int64)
 
         # 运行predictor
@@ -191,6 +270,113 @@ class MASRPredictor:
         result = {'text': text, 'score': score}
         return result
 
+    def featurize(self, audio_data, sample_rate=16000):
+        """
+        加载音频并提取特征
+        :param audio_data: 需要识别的数据，支持文件路径，文件对象，字节，numpy。如果是字节的话，必须是完整的字节文件
+        :param sample_rate: 如果传入的事numpy数据，需要指定采样率
+        :return: 音频特征，形状为(T, D)
+        """
+        audio_segment = self._load_audio(audio_data=audio_data, sample_rate=sample_rate)
+        audio_feature = self._audio_featurizer.featurize(audio_segment)
+        return np.array(audio_feature).astype(np.float32)
+
+    def predict_features(self, features, use_pun=False, is_itn=False):
+        """
+        批量预测已经提取好的音频特征，全部特征补齐到相同长度之后只执行一次模型
+        :param features: 音频特征列表，每个形状为(T, D)，可以通过featurize()获取
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :return: 每条音频的识别结果列表，顺序和输入一致
+        """
+        output_datas = self.predictor.predict_batch(features)
+        return self.decode_outputs(output_datas, use_pun=use_pun, is_itn=is_itn)
+
+    def decode_outputs(self, output_datas, use_pun=False, is_itn=False):
+        """
+        解码多条音频的模型输出结果
+        :param output_datas: 模型输出结果列表，每个形状为(T, vocab_size)，在模型所在设备上完成贪心解码时为得分和索引的元组
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :return: 每条音频的识别结果列表
+        """
+        if len(output_datas) == 0: return []
+        # 执行解码
+        if isinstance(output_datas[0], tuple):
+            decode_results = [(score, tokens_to_text(token_ids, self._text_featurizer.vocab_list))
+                              for score, token_ids in output_datas]
+        elif self.configs.decoder == 'ctc_beam_search':
+            # 集束搜索解码策略，多条音频并行解码
+            decode_results = self.beam_search_decoder.decode_batch_beam_search_offline(probs_split=output_datas,
+                                                                                       return_score=True)
+        else:
+            # 贪心解码策略
+            decode_results = greedy_decoder_batch(probs_split=output_datas, vocabulary=self._text_featurizer.vocab_list,
+                                                  return_score=True)
+        results = []
+        for score, text in decode_results:
+            text = self.postprocess(text, use_pun=use_pun, is_itn=is_itn)
+            results.append({'text': text, 'score': score})
+        return results
+
+    def predict_batch(self,
+                      audio_datas,
+                      use_pun=False,
+                      is_itn=False,
+                      sample_rate=16000,
+                      max_frames=60000,
+                      num_workers=4,
+                      decoder_pool=None):
+        """
+        批量预测多条完整的短语音，按特征长度排序后分成多个批次，每个批次只执行一次模型
+        :param audio_datas: 需要识别的数据列表，每个元素支持文件路径，文件对象，字节，numpy。如果是字节的话，必须是完整的字节文件
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :param sample_rate: 如果传入的事numpy数据，需要指定采样率
+        :param max_frames: 每个批次补齐之后的最大特征帧数，即批次大小乘以批次中最长的特征长度
+        :param num_workers: 并行提取特征的线程数量
+        :param decoder_pool: 集束搜索解码进程池DecoderPool，不为None时一个批次解码的同时执行下一个批次的模型计算
+        :return: 每条音频的识别文本结果和解码的得分数列表，顺序和输入一致
+        """
+        if len(audio_datas) == 0: return []
+        # 并行加载音频和提取特征
+        if num_workers > 1 and len(audio_datas) > 1:
+            with ThreadPoolExecutor(max_workers=min(num_workers, len(audio_datas))) as executor:
+                features = list(executor.map(lambda a: self.featurize(audio_data=a, sample_rate=sample_rate),
+                                             audio_datas))
+        else:
+            features = [self.featurize(audio_data=a, sample_rate=sample_rate) for a in audio_datas]
+        # 按特征长度从长到短排序，补齐的帧数不超过max_frames时放入同一个批次
+        sorted_indexes = sorted(range(len(features)), key=lambda i: features[i].shape[0], reverse=True)
+        batches, batch = [], []
+        for i in sorted_indexes:
+            # 批次中第一条特征最长，补齐之后的帧数为批次大小乘以第一条特征的长度
+            if len(batch) > 0 and (len(batch) + 1) * features[batch[0]].shape[0] > max_frames:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        batches.append(batch)
+        results = [None] * len(features)
+        if decoder_pool is None or self.configs.decoder != 'ctc_beam_search':
+            for batch in batches:
+                output_datas = self.predictor.predict_batch([features[i] for i in batch])
+                batch_results = self.decode_outputs(output_datas, use_pun=use_pun, is_itn=is_itn)
+                for i, result in zip(batch, batch_results):
+                    results[i] = result
+            return results
+        # 提交这个批次之后再等待上一个批次的解码结果
+        pending = []
+        for batch in batches + [None]:
+            if batch is not None:
+                output_datas = self.predictor.predict_batch([features[i] for i in batch])
+                pending.append((batch, decoder_pool.submit_batch(output_datas)))
+            if len(pending) > 1 or (batch is None and len(pending) > 0):
+                done_batch, future = pending.pop(0)
+                for i, nbest in zip(done_batch, future.result()):
+                    score, text = nbest[0]
+                    results[i] = {'text': self.postprocess(text, use_pun=use_pun, is_itn=is_itn), 'score': score}
+        return results
+
     # 长语音预测
     def predict_long(self,
                      audio_data,
@@ -242,7 +428,8 @@ class MASRPredictor:
                        is_itn=False,
                        channels=1,
                        samp_width=2,
-                       sample_rate=16000):
+                       sample_rate=16000,
+                       session=None):
         """
         预测函数，流式预测，通过一直输入音频数据，实现实时识别。
         :param audio_data: 需要预测的音频wave读取的字节流或者未预处理的numpy值
@@ -252,8 +439,99 @@ class MASRPredictor:
         :param channels: 如果传入的是pcm字节流数据，需要指定通道数
         :param samp_width: 如果传入的是pcm字节流数据，需要指定音频宽度
         :param sample_rate: 如果传入的是numpy或者pcm字节流数据，需要指定采样率
+        :param session: 流式识别会话，通过create_stream_session()创建，为None时使用默认会话
         :return: 识别的文本结果和解码的得分数
         """
+        if session is None:
+            session = self.stream_session
+        x_chunks = self._stream_feed(audio_data, is_end=is_end, session=session, channels=channels,
+                                     samp_width=samp_width, sample_rate=sample_rate)
+        if x_chunks is None: return None
+
+        score, text = None, None
+        for x_chunk in x_chunks:
+            # 执行识别
+            if self.configs.use_model == 'deepspeech2':
+                output_chunk_probs, output_lens = self.predictor.predict_chunk_deepspeech(x_chunk=x_chunk,
+                                                                                          session=session)
+            elif 'former' in self.configs.use_model:
+                output_chunk_probs = self.predictor.predict_chunk_conformer(x_chunk=x_chunk,
+                                                                            required_cache_size=self._required_cache_size(session),
+                                                                            session=session)
+                output_lens = np.array([self._chunk_output_len(output_chunk_probs)])
+            else:
+                raise Exception(f'当前模型不支持该方法，当前模型为：{self.configs.use_model}')
+            # 执行解码
+            score, text = self._stream_decode(output_chunk_probs, output_lens, session=session)
+        return self._stream_result(score, text, is_end=is_end, use_pun=use_pun, is_itn=is_itn)
+
+    def predict_stream_batch(self,
+                             audio_datas,
+                             sessions,
+                             is_ends=None,
+                             use_pun=False,
+                             is_itn=False,
+                             channels=1,
+                             samp_width=2,
+                             sample_rate=16000):
+        """
+        批量流式预测，同时处理多个流式识别会话的音频，conformer类模型会把多个会话的数据块合并成一个批次执行
+        :param audio_datas: 每个会话需要预测的音频字节流或者未预处理的numpy值列表
+        :param sessions: 每个音频对应的流式识别会话列表，通过create_stream_session()创建，不能重复
+        :param is_ends: 每个会话是否结束语音识别的列表，为None时全部未结束
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :param channels: 如果传入的是pcm字节流数据，需要指定通道数
+        :param samp_width: 如果传入的是pcm字节流数据，需要指定音频宽度
+        :param sample_rate: 如果传入的是numpy或者pcm字节流数据，需要指定采样率
+        :return: 每个会话的识别结果列表，和predict_stream()的返回值相同
+        """
+        assert len(audio_datas) == len(sessions), '音频数量和会话数量不一致'
+        assert len(set(id(s) for s in sessions)) == len(sessions), '同一个批次中不能有重复的会话'
+        if is_ends is None:
+            is_ends = [False] * len(sessions)
+        chunk_lists = [self._stream_feed(audio_data, is_end=is_end, session=session, channels=channels,
+                                         samp_width=samp_width, sample_rate=sample_rate)
+                       for audio_data, is_end, session in zip(audio_datas, is_ends, sessions)]
+        scores, texts = [None] * len(sessions), [None] * len(sessions)
+        num_rounds = max([len(c) for c in chunk_lists if c is not None], default=0)
+        # 每一轮取每个会话的一个数据块，保证同一个会话的数据块按顺序识别
+        for r in range(num_rounds):
+            indexes = [i for i, c in enumerate(chunk_lists) if c is not None and r < len(c)]
+            if 'former' in self.configs.use_model:
+                # 缓存大小不同的会话分开执行
+                cache_groups = {}
+                for i in indexes:
+                    cache_groups.setdefault(self._required_cache_size(sessions[i]), []).append(i)
+                outputs = {}
+                for required_cache_size, group in cache_groups.items():
+                    group_outputs = self.predictor.predict_chunk_conformer_batch(
+                        x_chunks=[chunk_lists[i][r] for i in group],
+                        required_cache_size=required_cache_size,
+                        sessions=[sessions[i] for i in group])
+                    for i, output in zip(group, group_outputs):
+                        outputs[i] = (output, np.array([self._chunk_output_len(output)]))
+                outputs = [outputs[i] for i in indexes]
+            elif self.configs.use_model == 'deepspeech2':
+                outputs = [self.predictor.predict_chunk_deepspeech(x_chunk=chunk_lists[i][r], session=sessions[i])
+                           for i in indexes]
+            else:
+                raise Exception(f'当前模型不支持该方法，当前模型为：{self.configs.use_model}')
+            for i, (output_chunk_probs, output_lens) in zip(indexes, outputs):
+                scores[i], texts[i] = self._stream_decode(output_chunk_probs, output_lens, session=sessions[i])
+        results = []
+        for i, chunks in enumerate(chunk_lists):
+            if chunks is None:
+                results.append(None)
+                continue
+            results.append(self._stream_result(scores[i], texts[i], is_end=is_ends[i], use_pun=use_pun, is_itn=is_itn))
+        return results
+
+    def _stream_feed(self, audio_data, is_end, session, channels=1, samp_width=2, sample_rate=16000):
+        """
+        把音频数据加入会话的缓存中，并切分出需要识别的数据块
+        :return: 需要识别的数据块列表，数据不足时返回None
+        """
         if not self.configs.streaming:
             raise Exception(
                 f"不支持改该模型流式识别，当前模型：{self.configs.use_model}，参数streaming为：{self.configs.streaming}")
@@ -265,32 +543,23 @@ class MASRPredictor:
                                                      samp_width=samp_width, sample_rate=sample_rate)
         else:
             raise Exception(f'不支持该数据类型，当前数据类型为：{type(audio_data)}')
-        if self.remained_wav is None:
-            self.remained_wav = audio_data
-        else:
-            self.remained_wav = AudioSegment(np.concatenate([self.remained_wav.samples, audio_data.samples]),
-                                             audio_data.sample_rate)
-
-        # 预处理语音块
-        x_chunk = self._audio_featurizer.featurize(self.remained_wav)
-        x_chunk = np.array(x_chunk).astype(np.float32)[np.newaxis, :]
-        if self.cached_feat is None:
-            self.cached_feat = x_chunk
-        else:
-            self.cached_feat = np.concatenate([self.cached_feat, x_chunk], axis=1)
-        self.remained_wav._samples = self.remained_wav.samples[160 * x_chunk.shape[1]:]
+        if session.featurizer is None:
+            session.featurizer = StreamingAudioFeaturizer(self._audio_featurizer)
+
+        # 只提取新增加的帧的特征
+        session.cached_feat.append(session.featurizer.featurize(audio_data))
 
         # 识别的数据块大小
-        decoding_chunk_size = 16
-        context = 7
-        subsampling = 4
+        decoding_chunk_size = session.decoding_chunk_size
+        context = self.right_context + 1
+        subsampling = self.subsampling_rate
 
         cached_feature_num = context - subsampling
         decoding_window = (decoding_chunk_size - 1) * subsampling + context
         stride = subsampling * decoding_chunk_size
 
         # 保证每帧数据长度都有效
-        num_frames = self.cached_feat.shape[1]
+        num_frames = session.cached_feat.num_frames
         if num_frames < decoding_window and not is_end: return None
         if num_frames < context: return None
 
@@ -300,58 +569,58 @@ class MASRPredictor:
         else:
             left_frames = decoding_window
 
-        score, text, end = None, None, None
+        x_chunks, end = [], None
         for cur in range(0, num_frames - left_frames + 1, stride):
             end = min(cur + decoding_window, num_frames)
             # 获取数据块
-            x_chunk = self.cached_feat[:, cur:end, :]
-
-            # 执行识别
-            if self.configs.use_model == 'deepspeech2':
-                output_chunk_probs, output_lens = self.predictor.predict_chunk_deepspeech(x_chunk=x_chunk)
-            elif 'former' in self.configs.use_model:
-                num_decoding_left_chunks = -1
-                required_cache_size = decoding_chunk_size * num_decoding_left_chunks
-                output_chunk_probs = self.predictor.predict_chunk_conformer(x_chunk=x_chunk,
-                                                                            required_cache_size=required_cache_size)
-                output_lens = np.array([output_chunk_probs.shape[1]])
-            else:
-                raise Exception(f'当前模型不支持该方法，当前模型为：{self.configs.use_model}')
-            # 执行解码
-            if self.configs.decoder == 'ctc_beam_search':
-                # 集束搜索解码策略
-                score, text = self.beam_search_decoder.decode_chunk(probs=output_chunk_probs, logits_lens=output_lens)
-            else:
-                # 贪心解码策略
-                score, text, self.greedy_last_max_prob_list, self.greedy_last_max_index_list = \
-                    greedy_decoder_chunk(probs_seq=output_chunk_probs[0], vocabulary=self._text_featurizer.vocab_list,
-                                         last_max_index_list=self.greedy_last_max_index_list,
-                                         last_max_prob_list=self.greedy_last_max_prob_list)
+            x_chunks.append(session.cached_feat.get(cur, end))
         # 更新特征缓存
-        self.cached_feat = self.cached_feat[:, end - cached_feature_num:, :]
+        session.cached_feat.drop(end - cached_feature_num)
+        return x_chunks
 
-        # 加标点符号
-        if use_pun and is_end and len(text) > 0:
-            if self.pun_predictor is not None:
-                text = self.pun_predictor(text)
+    @staticmethod
+    def _required_cache_size(session):
+        # conformer类模型下一个数据块需要的缓存大小
+        if session.num_decoding_left_chunks < 0: return -1
+        return session.decoding_chunk_size * session.num_decoding_left_chunks
+
+    @staticmethod
+    def _chunk_output_len(output):
+        # 在模型所在设备上完成贪心解码时，数据块的输出为每帧最大索引和最大概率的元组
+        if isinstance(output, tuple): return output[0].shape[1]
+        return output.shape[1]
+
+    def _stream_decode(self, output_chunk_probs, output_lens, session):
+        """对一个数据块的模型输出执行流式解码"""
+        if self.configs.decoder == 'ctc_beam_search':
+            # 集束搜索解码策略
+            score, text = self.beam_search_decoder.decode_chunk(probs=output_chunk_probs, logits_lens=output_lens,
+                                                                stream_state=session.beam_search_state)
+        else:
+            # 贪心解码策略，只解码新的帧
+            if session.greedy_decoder is None:
+                session.greedy_decoder = GreedyStreamDecoder(vocabulary=self._text_featurizer.vocab_list)
+            if isinstance(output_chunk_probs, tuple):
+                score, _ = session.greedy_decoder.decode_chunk_indices(max_index=output_chunk_probs[0][0],
+                                                                       max_prob=output_chunk_probs[1][0])
             else:
-                logger.warning('标点符号模型没有初始化！')
-        # 是否对文本进行反标准化
-        if is_itn:
-            text = self.inverse_text_normalization(text)
+                score, _ = session.greedy_decoder.decode_chunk(probs_seq=output_chunk_probs[0])
+            text = session.greedy_decoder.text
+        return score, text
 
+    def _stream_result(self, score, text, is_end, use_pun=False, is_itn=False):
+        """对流式识别的文本加标点符号和反标准化，只有结束时才加标点符号"""
+        text = self.postprocess(text, use_pun=use_pun and is_end, is_itn=is_itn)
         result = {'text': text, 'score': score}
         return result
 
     # 重置流式识别，每次流式识别完成之后都要执行
-    def reset_stream(self):
-        self.predictor.reset_stream()
-        self.remained_wav = None
-        self.cached_feat = None
-        self.greedy_last_max_prob_list = None
-        self.greedy_last_max_index_list = None
+    def reset_stream(self, session=None):
+        if session is None:
+            session = self.stream_session
+        self.predictor.reset_stream(session=session)
         if self.configs.decoder == 'ctc_beam_search':
-            self.beam_search_decoder.reset_decoder()
+            self.beam_search_decoder.reset_decoder(stream_state=session.beam_search_state)
 
     # 对文本进行反标准化
     def inverse_text_normalization(self, text):
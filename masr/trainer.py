@@ -2,6 +2,7 @@ import io
 import json
 import os
 import platform
+import random
 import shutil
 import time
 from collections import Counter
@@ -22,7 +23,8 @@ from masr.data_utils.featurizer.audio_featurizer import AudioFeaturizer
 from masr.data_utils.featurizer.text_featurizer import TextFeaturizer
 from masr.data_utils.normalizer import FeatureNormalizer
 from masr.data_utils.reader import MASRDataset
-from masr.data_utils.sampler import DSRandomSampler, DSElasticDistributedSampler
+from masr.data_utils.sampler import DSBucketingBatchSampler, DSRandomSampler, DSElasticDistributedSampler, \
+    DSSortedBatchSampler
 from masr.data_utils.utils import create_manifest_binary
 from masr.decoders.ctc_greedy_decoder import greedy_decoder_batch
 from masr.utils.logger import setup_logger
@@ -60,6 +62,7 @@ class MASRTrainer(object):
         self.model = None
         self.test_loader = None
         self.beam_search_decoder = None
+        self.decoder_pool = None
         if platform.system().lower() == 'windows':
             self.configs.dataset_conf.num_workers = 0
             self.configs.dataset_conf.prefetch_factor = 2
@@ -70,6 +73,8 @@ class MASRTrainer(object):
         self.eval_loss, self.eval_error_result = None, None
         self.test_log_step, self.train_log_step = 0, 0
         self.stop_train, self.stop_eval = False, False
+        # 恢复训练时要恢复的随机数生成器状态，在创建训练数据的迭代器之后再恢复
+        self.resume_rng_state = None
 
     def __setup_dataloader(self, augment_conf_path=None, is_train=False):
         # 获取训练数据
@@ -89,9 +94,19 @@ class MASRTrainer(object):
                                              max_duration=self.configs.dataset_conf.max_duration,
                                              augmentation_config=augmentation_config,
                                              manifest_type=self.configs.dataset_conf.manifest_type,
-                                             train=is_train)
+                                             train=is_train,
+                                             token_cache_dir=self.configs.dataset_conf.get('token_cache_dir', None))
+            max_frames_in_batch = self.configs.dataset_conf.get('max_frames_in_batch', 0)
+            if max_frames_in_batch > 0:
+                # 按特征帧数动态分批，多卡训练时每张卡的批次数量相同
+                self.train_batch_sampler = DSBucketingBatchSampler(self.train_dataset,
+                                                                   max_frames=max_frames_in_batch,
+                                                                   padded=self.configs.dataset_conf.get('batch_frames_type', 'padded') == 'padded',
+                                                                   sortagrad=True,
+                                                                   drop_last=True,
+                                                                   shuffle=True)
             # 设置支持多卡训练
-            if torch.cuda.device_count() > 1:
+            elif torch.cuda.device_count() > 1:
                 self.train_batch_sampler = DSElasticDistributedSampler(self.train_dataset,
                                                                        batch_size=self.configs.dataset_conf.batch_size,
                                                                        sortagrad=True,
@@ -113,55 +128,59 @@ class MASRTrainer(object):
                                         vocab_filepath=self.configs.dataset_conf.dataset_vocab,
                                         manifest_type=self.configs.dataset_conf.manifest_type,
                                         min_duration=self.configs.dataset_conf.min_duration,
-                                        max_duration=self.configs.dataset_conf.max_duration)
+                                        max_duration=self.configs.dataset_conf.max_duration,
+                                        token_cache_dir=self.configs.dataset_conf.get('token_cache_dir', None))
+        # 测试数据按长度排序之后分批，减少补齐的部分
+        self.test_batch_sampler = DSSortedBatchSampler(self.test_dataset,
+                                                       batch_size=self.configs.dataset_conf.batch_size)
         self.test_loader = DataLoader(dataset=self.test_dataset,
-                                      batch_size=self.configs.dataset_conf.batch_size,
                                       collate_fn=collate_fn,
+                                      batch_sampler=self.test_batch_sampler,
                                       num_workers=self.configs.dataset_conf.num_workers)
 
     # 提取特征保存文件
-    def extract_features(self, save_dir='dataset/features'):
+    def extract_features(self, save_dir='dataset/features', shard_duration=3600, feature_dtype='float32'):
+        """
+        提取全部数据的特征，按顺序保存到多个.npy特征分片中，并生成新的数据列表，
+        数据列表中每条数据的audio_filepath为特征分片的路径，start_frame和end_frame为这条数据在分片中的位置，
+        训练时以内存映射的方式打开分片，每条数据只读取需要的帧
+        :param save_dir: 保存特征的路径
+        :param shard_duration: 每个特征分片包含的音频总长度，单位为秒
+        :param feature_dtype: 保存特征的数据类型，支持float32、float16，float16可以减少一半的硬盘空间和读取量
+        """
+        assert feature_dtype in ['float32', 'float16'], f'不支持该数据类型：{feature_dtype}'
         for i, data_list_file in enumerate([self.configs.dataset_conf.train_manifest,
                                             self.configs.dataset_conf.test_manifest]):
-            save_dir1 = os.path.join(save_dir, data_list_file.split('.')[-1])
+            save_dir1 = os.path.join(save_dir, data_list_file.split('.')[-1], f'{int(time.time())}')
             os.makedirs(save_dir1, exist_ok=True)
             test_dataset = MASRDataset(preprocess_configs=self.configs.preprocess_conf,
                                        data_manifest=data_list_file,
                                        vocab_filepath=self.configs.dataset_conf.dataset_vocab,
                                        manifest_type=self.configs.dataset_conf.manifest_type,
                                        max_duration=-1)
-            save_dir_num = f'{int(time.time())}'
-            os.makedirs(os.path.join(str(save_dir1), save_dir_num), exist_ok=True)
-            all_feature, time_sum, index = None, 0, 0
+            shard_features, shard_frames, time_sum, shard_id = [], 0, 0, 0
+            save_path = os.path.join(save_dir1, f'shard_{shard_id:05d}.npy').replace('\\', '/')
             save_data_list = data_list_file.replace('manifest', 'manifest_features')
             with open(save_data_list, 'w', encoding='utf-8') as f:
                 for i in tqdm(range(len(test_dataset))):
                     feature, _ = test_dataset[i]
                     data_list = test_dataset.get_one_list(idx=i)
-                    time_sum += data_list['duration']
-                    if all_feature is None:
-                        index += 1
-                        all_feature = feature
-                        if index >= 1000:
-                            index = 0
-                            save_dir_num = f'{int(time.time())}'
-                            os.makedirs(os.path.join(str(save_dir1), save_dir_num), exist_ok=True)
-                        save_path = os.path.join(str(save_dir1), save_dir_num,
-                                                 f'{int(time.time() * 1000)}.npy').replace('\\', '/')
-                    else:
-                        all_feature = np.concatenate((all_feature, feature), axis=0)
                     new_data_list = {"audio_filepath": save_path,
                                      "duration": data_list['duration'],
                                      "text": data_list['text'],
-                                     "start_frame": all_feature.shape[0] - feature.shape[0],
-                                     "end_frame": all_feature.shape[0]}
+                                     "start_frame": shard_frames,
+                                     "end_frame": shard_frames + feature.shape[0]}
                     f.write(f'{json.dumps(new_data_list, ensure_ascii=False)}\n')
-                    if time_sum > 600:
-                        np.save(save_path, all_feature)
-                        all_feature, time_sum = None, 0
-                if all_feature is not None:
-                    np.save(save_path, all_feature)
-                    print(save_path)
+                    shard_features.append(feature.astype(feature_dtype))
+                    shard_frames += feature.shape[0]
+                    time_sum += data_list['duration']
+                    # 一个分片的音频总长度达到shard_duration之后再一次性写入
+                    if time_sum >= shard_duration:
+                        np.save(save_path, np.concatenate(shard_features, axis=0))
+                        shard_features, shard_frames, time_sum, shard_id = [], 0, 0, shard_id + 1
+                        save_path = os.path.join(save_dir1, f'shard_{shard_id:05d}.npy').replace('\\', '/')
+                if len(shard_features) > 0:
+                    np.save(save_path, np.concatenate(shard_features, axis=0))
             logger.info(f'[{data_list_file}]列表中的数据已提取特征完成，新列表为：[{save_data_list}]')
 
     def __setup_model(self, input_dim, vocab_size, is_train=False):
@@ -264,7 +283,7 @@ class MASRTrainer(object):
             logger.info(f'[GPU:{self.local_rank}] 成功加载预训练模型：{pretrained_model}')
 
     def __load_checkpoint(self, save_model_path, resume_model):
-        last_epoch = -1
+        last_epoch, train_batch_id = -1, 0
         best_error_rate = 1.0
         save_model_name = f'{self.configs.use_model}_{"streaming" if self.configs.streaming else "non-streaming"}' \
                           f'_{self.configs.preprocess_conf.feature_method}'
@@ -284,15 +303,47 @@ class MASRTrainer(object):
             with open(os.path.join(resume_model, 'model.state'), 'r', encoding='utf-8') as f:
                 json_data = json.load(f)
                 last_epoch = json_data['last_epoch'] - 1
+                # 在一轮的中间保存的模型，这一轮已经训练过的批次数量
+                train_batch_id = json_data.get('train_batch_id', 0)
                 if 'test_cer' in json_data.keys():
                     best_error_rate = abs(json_data['test_cer'])
                 if 'test_wer' in json_data.keys():
                     best_error_rate = abs(json_data['test_wer'])
+            # 旧版本保存的模型没有训练状态，只能从下一轮的开始继续训练
+            if os.path.exists(os.path.join(resume_model, 'train.pt')):
+                self.__load_train_state(torch.load(os.path.join(resume_model, 'train.pt')))
             logger.info(f'[GPU:{self.local_rank}] 成功恢复模型参数和优化方法参数：{resume_model}')
-        return last_epoch, best_error_rate
+        return last_epoch, best_error_rate, train_batch_id
+
+    # 获取学习率衰减、混合精度和随机数生成器的状态，用于从保存模型的位置继续训练
+    def __get_train_state(self):
+        np_state = np.random.get_state()
+        return {'scheduler': self.scheduler.state_dict(),
+                'amp_scaler': self.amp_scaler.state_dict() if self.configs.train_conf.enable_amp else None,
+                'rng_state': {'python': random.getstate(),
+                              # 转换为列表，torch.load只加载权重时也可以读取
+                              'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+                              'torch': torch.get_rng_state(),
+                              'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}}
+
+    def __load_train_state(self, train_state):
+        self.scheduler.load_state_dict(train_state['scheduler'])
+        if self.configs.train_conf.enable_amp and train_state['amp_scaler'] is not None:
+            self.amp_scaler.load_state_dict(train_state['amp_scaler'])
+        self.resume_rng_state = train_state['rng_state']
+
+    @staticmethod
+    def __set_rng_state(rng_state):
+        random.setstate(rng_state['python'])
+        np_state = rng_state['numpy']
+        np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+        torch.set_rng_state(rng_state['torch'])
+        if rng_state['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_state['cuda'])
 
     # 保存模型
-    def __save_checkpoint(self, save_model_path, epoch_id, error_rate=1.0, test_loss=1e3, is_best_model=False, save_as_best_model=False):
+    def __save_checkpoint(self, save_model_path, epoch_id, error_rate=1.0, test_loss=1e3, is_best_model=False,
+                          save_as_best_model=False, train_batch_id=None):
         if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
             state_dict = self.model.module.state_dict()
         else:
@@ -308,9 +359,13 @@ class MASRTrainer(object):
         os.makedirs(model_path, exist_ok=True)
         torch.save(self.optimizer.state_dict(), os.path.join(model_path, 'optimizer.pt'))
         torch.save(state_dict, os.path.join(model_path, 'model.pt'))
+        torch.save(self.__get_train_state(), os.path.join(model_path, 'train.pt'))
         with open(os.path.join(model_path, 'model.state'), 'w', encoding='utf-8') as f:
             data = {"last_epoch": epoch_id, f"test_{self.configs.metrics_type}": error_rate, "test_loss": test_loss,
                     "version": __version__}
+            # 在一轮的中间保存时，last_epoch为上一个完整训练的轮数，并记录这一轮已经训练过的批次数量
+            if train_batch_id is not None:
+                data['last_epoch'], data['train_batch_id'] = epoch_id - 1, train_batch_id
             f.write(json.dumps(data))
         if not save_as_best_model:
             logger.info('已保存模型：{}'.format(model_path))
@@ -334,27 +389,32 @@ class MASRTrainer(object):
     def __decoder_result(self, outs, vocabulary):
         # 集束搜索方法的处理
         if self.configs.decoder == "ctc_beam_search" and self.beam_search_decoder is None:
-            try:
-                from masr.decoders.beam_search_decoder import BeamSearchDecoder
-                self.beam_search_decoder = BeamSearchDecoder(vocab_list=vocabulary,
-                                                             **self.configs.ctc_beam_search_decoder_conf)
-            except ModuleNotFoundError:
-                logger.warning('==================================================================')
-                logger.warning('缺少 paddlespeech-ctcdecoders 库，请根据文档安装。')
+            from masr.decoders.beam_search_decoder import BeamSearchDecoder, NATIVE_DECODER
+            if not NATIVE_DECODER:
+                logger.warning('缺少 paddlespeech-ctcdecoders 库，使用NumPy实现的前缀集束搜索，解码速度较慢，可以执行以下命令安装。')
                 logger.warning(
                     'python -m pip install paddlespeech_ctcdecoders -U -i https://ppasr.yeyupiaoling.cn/pypi/simple/')
-                logger.warning('【注意】现在已自动切换为ctc_greedy解码器，ctc_greedy解码器准确率相对较低。')
-                logger.warning('==================================================================\n')
-                self.configs.decoder = 'ctc_greedy'
+            self.beam_search_decoder = BeamSearchDecoder(vocab_list=vocabulary,
+                                                         **self.configs.ctc_beam_search_decoder_conf)
 
         # 执行解码
-        outs = [outs[i, :, :] for i, _ in enumerate(range(outs.shape[0]))]
         if self.configs.decoder == 'ctc_greedy':
             result = greedy_decoder_batch(outs, vocabulary)
         else:
             result = self.beam_search_decoder.decode_batch_beam_search_offline(probs_split=outs)
         return result
 
+    # 创建集束搜索解码进程池，整个训练过程只创建一次，每个进程只加载一次语言模型
+    def __setup_decoder_pool(self, vocabulary, num_processes):
+        if self.decoder_pool is not None and self.decoder_pool.num_processes == num_processes:
+            return
+        if self.decoder_pool is not None:
+            self.decoder_pool.shutdown()
+        from masr.infer_utils.decoder_pool import DecoderPool
+        self.decoder_pool = DecoderPool(vocab_list=vocabulary,
+                                        decoder_conf=self.configs.ctc_beam_search_decoder_conf,
+                                        num_processes=num_processes)
+
     def __train_epoch(self, epoch_id, save_model_path, writer):
         accum_grad = self.configs.train_conf.accum_grad
         grad_clip = self.configs.train_conf.grad_clip
@@ -362,10 +422,21 @@ class MASRTrainer(object):
             model_context = self.model.join
         else:
             model_context = nullcontext
-        train_times, reader_times, batch_times, loss_sum = [], [], [], []
+        checkpoint_interval = self.configs.train_conf.get('checkpoint_interval', 10000)
+        train_times, reader_times, batch_times, loss_sum, train_utts = [], [], [], [], []
+        # 从一轮的中间恢复训练时，Sampler会跳过已经训练过的批次，batch_id从这个位置开始计数
+        start_batch = self.train_batch_sampler.batch_id
+        # 创建迭代器时DataLoader会使用随机数生成器，在一轮的中间保存的状态要在创建迭代器之后再恢复
+        if self.resume_rng_state is not None and start_batch == 0:
+            self.__set_rng_state(self.resume_rng_state)
+            self.resume_rng_state = None
+        train_iter = iter(self.train_loader)
+        if self.resume_rng_state is not None:
+            self.__set_rng_state(self.resume_rng_state)
+            self.resume_rng_state = None
         start = time.time()
         with model_context():
-            for batch_id, batch in enumerate(self.train_loader):
+            for batch_id, batch in enumerate(train_iter, start=start_batch):
                 if self.stop_train: break
                 inputs, labels, input_lens, label_lens = batch
                 reader_times.append((time.time() - start) * 1000)
@@ -407,6 +478,7 @@ class MASRTrainer(object):
                     self.optimizer.zero_grad()
                     self.scheduler.step()
                 loss_sum.append(loss.data.cpu().numpy())
+                train_utts.append(num_utts)
                 train_times.append((time.time() - start) * 1000)
                 batch_times.append((time.time() - start_step) * 1000)
                 self.train_step += 1
@@ -414,7 +486,7 @@ class MASRTrainer(object):
                 # 多卡训练只使用一个进程打印
                 if batch_id % self.configs.train_conf.log_interval == 0 and self.local_rank == 0:
                     # 计算每秒训练数据量
-                    train_speed = self.configs.dataset_conf.batch_size / (sum(train_times) / len(train_times) / 1000)
+                    train_speed = sum(train_utts) / (sum(train_times) / 1000)
                     # 计算剩余时间
                     self.train_eta_sec = (sum(train_times) / len(train_times)) * (self.max_step - self.train_step) / 1000
                     eta_str = str(timedelta(seconds=int(self.train_eta_sec)))
@@ -431,10 +503,15 @@ class MASRTrainer(object):
                     writer.add_scalar('Train/lr', self.scheduler.get_last_lr()[0], self.train_log_step)
                     writer.add_scalar('Train/Loss', self.train_loss, self.train_log_step)
                     self.train_log_step += 1
-                    train_times, reader_times, batch_times, loss_sum = [], [], [], []
-                # 固定步数也要保存一次模型
-                if batch_id % 10000 == 0 and batch_id != 0 and self.local_rank == 0:
-                    self.__save_checkpoint(save_model_path=save_model_path, epoch_id=epoch_id)
+                    train_times, reader_times, batch_times, loss_sum, train_utts = [], [], [], [], []
+                # 固定步数也要保存一次模型，只在刚更新完参数时保存，恢复训练时不会丢失累加的梯度
+                if batch_id % checkpoint_interval == 0 and batch_id % accum_grad == 0 \
+                        and batch_id != 0 and self.local_rank == 0:
+                    # 记录目前最好的错误率和最近一次评估的损失值，恢复训练之后不会把下一次评估误认为最好的模型
+                    self.__save_checkpoint(save_model_path=save_model_path, epoch_id=epoch_id,
+                                           error_rate=self.eval_best_error_rate,
+                                           test_loss=self.eval_loss if self.eval_loss is not None else 1e3,
+                                           train_batch_id=batch_id + 1)
                 start = time.time()
 
     def create_data(self,
@@ -512,7 +589,8 @@ class MASRTrainer(object):
             logger.info('=' * 70)
             logger.info('正在生成数据列表的二进制文件...')
             create_manifest_binary(train_manifest_path=self.configs.dataset_conf.train_manifest,
-                                   test_manifest_path=self.configs.dataset_conf.test_manifest)
+                                   test_manifest_path=self.configs.dataset_conf.test_manifest,
+                                   vocab_filepath=self.configs.dataset_conf.dataset_vocab)
             logger.info('数据列表的二进制文件生成完成！')
 
     def train(self,
@@ -556,19 +634,20 @@ class MASRTrainer(object):
 
         self.__load_pretrained(pretrained_model=pretrained_model)
         # 加载恢复模型
-        last_epoch, self.eval_best_error_rate = self.__load_checkpoint(save_model_path=save_model_path,
-                                                                       resume_model=resume_model)
+        last_epoch, self.eval_best_error_rate, train_batch_id = self.__load_checkpoint(save_model_path=save_model_path,
+                                                                                       resume_model=resume_model)
 
         self.train_loss = None
         self.test_log_step, self.train_log_step = 0, 0
         self.eval_loss, self.eval_error_result = None, None
         last_epoch += 1
-        self.train_batch_sampler.epoch = last_epoch
+        # 从保存模型时的下一个批次继续训练
+        self.train_batch_sampler.load_state_dict({'epoch': last_epoch, 'batch_id': train_batch_id})
         if self.local_rank == 0:
             writer.add_scalar('Train/lr', self.scheduler.get_last_lr()[0], last_epoch)
         # 最大步数
         self.max_step = len(self.train_loader) * self.configs.train_conf.max_epoch
-        self.train_step = max(last_epoch, 0) * len(self.train_loader)
+        self.train_step = max(last_epoch, 0) * len(self.train_loader) + train_batch_id
         # 开始训练
         for epoch_id in range(last_epoch, self.configs.train_conf.max_epoch):
             if self.stop_train: break
@@ -611,11 +690,14 @@ class MASRTrainer(object):
     def evaluate(self, resume_model='models/conformer_streaming_fbank/best_model/', display_result=False,
                  display_all_batch_id=False, portion_to_display_batch_id=4,
                  step_to_write_eval_txt=1000,
-                 epoch_id=-1):
+                 epoch_id=-1,
+                 num_decode_processes=0):
         """
         评估模型
         :param resume_model: 所使用的模型
         :param display_result: 是否打印识别结果
+        :param num_decode_processes: 集束搜索解码的进程数量，大于0时使用解码进程池，每个进程只加载一次语言模型，
+                                     一个批次解码的同时执行下一个批次的模型计算
         :return: 评估结果
         """
         if self.test_loader is None:
@@ -633,6 +715,11 @@ class MASRTrainer(object):
                 model_state_dict = torch.load(resume_model, map_location='cpu')
             self.model.load_state_dict(model_state_dict)
             logger.info(f'成功加载模型：{resume_model}')
+        # 测试数据没有数据增强，特征只提取一次，之后的评估都读取缓存，多卡训练时只有主进程评估，也只在主进程生成缓存
+        test_feature_cache_dir = self.configs.dataset_conf.get('test_feature_cache_dir', None)
+        if test_feature_cache_dir:
+            self.test_dataset.enable_feature_cache(cache_dir=test_feature_cache_dir,
+                                                   num_workers=self.configs.dataset_conf.num_workers)
         self.model.eval()
         if isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
             eval_model = self.model.module
@@ -645,6 +732,37 @@ class MASRTrainer(object):
         eval_txt_path = 'models/eval_epoch_' + str(epoch_id) + '.txt'
         f = open(eval_txt_path, 'w', encoding='utf-8')
         eval_result_buffer = ''
+        if num_decode_processes > 0 and self.configs.decoder == 'ctc_beam_search':
+            self.__setup_decoder_pool(self.test_dataset.vocab_list, num_decode_processes)
+            decoder_pool = self.decoder_pool
+        else:
+            decoder_pool = None
+
+        # 统计一个批次的解码结果
+        def add_batch_result(batch_id, out_strings, labels_str):
+            nonlocal eval_result_buffer
+            eval_result_buffer += '> ' + str(batch_id) + '\n'
+            for out_string, label in zip(*(out_strings, labels_str)):
+                eval_result_buffer += '|'.join(label) + '\n'
+                eval_result_buffer += '|'.join(out_string) + '\n'
+                # 计算字错率或者词错率
+                if self.configs.metrics_type == 'wer':
+                    error_rate = wer(out_string, label)
+                else:
+                    error_rate = cer(out_string, label)
+                error_results.append(error_rate)
+                if display_result:
+                    logger.info(f'实际标签为：{label}')
+                    logger.info(f'预测结果为：{out_string}')
+                    logger.info(f'这条数据的{self.configs.metrics_type}：{round(error_rate, 6)}，'
+                                f'当前{self.configs.metrics_type}：{round(sum(error_results) / len(error_results), 6)}')
+                    logger.info('-' * 70)
+            if batch_id % step_to_write_eval_txt == 0:
+                f.write(eval_result_buffer)
+                eval_result_buffer = ''
+
+        # 正在解码进程池中解码的批次
+        pending = None
         with torch.no_grad():
             tests = self.test_loader
             step_to_display_batch_id = len(tests) // portion_to_display_batch_id
@@ -653,36 +771,30 @@ class MASRTrainer(object):
             for batch_id, batch in enumerate(tests):
                 if self.stop_eval: break
                 inputs, labels, input_lens, label_lens = batch
+                # 标签还在CPU上，直接转换为文本
+                labels_str = labels_to_string(labels, self.test_dataset.vocab_list, eos=eos)
                 inputs = inputs.to(self.device)
                 labels = labels.to(self.device)
                 input_lens = input_lens.to(self.device)
-                loss_dict = eval_model(inputs, input_lens, labels, label_lens)
+                # 计算损失和解码使用同一次编码器的输出
+                loss_dict, outputs, output_lens = eval_model.forward_with_encoder_out(inputs, input_lens,
+                                                                                     labels, label_lens)
                 losses.append(loss_dict['loss'].cpu().detach().numpy())
-                # 获取模型编码器输出
-                outputs = eval_model.get_encoder_out(inputs, input_lens).cpu().detach().numpy()
-                out_strings = self.__decoder_result(outs=outputs, vocabulary=self.test_dataset.vocab_list)
-                labels_str = labels_to_string(labels, self.test_dataset.vocab_list, eos=eos)
+                outputs, output_lens = outputs.cpu().detach().numpy(), output_lens.cpu().numpy()
                 if display_all_batch_id or batch_id % step_to_display_batch_id == 0:
                     logger.info('Evaluate: %d / %d' % (batch_id, len(tests)))
-                eval_result_buffer += '> ' + str(batch_id) + '\n'
-                for out_string, label in zip(*(out_strings, labels_str)):
-                    eval_result_buffer += '|'.join(label) + '\n'
-                    eval_result_buffer += '|'.join(out_string) + '\n'
-                    # 计算字错率或者词错率
-                    if self.configs.metrics_type == 'wer':
-                        error_rate = wer(out_string, label)
-                    else:
-                        error_rate = cer(out_string, label)
-                    error_results.append(error_rate)
-                    if display_result:
-                        logger.info(f'实际标签为：{label}')
-                        logger.info(f'预测结果为：{out_string}')
-                        logger.info(f'这条数据的{self.configs.metrics_type}：{round(error_rate, 6)}，'
-                                    f'当前{self.configs.metrics_type}：{round(sum(error_results) / len(error_results), 6)}')
-                        logger.info('-' * 70)
-                if batch_id % step_to_write_eval_txt == 0:
-                    f.write(eval_result_buffer)
-                    eval_result_buffer = ''
+                if decoder_pool is None:
+                    outs = [outputs[i, :l] for i, l in enumerate(output_lens)]
+                    out_strings = self.__decoder_result(outs=outs, vocabulary=self.test_dataset.vocab_list)
+                    add_batch_result(batch_id, out_strings, labels_str)
+                    continue
+                # 提交这个批次之后再等待上一个批次的解码结果，解码和下一个批次的模型计算同时执行
+                future = decoder_pool.submit_batch(outputs, output_lens)
+                if pending is not None:
+                    add_batch_result(pending[0], [nbest[0][1] for nbest in pending[1].result()], pending[2])
+                pending = (batch_id, future, labels_str)
+            if pending is not None:
+                add_batch_result(pending[0], [nbest[0][1] for nbest in pending[1].result()], pending[2])
         f.write(eval_result_buffer)
         f.close()
         loss = float(sum(losses) / len(losses)) if len(losses) > 0 else -1
@@ -3,6 +3,7 @@ import os
 import urllib.request
 import zipfile
 
+import numpy as np
 from tqdm import tqdm
 
 from masr.utils.logger import setup_logger
@@ -57,11 +58,11 @@ def dict_to_object(dict_obj):
 
 
 def labels_to_string(label, vocabulary, eos, blank_index=0):
-    labels = []
-    for l in label:
-        index_list = [index for index in l if index != blank_index and index != -1 and index != eos]
-        labels.append([vocabulary[index].replace('<space>', ' ').replace('<unk>', '') for index in index_list])
-    return labels
+    # 传入设备上的张量时只复制一次到CPU，之后使用NumPy批量处理
+    label = np.asarray(label.cpu() if hasattr(label, 'cpu') else label)
+    vocabulary = np.array([v.replace('<space>', ' ').replace('<unk>', '') for v in vocabulary], dtype=object)
+    valid = (label != blank_index) & (label != -1) & (label != eos)
+    return [vocabulary[l[v]].tolist() for l, v in zip(label, valid)]
 
 
 # 使用模糊删除方式删除文件
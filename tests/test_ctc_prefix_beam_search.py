@@ -0,0 +1,57 @@
+"""NumPy前缀集束搜索和逐个前缀计算的参考实现比较"""
+from collections import defaultdict
+
+import numpy as np
+
+from masr.decoders.ctc_prefix_beam_search import CTCBeamSearchDecoder, ctc_beam_search_decoding
+
+VOCABULARY = ['<blank>', 'a', 'b', 'c']
+
+
+def reference_decoding(probs_seq, beam_size, blank_id=0):
+    """用字典保存每个前缀的参考实现，没有剪枝和语言模型"""
+    beams = {(): (0.0, -np.inf)}
+    with np.errstate(divide='ignore'):
+        log_probs_seq = np.log(probs_seq)
+    for log_probs in log_probs_seq:
+        next_beams = defaultdict(lambda: [-np.inf, -np.inf])
+        for prefix, (log_prob_b, log_prob_nb) in beams.items():
+            total = np.logaddexp(log_prob_b, log_prob_nb)
+            next_beams[prefix][0] = np.logaddexp(next_beams[prefix][0], total + log_probs[blank_id])
+            if len(prefix) > 0:
+                next_beams[prefix][1] = np.logaddexp(next_beams[prefix][1], log_prob_nb + log_probs[prefix[-1]])
+            for token in range(len(log_probs)):
+                if token == blank_id: continue
+                new_prefix = prefix + (token,)
+                from_prob = log_prob_b if len(prefix) > 0 and prefix[-1] == token else total
+                next_beams[new_prefix][1] = np.logaddexp(next_beams[new_prefix][1], from_prob + log_probs[token])
+        ranked = sorted(next_beams.items(), key=lambda b: -np.logaddexp(*b[1]))[:beam_size]
+        beams = {prefix: tuple(probs) for prefix, probs in ranked}
+    return sorted(((float(np.logaddexp(*probs)), ''.join(VOCABULARY[t] for t in prefix))
+                   for prefix, probs in beams.items()), reverse=True)
+
+
+def test_same_as_reference():
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        probs_seq = rng.dirichlet(np.ones(len(VOCABULARY)) * 0.5, size=rng.randint(1, 30))
+        beam_size = rng.randint(2, 5)
+        results = ctc_beam_search_decoding(probs_seq, VOCABULARY, beam_size, cutoff_top_n=len(VOCABULARY))
+        expected = reference_decoding(probs_seq, beam_size)
+        texts = [text for _, text in results]
+        assert len(set(texts)) == len(texts)
+        assert texts[0] == expected[0][1]
+        np.testing.assert_allclose(sorted(score for score, _ in results), sorted(score for score, _ in expected))
+
+
+def test_long_stream_compacts_trie():
+    rng = np.random.RandomState(1)
+    probs_seq = rng.dirichlet(np.ones(len(VOCABULARY)) * 0.5, size=3000)
+    decoder = CTCBeamSearchDecoder(VOCABULARY, batch_size=1, beam_size=4, num_processes=1,
+                                   cutoff_prob=1.0, cutoff_top_n=len(VOCABULARY), _ext_scorer=None, blank_id=0)
+    for chunk in np.array_split(probs_seq, 100):
+        decoder.next([chunk], ['true'])
+    state = decoder.states[0]
+    assert len(state.node_parents) <= state.max_nodes
+    assert len(state.node_parents) == len(state.node_tokens) == len(state.lm_states)
+    assert decoder.decode()[0] == ctc_beam_search_decoding(probs_seq, VOCABULARY, 4, cutoff_top_n=len(VOCABULARY))
@@ -0,0 +1,42 @@
+"""按特征帧数动态分批的Sampler"""
+import numpy as np
+
+from masr.data_utils.sampler import DSBucketingBatchSampler
+
+MAX_FRAMES = 20000
+
+
+class FakeDataset:
+    def __init__(self, num_data):
+        self.num_frames = np.random.RandomState(1).randint(50, 3200, num_data)
+
+    def __len__(self):
+        return len(self.num_frames)
+
+
+def test_same_number_of_batches_on_every_rank():
+    dataset = FakeDataset(1003)
+    for padded in [True, False]:
+        for num_replicas in [1, 3, 4]:
+            for drop_last in [True, False]:
+                samplers = [DSBucketingBatchSampler(dataset, MAX_FRAMES, padded=padded, num_replicas=num_replicas,
+                                                    rank=rank, shuffle=True, drop_last=drop_last, sortagrad=True)
+                            for rank in range(num_replicas)]
+                for _ in range(4):
+                    rank_batches = [list(sampler) for sampler in samplers]
+                    assert all(len(batches) == len(samplers[0]) for batches in rank_batches)
+                    all_batches = [batch for batches in rank_batches for batch in batches]
+                    for batch in all_batches:
+                        num_frames = dataset.num_frames[batch]
+                        cost = num_frames.max() * len(batch) if padded else num_frames.sum()
+                        assert cost <= MAX_FRAMES or len(batch) == 1
+                    if not drop_last:
+                        assert {idx for batch in all_batches for idx in batch} == set(range(len(dataset)))
+
+
+def test_batches_change_between_epochs():
+    dataset = FakeDataset(5000)
+    sampler = DSBucketingBatchSampler(dataset, MAX_FRAMES, shuffle=True, drop_last=True)
+    epochs = [set(frozenset(batch) for batch in sampler) for _ in range(3)]
+    for batches, next_batches in zip(epochs, epochs[1:]):
+        assert len(batches & next_batches) < len(batches) // 2
@@ -0,0 +1,62 @@
+"""多进程识别工作池，fork出的工作进程使用多个线程"""
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+import torch
+
+from masr.infer_utils.worker_pool import PredictorWorkerPool
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在新的进程中执行，主进程的线程数量不受pytest中其他测试的影响
+WORKER_POOL_SCRIPT = textwrap.dedent("""
+    import asyncio
+
+    import torch
+
+    from masr.infer_utils.worker_pool import PredictorWorkerPool
+
+
+    class FakePredictor:
+        def featurize(self, audio_data):
+            return torch.full((256, 256), float(audio_data))
+
+        def predict_features(self, features, use_pun=False, is_itn=False):
+            return [{'text': str(torch.get_num_threads()), 'score': float((f @ f).sum())} for f in features]
+
+
+    # 和infer_server.py一样，主进程只使用一个线程加载和预热模型
+    torch.set_num_threads(1)
+    (torch.ones(512, 512) @ torch.ones(512, 512)).sum()
+    pool = PredictorWorkerPool(FakePredictor(), num_workers=2, num_threads=4)
+
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(*[pool.predict(i) for i in range(8)]), timeout=60)
+
+
+    results = asyncio.run(main())
+    pool.close()
+    assert [r['text'] for r in results] == ['4'] * 8, results
+    assert [r['score'] for r in results] == [256.0 ** 3 * i * i for i in range(8)], results
+""")
+
+
+def test_multi_thread_workers():
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    result = subprocess.run([sys.executable, '-c', WORKER_POOL_SCRIPT], cwd=ROOT_DIR, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+
+
+def test_reject_multi_thread_parent():
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(2)
+    try:
+        with pytest.raises(Exception, match='set_num_threads'):
+            PredictorWorkerPool(predictor=None, num_workers=1, num_threads=4)
+    finally:
+        torch.set_num_threads(num_threads)
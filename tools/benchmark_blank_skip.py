@@ -0,0 +1,89 @@
+"""测试集束搜索之前跳过空白帧在不同阈值下的解码时间和错误率"""
+import os
+import sys
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(__dir__)
+sys.path.append(os.path.abspath(os.path.join(__dir__, '..')))
+
+import argparse
+import functools
+import time
+
+import numpy as np
+import yaml
+from tqdm import tqdm
+
+from masr.data_utils.audio import AudioSegment
+from masr.data_utils.featurizer.audio_featurizer import AudioFeaturizer
+from masr.data_utils.featurizer.text_featurizer import TextFeaturizer
+from masr.data_utils.utils import read_manifest
+from masr.decoders.beam_search_decoder import BeamSearchDecoder
+from masr.decoders.blank_skip import skip_blank_frames
+from masr.infer_utils.inference_predictor import InferencePredictor
+from masr.utils.metrics import cer, wer
+from masr.utils.utils import add_arguments, print_arguments, dict_to_object
+
+parser = argparse.ArgumentParser(description=__doc__)
+add_arg = functools.partial(add_arguments, argparser=parser)
+add_arg('configs',          str,   'configs/conformer.yml',     "配置文件")
+add_arg('model_path',       str,   'models/conformer_streaming_fbank/inference.pt', "导出的预测模型文件路径")
+add_arg('test_manifest',    str,   None,                        "测试数据的数据列表路径，为None时使用配置文件中的测试数据")
+add_arg('num_data',         int,   200,                         "用于测试的数据数量，当为-1时使用全部数据")
+add_arg('thresholds',       str,   '1.0,0.9999,0.999,0.99,0.95,0.9', "需要测试的空白帧概率阈值，用逗号分隔，1.0为不跳过")
+add_arg('use_gpu',          bool,  True,                        "是否使用GPU预测")
+add_arg('metrics_type',     str,   'cer',                       "计算错误率方法", choices=['cer', 'wer'])
+args = parser.parse_args()
+
+
+def main():
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    print_arguments(args=args)
+    test_manifest = args.test_manifest or configs.dataset_conf.test_manifest
+    data_list = read_manifest(test_manifest)
+    if args.num_data > 0:
+        data_list = data_list[:args.num_data]
+    text_featurizer = TextFeaturizer(vocab_filepath=configs.dataset_conf.dataset_vocab)
+    audio_featurizer = AudioFeaturizer(**configs.preprocess_conf)
+    predictor = InferencePredictor(configs=configs,
+                                   use_model=configs.use_model,
+                                   streaming=configs.streaming,
+                                   model_path=args.model_path,
+                                   use_gpu=args.use_gpu)
+
+    # 只执行一次模型，全部阈值都使用相同的模型输出
+    print('开始识别数据...')
+    outputs, labels = [], []
+    for data in tqdm(data_list):
+        audio_segment = AudioSegment.from_file(data['audio_filepath'])
+        feature = np.array(audio_featurizer.featurize(audio_segment)).astype(np.float32)
+        outputs.append(predictor.predict_batch([feature])[0])
+        label = data['text']
+        labels.append(''.join(label) if isinstance(label, list) else label)
+    total_frames = sum(len(output) for output in outputs)
+    total_duration = sum(data['duration'] for data in data_list)
+
+    results = []
+    for threshold in [float(t) for t in args.thresholds.split(',')]:
+        decoder_conf = dict(configs.ctc_beam_search_decoder_conf)
+        decoder_conf['blank_skip_threshold'] = threshold
+        decoder = BeamSearchDecoder(vocab_list=text_featurizer.vocab_list, **decoder_conf)
+        kept_frames = sum(len(skip_blank_frames(output, threshold, blank_id=decoder.blank_id)[0])
+                          for output in outputs)
+        errors, decode_time = [], 0.0
+        for output, label in zip(tqdm(outputs, desc=f'阈值{threshold}'), labels):
+            start = time.time()
+            _, text = decoder.decode_beam_search_offline(probs_split=output)
+            decode_time += time.time() - start
+            errors.append(wer(text, label) if args.metrics_type == 'wer' else cer(text, label))
+        results.append((threshold, kept_frames / total_frames, decode_time, sum(errors) / len(errors)))
+
+    print(f'数据数量：{len(outputs)}，音频总长度：{total_duration:.2f}s，模型输出总帧数：{total_frames}')
+    print(f'|  阈值  | 保留帧比例 | 解码时间(s) | 解码实时率 | {args.metrics_type} |')
+    for threshold, kept_ratio, decode_time, error in results:
+        print(f'| {threshold} | {kept_ratio:.4f} | {decode_time:.2f} | {decode_time / total_duration:.4f} | {error:.5f} |')
+
+
+if __name__ == '__main__':
+    main()
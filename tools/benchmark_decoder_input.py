@@ -0,0 +1,71 @@
+"""测试集束搜索解码时概率转换为解码器输入的时间和集束搜索本身的时间"""
+import os
+import sys
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(__dir__)
+sys.path.append(os.path.abspath(os.path.join(__dir__, '..')))
+
+import argparse
+import functools
+import time
+
+import numpy as np
+
+from masr.decoders import swig_wrapper
+from masr.utils.utils import add_arguments, print_arguments
+
+parser = argparse.ArgumentParser(description=__doc__)
+add_arg = functools.partial(add_arguments, argparser=parser)
+add_arg('num_frames',       int,    1500,   "模型输出的帧数，1500帧约为60秒的音频")
+add_arg('vocab_size',       int,    5000,   "词汇表大小，包括空白")
+add_arg('beam_size',        int,    300,    "集束搜索的大小")
+add_arg('cutoff_prob',      float,  0.99,   "剪枝的概率")
+add_arg('cutoff_top_n',     int,    40,     "剪枝的最大值")
+add_arg('num_repeats',      int,    5,      "重复测试的次数")
+add_arg('language_model_path', str, None,   "语言模型文件路径，为None时不使用语言模型")
+args = parser.parse_args()
+
+
+# 生成类似模型输出的概率，大部分帧都是空白帧
+def make_probs(num_frames, vocab_size, seed=0):
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(num_frames, vocab_size).astype(np.float32)
+    logits[:, 0] += rng.choice([0, 12], num_frames, p=[0.3, 0.7])
+    probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
+def timeit(func, num_repeats):
+    times = []
+    for _ in range(num_repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times) * 1000
+
+
+def main():
+    print_arguments(args=args)
+    probs = make_probs(args.num_frames, args.vocab_size)
+    vocab_list = [chr(0x4e00 + i) for i in range(args.vocab_size - 1)]
+    scorer = None
+    if args.language_model_path:
+        scorer = swig_wrapper.Scorer(2.2, 4.3, args.language_model_path, vocab_list)
+
+    list_time = timeit(lambda: swig_wrapper.to_decoder_input(probs), args.num_repeats)
+    print(f'转换全部概率为Python列表的时间：{list_time:.2f}ms')
+    top_n_time = timeit(lambda: swig_wrapper.to_decoder_input(probs, cutoff_top_n=args.cutoff_top_n), args.num_repeats)
+    print(f'只转换每帧最大的cutoff_top_n个概率的时间：{top_n_time:.2f}ms')
+    probs_list = swig_wrapper.to_decoder_input(probs, cutoff_top_n=args.cutoff_top_n)
+    search_time = timeit(lambda: swig_wrapper.paddlespeech_ctcdecoders.ctc_beam_search_decoding(
+        probs_list, vocab_list, args.beam_size, args.cutoff_prob, args.cutoff_top_n, scorer, 0), args.num_repeats)
+    print(f'传入Python列表的集束搜索时间：{search_time:.2f}ms')
+    total_time = timeit(lambda: swig_wrapper.ctc_beam_search_decoding(
+        probs, vocab_list, args.beam_size, args.cutoff_prob, args.cutoff_top_n, 0, scorer), args.num_repeats)
+    print(f'ctc_beam_search_decoding()的总时间：{total_time:.2f}ms，'
+          f'其中转换输入占比：{(total_time - search_time) / total_time * 100:.1f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,129 +6,220 @@ __dir__ = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(__dir__)
 sys.path.append(os.path.abspath(os.path.join(__dir__, '..')))
 
-import numpy as np
 import argparse
 import functools
-from masr.decoders.beam_search_decoder import BeamSearchDecoder
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
+import yaml
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
-from masr.utils.utils import add_arguments, print_arguments
 from masr.data_utils.reader import MASRDataset
-from masr.data_utils.collate_fn import collate_fn
-from masr.model_utils.deepspeech2.model import DeepSpeech2Model
+from masr.decoders.beam_search_decoder import BeamSearchDecoder
+from masr.infer_utils.inference_predictor import InferencePredictor
+from masr.infer_utils.posterior_store import PosteriorStore, PosteriorStoreWriter
+from masr.utils.logger import setup_logger
 from masr.utils.metrics import cer, wer
-from masr.utils.utils import labels_to_string
+from masr.utils.utils import add_arguments, print_arguments, dict_to_object, labels_to_string
 
+logger = setup_logger(__name__)
 
 parser = argparse.ArgumentParser(description=__doc__)
 add_arg = functools.partial(add_arguments, argparser=parser)
-add_arg('num_data',         int,    -1,    "用于评估的数据数量，当为-1时使用全部数据")
-add_arg('batch_size',       int,    16,    "评估是每一批数据的大小")
-add_arg('beam_size',        int,    300,   "定向搜索的大小，范围建议:[5, 500]")
-add_arg('num_proc_bsearch', int,    10,    "定向搜索方法使用CPU数量")
-add_arg('num_alphas',       int,    30,    "用于调优的alpha候选项")
-add_arg('num_betas',        int,    20,    "用于调优的beta候选项")
-add_arg('alpha_from',       float,  1.0,   "alpha调优开始大小")
-add_arg('alpha_to',         float,  3.2,   "alpha调优结速大小")
-add_arg('beta_from',        float,  0.1,   "beta调优开始大小")
-add_arg('beta_to',          float,  4.5,   "beta调优结速大小")
-add_arg('cutoff_prob',      float,  0.99,  "剪枝的概率")
-add_arg('cutoff_top_n',     int,    40,    "剪枝的最大值")
-add_arg('use_model',        str,   'deepspeech2',             '所使用的模型')
-add_arg('test_manifest',    str,   'dataset/manifest.test',   '测试数据的数据列表路径')
-add_arg('dataset_vocab',    str,   'dataset/vocabulary.txt',  '数据字典的路径')
-add_arg('mean_std_path',    str,   'dataset/mean_std.npz',    '数据集的均值和标准值的npy文件路径')
-add_arg('resume_model',     str,   'models/deepspeech2/best_model/', '模型的路径')
-add_arg('metrics_type',     str,   'cer',                '计算错误率方法', choices=['cer', 'wer'])
-add_arg('feature_method',   str,   'linear',             '音频预处理方法', choices=['linear', 'mfcc', 'fbank'])
-add_arg('lang_model_path',  str,   'lm/zh_giga.no_cna_cmn.prune01244.klm',        "语言模型文件路径")
+add_arg('configs',          str,    'configs/conformer.yml',     "配置文件")
+add_arg('model_path',       str,    'models/conformer_streaming_fbank/inference.pt', "导出的预测模型文件路径")
+add_arg('test_manifest',    str,    None,                        "测试数据的数据列表路径，为None时使用配置文件中的测试数据")
+add_arg('num_data',         int,    -1,     "用于评估的数据数量，当为-1时使用全部数据")
+add_arg('use_gpu',          bool,   True,   "是否使用GPU执行模型")
+add_arg('cache_dir',        str,    'models/tune_cache',         "模型输出的缓存路径，模型或者数据没有变化时直接使用缓存")
+add_arg('overwrite_cache',  bool,   False,  "是否重新执行模型覆盖已有的缓存")
+add_arg('top_k',            int,    40,     "每帧只缓存最大的top_k个概率，不能小于cutoff_top_n，为0时缓存完整的概率")
+add_arg('num_processes',    int,    10,     "并行搜索参数的进程数量，每个进程只加载一次语言模型")
+add_arg('beam_size',        int,    -1,     "集束搜索的大小，为-1时使用配置文件中的参数")
+add_arg('language_model_path', str, None,   "语言模型文件路径，为None时使用配置文件中的参数")
+add_arg('num_alphas',       int,    10,     "每一轮搜索的alpha候选项数量")
+add_arg('num_betas',        int,    10,     "每一轮搜索的beta候选项数量")
+add_arg('alpha_from',       float,  1.0,    "alpha调优开始大小")
+add_arg('alpha_to',         float,  3.2,    "alpha调优结束大小")
+add_arg('beta_from',        float,  0.1,    "beta调优开始大小")
+add_arg('beta_to',          float,  4.5,    "beta调优结束大小")
+add_arg('num_rounds',       int,    3,      "由粗到细搜索的轮数，之后每一轮在上一轮最优参数相邻的网格内搜索")
+add_arg('early_stop',       bool,   True,   "部分数据的错误率已经不可能优于当前最优参数时提前停止这组参数的解码")
 args = parser.parse_args()
-print_arguments(args)
+
+# 每个搜索进程独立的缓存、解码器和当前最优参数的错误率之和
+_store = None
+_decoder = None
+_metrics_type = None
+_best_error_sum = None
+
+
+def _init_worker(cache_dir, vocab_list, decoder_conf, metrics_type, best_error_sum):
+    global _store, _decoder, _metrics_type, _best_error_sum
+    _store = PosteriorStore(cache_dir)
+    _decoder = BeamSearchDecoder(vocab_list=vocab_list, **decoder_conf)
+    _metrics_type = metrics_type
+    _best_error_sum = best_error_sum
+
+
+def _evaluate_params(alpha, beta, early_stop):
+    # 解码时通过reset_params修改语言模型的参数，不需要重新加载语言模型
+    _decoder.alpha, _decoder.beta = alpha, beta
+    error_sum = 0.0
+    for i in range(len(_store)):
+        probs, label = _store.get(i)
+        _, text = _decoder.decode_beam_search_offline(probs_split=probs)
+        error_sum += wer(text, label) if _metrics_type == 'wer' else cer(text, label)
+        # 错误率之和只会增加，超过最优参数全部数据的错误率之和时这组参数不可能是最优的
+        if early_stop and error_sum > _best_error_sum.value:
+            return alpha, beta, None, i + 1
+    with _best_error_sum.get_lock():
+        if error_sum < _best_error_sum.value:
+            _best_error_sum.value = error_sum
+    return alpha, beta, error_sum / len(_store), len(_store)
+
+
+def _list_collate(batch):
+    return batch
+
+
+# 执行一次模型，把全部测试数据的模型输出写入缓存
+def create_cache(configs, test_dataset, metadata):
+    predictor = InferencePredictor(configs=configs,
+                                   use_model=configs.use_model,
+                                   streaming=configs.streaming,
+                                   model_path=args.model_path,
+                                   use_gpu=args.use_gpu,
+                                   output_type='topk' if args.top_k > 0 else 'probs',
+                                   top_k=args.top_k)
+    num_data = len(test_dataset) if args.num_data == -1 else min(args.num_data, len(test_dataset))
+    test_loader = DataLoader(dataset=Subset(test_dataset, range(num_data)),
+                             batch_size=configs.dataset_conf.batch_size,
+                             collate_fn=_list_collate,
+                             num_workers=configs.dataset_conf.num_workers)
+    eos = test_dataset.vocab_size - 1
+    idx, num_skip = 0, 0
+    print('开始识别数据...')
+    with PosteriorStoreWriter(args.cache_dir, vocab_size=test_dataset.vocab_size, top_k=args.top_k,
+                              metadata=metadata) as writer, torch.no_grad():
+        for batch in tqdm(test_loader):
+            outputs = predictor.predict_batch([feature for feature, _ in batch])
+            for output, (_, transcript) in zip(outputs, batch):
+                data = test_dataset.get_one_list(idx)
+                idx += 1
+                label = ''.join(labels_to_string([transcript], test_dataset.vocab_list, eos=eos)[0])
+                # 没有标注文本的数据无法计算错误率
+                if len(label) == 0:
+                    num_skip += 1
+                    continue
+                key = data['audio_filepath']
+                if 'start_time' in data.keys():
+                    key = f"{key}:{data['start_time']}-{data['end_time']}"
+                writer.add(key, output, label)
+    if num_skip > 0:
+        logger.warning(f'跳过了{num_skip}条没有标注文本的数据')
 
 
 def tune():
-    # 逐步调整alphas参数和betas参数
-    if not args.num_alphas >= 0:
-        raise ValueError("num_alphas must be non-negative!")
-    if not args.num_betas >= 0:
-        raise ValueError("num_betas must be non-negative!")
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    print_arguments(args=args)
+    if args.num_alphas <= 0 or args.num_betas <= 0:
+        raise Exception('num_alphas和num_betas必须大于0')
+    decoder_conf = dict(configs.ctc_beam_search_decoder_conf)
+    if 0 < args.top_k < decoder_conf['cutoff_top_n']:
+        logger.warning(f"top_k小于cutoff_top_n（{decoder_conf['cutoff_top_n']}），解码结果会和实际预测时不同")
+    decoder_conf['num_processes'] = 1
+    if args.beam_size > 0:
+        decoder_conf['beam_size'] = args.beam_size
+    if args.language_model_path is not None:
+        decoder_conf['language_model_path'] = args.language_model_path
 
     # 获取测试数据
-    test_dataset = MASRDataset(args.test_manifest, args.dataset_vocab, args.mean_std_path,
-                               feature_method=args.feature_method)
-    test_loader = DataLoader(dataset=test_dataset,
-                             batch_size=args.batch_size,
-                             collate_fn=collate_fn)
-
-    # 获取模型
-    if args.use_model == 'deepspeech2':
-        model = DeepSpeech2Model(feat_size=test_dataset.feature_dim, vocab_size=test_dataset.vocab_size)
+    test_manifest = args.test_manifest or configs.dataset_conf.test_manifest
+    test_dataset = MASRDataset(preprocess_configs=configs.preprocess_conf,
+                               data_manifest=test_manifest,
+                               vocab_filepath=configs.dataset_conf.dataset_vocab,
+                               manifest_type=configs.dataset_conf.manifest_type,
+                               min_duration=configs.dataset_conf.min_duration,
+                               max_duration=configs.dataset_conf.max_duration)
+    # 模型、数据或者缓存方式有变化时缓存失效
+    assert os.path.exists(args.model_path), f'模型不存在：{args.model_path}'
+    metadata = {'model_path': os.path.abspath(args.model_path),
+                'model_mtime': os.path.getmtime(args.model_path),
+                'test_manifest': os.path.abspath(test_manifest),
+                'num_data': args.num_data,
+                'top_k': args.top_k}
+    if not args.overwrite_cache and PosteriorStore.exists(args.cache_dir) \
+            and PosteriorStore(args.cache_dir).metadata == metadata:
+        logger.info(f'模型和数据没有变化，使用已有的模型输出缓存：{args.cache_dir}')
     else:
-        raise Exception('没有该模型：%s' % args.use_model)
-
-    assert os.path.exists(os.path.join(args.resume_model, 'model.pt')), "模型不存在！"
-    model.cuda()
-    model.load_state_dict(torch.load(os.path.join(args.resume_model, 'model.pt')))
-    model.eval()
-
-    # 创建用于搜索的alphas参数和betas参数
-    cand_alphas = np.linspace(args.alpha_from, args.alpha_to, args.num_alphas)
-    cand_betas = np.linspace(args.beta_from, args.beta_to, args.num_betas)
-    params_grid = [(round(alpha, 2), round(beta, 2)) for alpha in cand_alphas for beta in cand_betas]
-
-    outputs = []
-    labels = []
-    # 多批增量调优参数
-    print('开始识别数据...')
-    used_sum = 0
-    for inputs, label, input_lens, _ in tqdm(test_loader):
-        inputs = inputs.cuda()
-        label = label.cuda()
-        used_sum += inputs.shape[0]
-        # 执行识别
-        outs, out_lens, _ = model(inputs, input_lens)
-        outs = torch.nn.functional.softmax(outs, 2)
-        outs = outs.cpu().detach().numpy()
-        outputs.append(outs)
-        labels.append(label.cpu().detach().numpy())
-        if args.num_data != -1 and used_sum >= args.num_data:break
+        start = time.time()
+        create_cache(configs, test_dataset, metadata)
+        logger.info(f'执行模型的时间：{time.time() - start:.2f}s')
+    num_data = len(PosteriorStore(args.cache_dir))
+    if num_data == 0:
+        raise Exception('没有可以用于调优的数据')
 
     print('开始使用识别结果解码...')
-    print('解码alpha和beta的排列：%s' % params_grid)
-    # 搜索alphas参数和betas参数
-    best_alpha, best_beta, best_cer = 0, 0, 1
-    for i, (alpha, beta) in enumerate(params_grid):
-        beam_search_decoder = BeamSearchDecoder(alpha, beta, args.lang_model_path, test_dataset.vocab_list)
-
-        c = []
-        print('正在解码[%d/%d]: (%.2f, %.2f)' % (i, len(params_grid), alpha, beta))
-        for j in tqdm(range(len(labels))):
-            outs, label = outputs[j], labels[j]
-            out_strings = beam_search_decoder.decode_batch_beam_search(probs_split=outs,
-                                                                       beam_alpha=alpha,
-                                                                       beam_beta=beta,
-                                                                       beam_size=args.beam_size,
-                                                                       cutoff_prob=args.cutoff_prob,
-                                                                       cutoff_top_n=args.cutoff_top_n,
-                                                                       vocab_list=test_dataset.vocab_list,
-                                                                       num_processes=args.num_proc_bsearch)
-            labels_str = labels_to_string(label, test_dataset.vocab_list)
-            for out_string, label in zip(*(out_strings, labels_str)):
-                # 计算字错率或者词错率
-                if args.metrics_type == 'wer':
-                    c.append(wer(out_string, label))
-                else:
-                    c.append(cer(out_string, label))
-        c = float(sum(c) / len(c))
-        if c < best_cer:
-            best_alpha = alpha
-            best_beta = beta
-            best_cer = c
-        print('当alpha为：%f, beta为：%f，%s：%f' % (alpha, beta, args.metrics_type, c))
-    print('【最后结果】当alpha为：%f, beta为：%f，%s最低，为：%f' % (best_alpha, best_beta, args.metrics_type, best_cer))
+    start = time.time()
+    ctx = multiprocessing.get_context('spawn')
+    best_error_sum = ctx.Value('d', float('inf'))
+    executor = ProcessPoolExecutor(max_workers=args.num_processes,
+                                   mp_context=ctx,
+                                   initializer=_init_worker,
+                                   initargs=(args.cache_dir, list(test_dataset.vocab_list), decoder_conf,
+                                             configs.metrics_type, best_error_sum))
+    results = {}
+
+    # 搜索一组参数，已经搜索过的参数不会重复解码
+    def search(params_grid, desc):
+        params_grid = [p for p in dict.fromkeys(params_grid) if p not in results]
+        futures = [executor.submit(_evaluate_params, alpha, beta, args.early_stop) for alpha, beta in params_grid]
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            alpha, beta, error, num_decoded = future.result()
+            results[(alpha, beta)] = error
+            if error is None:
+                logger.info(f'当alpha为：{alpha}, beta为：{beta}，解码{num_decoded}/{num_data}条数据之后提前停止')
+            else:
+                logger.info(f'当alpha为：{alpha}, beta为：{beta}，{configs.metrics_type}：{error:.5f}')
+
+    # 错误率相同时优先选择先搜索的参数，即配置文件中的参数
+    def best_params():
+        params, error = min([(p, e) for p, e in results.items() if e is not None], key=lambda r: r[1])
+        return error, params
+
+    # 先解码配置文件中的参数，作为提前停止其他参数的基准
+    search([(decoder_conf['alpha'], decoder_conf['beta'])], desc='配置文件的参数')
+    alpha_from, alpha_to, beta_from, beta_to = args.alpha_from, args.alpha_to, args.beta_from, args.beta_to
+    for round_id in range(args.num_rounds):
+        cand_alphas = np.linspace(alpha_from, alpha_to, args.num_alphas)
+        cand_betas = np.linspace(beta_from, beta_to, args.num_betas)
+        params_grid = [(round(float(alpha), 3), round(float(beta), 3)) for alpha in cand_alphas for beta in cand_betas]
+        last_best_error = best_params()[0]
+        search(params_grid, desc=f'第{round_id + 1}轮搜索')
+        best_error, (best_alpha, best_beta) = best_params()
+        logger.info(f'第{round_id + 1}轮搜索完成，当前最优的alpha为：{best_alpha}, beta为：{best_beta}，'
+                    f'{configs.metrics_type}：{best_error:.5f}')
+        # 细化搜索没有找到更好的参数时停止
+        if round_id > 0 and best_error >= last_best_error:
+            break
+        # 下一轮在最优参数前后各一个网格步长的范围内搜索
+        alpha_step = (alpha_to - alpha_from) / max(args.num_alphas - 1, 1)
+        beta_step = (beta_to - beta_from) / max(args.num_betas - 1, 1)
+        alpha_from, alpha_to = max(best_alpha - alpha_step, 0.0), best_alpha + alpha_step
+        beta_from, beta_to = best_beta - beta_step, best_beta + beta_step
+    executor.shutdown()
+
+    best_error, (best_alpha, best_beta) = best_params()
+    num_stopped = sum(e is None for e in results.values())
+    logger.info(f'共搜索了{len(results)}组参数，其中{num_stopped}组提前停止，解码时间：{time.time() - start:.2f}s')
+    print('【最后结果】当alpha为：%f, beta为：%f，%s最低，为：%f' % (best_alpha, best_beta, configs.metrics_type, best_error))
 
 
 if __name__ == '__main__':
-    tune()
\ No newline at end of file
+    tune()